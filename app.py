@@ -1,6 +1,37 @@
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 import streamlit as st
-import anthropic
-from typing import List, Dict
+from typing import List, Dict, Optional
+
+# Start of this script run; the qgen imports below only cost anything on a process's first run
+SCRIPT_STARTED = time.perf_counter()
+
+from qgen.bank import QuestionBank
+from qgen.bulk import BulkJob, results_markdown
+from qgen.categorise import Categoriser
+from qgen.clients import ClientRegistry
+from qgen.continuation import MAX_OUTPUT_TOKENS, OutputBudget, complete
+from qgen.dedup import StemIndex
+from qgen.documents import TOP_K, DocumentStore
+from qgen.engine import Engine, Settings
+from qgen.history import HistoryWindow
+from qgen.payload import prompt_hash, usage_metrics
+from qgen.prefetch import Prefetcher
+from qgen.prompts import SYSTEM_PROMPT
+from qgen.question_set import render_markdown
+from qgen.reference import CONDITIONS, INDEXES
+from qgen.rendering import format_message, title
+from qgen.response_cache import ResponseCache, request_key
+from qgen.router import DEFAULT_ROUTES, DEFAULT_TIERS, Route, Router
+from qgen.scheduler import CHAT, Scheduler
+from qgen.singleflight import SingleFlight
+from qgen.telemetry import Telemetry
+
+IMPORTS_DONE = time.perf_counter()
 
 # Page configuration
 st.set_page_config(
@@ -13,66 +44,470 @@ st.set_page_config(
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+# Decides which turns are sent verbatim and folds the rest into a summary
+if "history" not in st.session_state:
+    st.session_state.history = HistoryWindow()
+
+# Identifies this browser session to the shared client registry
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 if "api_key" not in st.session_state:
     # Try to get API key from secrets.toml
     st.session_state.api_key = st.secrets.get("ANTHROPIC_API_KEY", "") if "ANTHROPIC_API_KEY" in st.secrets else ""
     
 if "system_prompt" not in st.session_state:
-    st.session_state.system_prompt = """SBA Purpose
-You are a production model designed to produce difficult mock exam questions for medical students.
-You must produce the following question sets:
-Question Set
-Defined as
-Question Stem
-Lead-In question
-Answer options
-Correct answer
-Why the question set is difficult
-Explanations
-Module categorisation
-Presentation categorisation
-Your tone must be in the most medically complex and succinct tone and you must use long and precise medical terminology. Include red-herrings to make the question complex.
-Question Stem
-It must be challenging for the student and be made in these steps: 
-
-Step 1 - Write the patient's age and gender at the start for example "A 42-year-old male" or "A 5-year-old girl exhibits".
-Step 2 - Write the patient's presenting complaint. Use your information regarding the features, signs and symptoms of the condition to do this. You must use various adjectives and synonyms to describe the signs and symptoms and investigation findings in unique ways. When making multiple question stems, do not repeat question stems for different questions on the same condition. Get creative!!
-
-Step 3 - Never give away the diagnosis in the question stem. All questions MUST BE MULTI-STEPPED by explaining the features of the condition without explicitly mentioning the condition name.
-
-Step 4 - Include red herrings about common differentials/answer options. Use the differentials provided or from your knowledge to include their features within the question stem. Provide them with subtle or less obvious details that allow for multiple possible answers.
-
-Step 5 - Write the investigations and examination findings. Investigation findings must be described and not give away the diagnosis, For example, "Transvaginal ultrasound finding = 6mm gestational sac implanted in the left fallopian tube" NOT "Transvaginal ultrasound confirms an ectopic pregnancy". Giving raw data over formulation is best for example, "her temperature is 38.5°C and pulse rate is 121 bpm" requires more clinical knowledge and experience than "she is pyrexic and tachycardic."
-
-Step 6 - Write down the patient's risk factors and medical history. Use risk factors and medical history from the information provided to you to test the user as to what the most likely diagnosis is. This can allow for your question stems to be even more vague and challenging, as the user has to use probability to assume a diagnosis.
-
-Lead-In question
-Step 1 - The lead-in question should only be answerable alongside the stem. For example, "Given the most likely diagnosis, what is the most likely adverse effect of the most appropriate management option?" requires reading the stem to answer, while "What is the most common adverse effect of ramipril?" is a freestanding question and must be avoided. The lead-in must express uncertainty, asking for the "most likely" diagnosis or the "most appropriate" investigation, implying all options are plausible but one is "most correct." Ensure lead-in questions are positive, as negative questions provide little value.
-Answer options
-Step 1 - Provide five multiple-choice answers (A through to E) for each question. Ensure every answer belongs to the same domain/address of the same topic. The answer options should all be from the same topic or domain. Retrieve this information from the information provided. This makes discrimination more challenging for the candidate. Step 2 - You must avoid and NOT include other options e.g. "A and C" or "all of the above" as options.Step 3 - Include answer pairs e.g. "A - 250mg TDS Amoxicillin and IV Fluids" "B - 500mg TDS Amoxicillin and IV fluids"
-Correct Answer
-Ensure the correct answer is not always e.g. Option A. Change it up when positioning the right answer.
-Why the question is difficult
-You must explain why the question you produced was difficult and multi-stepped commenting on the following:
-the specific mult-stepped thinking a student would need to think about the question
-why the answer options are good as they are of the same domain and have only a small difference compared with the right answer (e.g. 500mg Amoxicillin = correct answer, 450mg Amoxicillin = incorrect answer, 500mg Flucloxcillin = incorrect answer).
-Explanations
-For each answer option, please explain why the answer is wrong or right in this context You use the document provided to support your explanations.
-Module and Presentation Selection
-You must categorise with the following lists from the UKMLA"""
+    st.session_state.system_prompt = SYSTEM_PROMPT
+
+# Streaming is on by default so writers see the question set as it is written
+if "stream_responses" not in st.session_state:
+    st.session_state.stream_responses = True
 
 # Initialize saved prompts
 if "saved_prompts" not in st.session_state:
     st.session_state.saved_prompts = ["Please make the stem more concise"]
 
+# Prompt caching for the system prompt and conversation prefix
+if "prompt_caching" not in st.session_state:
+    st.session_state.prompt_caching = True
+
+# Hash of the system prompt the cache was last written for
+if "cached_prompt_hash" not in st.session_state:
+    st.session_state.cached_prompt_hash = None
+
+# Serve repeated identical requests from the on-disk response cache
+if "use_response_cache" not in st.session_state:
+    st.session_state.use_response_cache = True
+
+# Number of recent turns rendered in full; older ones are collapsed
+if "expanded_turns" not in st.session_state:
+    st.session_state.expanded_turns = 5
+
+# Recent history render times in milliseconds
+if "render_times" not in st.session_state:
+    st.session_state.render_times = deque(maxlen=50)
+
+# Set when the instructions are edited, until the writer applies them and clears the chat
+if "system_prompt_changed" not in st.session_state:
+    st.session_state.system_prompt_changed = False
+
+# Ask for question sets through the tool schema so each answer is a typed record
+if "structured_output" not in st.session_state:
+    st.session_state.structured_output = True
+
+# Edit prompts aimed at one section of a question set only send and rewrite that section
+if "targeted_edits" not in st.session_state:
+    st.session_state.targeted_edits = True
+
+# What to do when a new stem is a near-duplicate of an earlier one: Flag, Regenerate or Off
+if "duplicate_stems" not in st.session_state:
+    st.session_state.duplicate_stems = "Flag"
+
+# Generate the next question set in the background while the writer reads the current one
+if "prefetch_next" not in st.session_state:
+    st.session_state.prefetch_next = False
+
+# Conditions the writer chose to work through; empty means the whole condition list
+if "prefetch_queue" not in st.session_state:
+    st.session_state.prefetch_queue = []
+
+# Assign module and presentation ids locally, leaving the UKMLA lists out of structured requests
+if "local_categoriser" not in st.session_state:
+    st.session_state.local_categoriser = True
+
+# Send light edits and categorisation to a faster model tier than new question sets
+if "model_routing" not in st.session_state:
+    st.session_state.model_routing = True
+
+# Turn class and model chosen for each chat turn, newest last
+if "route_log" not in st.session_state:
+    st.session_state.route_log = []
+
+# Uploaded source document whose relevant passages go with each new question set
+if "source_document" not in st.session_state:
+    st.session_state.source_document = None
+
+# Passages of the source document sent with each request
+if "source_top_k" not in st.session_state:
+    st.session_state.source_top_k = TOP_K
+
+# Results of the last bulk generation run
+if "bulk_results" not in st.session_state:
+    st.session_state.bulk_results = []
+
+
+def reset_chat():
+    history = st.session_state.history
+    st.session_state.messages = []
+    st.session_state.route_log = []
+    st.session_state.history = HistoryWindow(
+        keep_turns=history.keep_turns,
+        token_budget=history.token_budget
+    )
+
+
+def rerun_fragment():
+    """Rerun only the calling fragment, or the whole app when this is a full-app run."""
+    try:
+        st.rerun(scope="fragment")
+    except st.errors.StreamlitAPIException:
+        st.rerun()
+
+
+def get_secret(name: str, default=None):
+    """Read an optional setting from secrets.toml, falling back when no secrets file exists."""
+    try:
+        return st.secrets.get(name, default)
+    except FileNotFoundError:
+        return default
+
+
+@st.cache_resource
+def get_client_registry() -> ClientRegistry:
+    """One registry per server process, so keep-alive connections survive reruns and sessions."""
+    return ClientRegistry(
+        max_connections=int(get_secret("ANTHROPIC_MAX_CONNECTIONS", 20)),
+        max_keepalive_connections=int(get_secret("ANTHROPIC_MAX_KEEPALIVE_CONNECTIONS", 10)),
+        keepalive_expiry=float(get_secret("ANTHROPIC_KEEPALIVE_EXPIRY", 30.0)),
+        connect_timeout=float(get_secret("ANTHROPIC_CONNECT_TIMEOUT", 10.0)),
+        read_timeout=float(get_secret("ANTHROPIC_READ_TIMEOUT", 120.0)),
+        # Retries are left to the scheduler, which shares backoff across sessions
+        max_retries=int(get_secret("ANTHROPIC_MAX_RETRIES", 0)),
+        base_url=get_secret("ANTHROPIC_BASE_URL") or None,
+    )
+
+
+@st.cache_resource
+def get_router() -> Router:
+    """Model tiers and the turn classes sent to each, overridable per deployment."""
+    tiers = {
+        name: replace(tier, model=get_secret(f"{name.upper()}_MODEL", tier.model))
+        for name, tier in DEFAULT_TIERS.items()
+    }
+    routes = {
+        turn_class: get_secret(f"ROUTE_{turn_class.upper()}", tier)
+        for turn_class, tier in DEFAULT_ROUTES.items()
+    }
+    return Router(tiers, routes)
+
+
+@st.cache_resource
+def get_output_budget() -> OutputBudget:
+    """Output sizes seen per request type, shared by every session."""
+    return OutputBudget(ceiling=int(get_secret("MAX_TOKENS_CEILING", MAX_OUTPUT_TOKENS)))
+
+
+@st.cache_resource
+def get_single_flight() -> SingleFlight:
+    return SingleFlight()
+
+
+@st.cache_resource
+def get_scheduler() -> Scheduler:
+    """Per-key rate limits for the whole server process, not per session."""
+    return Scheduler(
+        requests_per_minute=float(get_secret("ANTHROPIC_REQUESTS_PER_MINUTE", 50)),
+        tokens_per_minute=float(get_secret("ANTHROPIC_TOKENS_PER_MINUTE", 40000)),
+        max_retries=int(get_secret("SCHEDULER_MAX_RETRIES", 4)),
+    )
+
+
+def data_path(name: str) -> str:
+    """Location of a local store under the data directory (``QGEN_DATA_DIR``, default ``.qgen``)."""
+    return os.path.join(get_secret("QGEN_DATA_DIR", ".qgen"), name)
+
+
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    return ResponseCache(
+        data_path("response_cache.sqlite3"),
+        max_bytes=int(get_secret("RESPONSE_CACHE_MAX_MB", 50)) * 1024 * 1024,
+        ttl=float(get_secret("RESPONSE_CACHE_TTL_HOURS", 168)) * 3600,
+    )
+
+
+@st.cache_resource
+def get_telemetry() -> Telemetry:
+    return Telemetry(data_path("telemetry.jsonl"))
+
+
+@st.cache_resource
+def get_cold_start() -> Dict[str, float]:
+    """Import and first-render times (ms) of the first script run in this server process.
+
+    Called unconditionally at module level, so the first call is
+    always made by the first run; ``first_render`` is filled in when that
+    run finishes.
+    """
+    return {"started": SCRIPT_STARTED, "imports": (IMPORTS_DONE - SCRIPT_STARTED) * 1000}
+
+
+cold_start = get_cold_start()
+
+
+@st.cache_data
+def search_reference(list_name: str, query: str, limit: int = 25) -> List[tuple]:
+    return INDEXES[list_name].search(query, limit)
+
+
+# Older messages are browsed in pages of this size
+OLDER_PAGE_SIZE = 10
+
+@st.cache_resource
+def get_question_bank() -> QuestionBank:
+    return QuestionBank(data_path("question_bank.sqlite3"))
+
+
+@st.cache_resource
+def get_document_store() -> DocumentStore:
+    """Chunked, indexed source documents, shared by every session and kept per file hash."""
+    return DocumentStore(data_path("documents"))
+
+
+@st.cache_resource
+def get_categoriser() -> Categoriser:
+    """The local module/presentation categoriser, seeded with every categorisation in the bank."""
+    categoriser = Categoriser(threshold=float(get_secret("CATEGORISER_THRESHOLD", 0.5)))
+    categoriser.learn_all(get_question_bank().categorisations())
+    return categoriser
+
+
+@st.cache_resource
+def get_stem_index() -> StemIndex:
+    return StemIndex(
+        data_path("stem_index"),
+        threshold=float(get_secret("STEM_SIMILARITY_THRESHOLD", 0.5)),
+    )
+
+
+def get_engine() -> Engine:
+    """The generation engine with this session's settings and the process-wide resources."""
+    return Engine(
+        Settings(
+            system_prompt=st.session_state.system_prompt,
+            structured=st.session_state.structured_output,
+            prompt_caching=st.session_state.prompt_caching,
+            local_categorisation=st.session_state.local_categoriser,
+            routing=st.session_state.model_routing,
+            targeted_edits=st.session_state.targeted_edits,
+            duplicate_stems=st.session_state.duplicate_stems,
+            top_k=st.session_state.source_top_k,
+            session=st.session_state.session_id,
+        ),
+        router=get_router(),
+        budget=get_output_budget(),
+        categoriser=get_categoriser(),
+        bank=get_question_bank(),
+        stems=get_stem_index(),
+        telemetry=get_telemetry(),
+        document=st.session_state.source_document,
+    )
+
+
+@st.cache_resource
+def get_prefetch_pool() -> ThreadPoolExecutor:
+    """Background workers for speculative generation, shared by every session."""
+    return ThreadPoolExecutor(max_workers=int(get_secret("PREFETCH_WORKERS", 4)), thread_name_prefix="prefetch")
+
+
+# Question sets generated ahead for the next conditions in the writer's queue
+if "prefetcher" not in st.session_state:
+    st.session_state.prefetcher = Prefetcher(get_prefetch_pool())
+
+
+def fill_prefetch():
+    """Keep the prefetch buffer topped up for the current key, prompt, source and output settings.
+
+    Anything prefetched under other settings (most often an edited system
+    prompt) is cancelled and generated again.
+    """
+    if not st.session_state.prefetch_next or not st.session_state.api_key:
+        return
+    api_key = st.session_state.api_key
+    # Worker threads have no script context, so everything they need is captured here
+    engine = get_engine()
+    client = get_client_registry().get(api_key, st.session_state.session_id)
+    limiter = get_scheduler().limiter(api_key)
+
+    def generate(condition: str):
+        job = BulkJob("condition", condition, 1, 1, sources=engine.sources(condition))
+        return engine.generate_sync(client, job, limiter)
+
+    document = engine.document
+    source_key = (document.digest, engine.settings.top_k) if document is not None else None
+    key = (api_key, engine.prompt_hash, engine.settings.structured, source_key, engine.local_categoriser is None)
+    st.session_state.prefetcher.fill(key, generate)
+
+
+@st.cache_data(ttl=5)
+def search_bank(query: str, module_id=None, limit: int = 10) -> tuple:
+    started = time.perf_counter()
+    hits = get_question_bank().search(query, limit=limit, module_id=module_id)
+    return hits, (time.perf_counter() - started) * 1000
+
+
+# Minimum gap between placeholder repaints while streaming, in seconds
+STREAM_REFRESH_INTERVAL = 0.05
+
+
+def show_snapshot(placeholder, snapshot):
+    """Paint partial output: plain text as is, or a partially parsed question-set tool call."""
+    shown = render_markdown(snapshot) if isinstance(snapshot, dict) else snapshot
+    placeholder.markdown(shown + "▌")
+
+
+def stream_response(client, request: Dict, placeholder, publish=None, base=None) -> tuple:
+    """Stream a response into the placeholder and return (final message, time_to_first_token).
+
+    Each snapshot is also handed to ``publish``, so that sessions following
+    the same request can show it too. When continuing a truncated answer,
+    ``base`` is what it had settled so far (text, or tool fields) and is
+    shown ahead of the new output.
+    """
+    started = time.perf_counter()
+    first_token = None
+    last_paint = 0.0
+    snapshot = None
+    with client.messages.stream(**request) as stream:
+        for event in stream:
+            if event.type not in ("text", "input_json"):
+                continue
+            now = time.perf_counter()
+            if first_token is None:
+                first_token = now - started
+            snapshot = event.snapshot
+            if base is not None:
+                snapshot = {**base, **snapshot} if isinstance(snapshot, dict) else base + snapshot
+            # Repainting on every token floods the websocket, so throttle updates
+            if now - last_paint >= STREAM_REFRESH_INTERVAL:
+                show_snapshot(placeholder, snapshot)
+                if publish is not None:
+                    publish(snapshot)
+                last_paint = now
+        response = stream.get_final_message()
+    if first_token is None:
+        first_token = time.perf_counter() - started
+    return response, first_token
+
+
+def call_claude(client, request: Dict, placeholder, kind: str = "chat", route: Optional[Route] = None) -> tuple:
+    """Run one request, streamed or blocking, and return (final message, time_to_first_token, shared).
+
+    The call goes through the chat lane of the shared scheduler, which waits
+    for rate-limit capacity and retries transient failures. If another
+    session is already sending the identical request with the same key,
+    this one follows it instead (``shared`` is then True). An answer cut off
+    at ``max_tokens`` is continued, without regenerating what was already
+    written, and returned as one message; its full size feeds the adaptive
+    ``max_tokens`` for ``kind``. Every attempt, failed or not, is recorded
+    in the shared telemetry, tagged with the turn class it was routed for.
+    """
+    record = dict(
+        source="chat",
+        model=request["model"],
+        session=st.session_state.session_id,
+        prompt_hash=prompt_hash(st.session_state.system_prompt),
+        route=route.turn_class if route is not None else None,
+    )
+    timing = {}
+
+    def attempt(req, publish, base=None):
+        started = time.perf_counter()
+        try:
+            if st.session_state.stream_responses:
+                response, first_token = stream_response(client, req, placeholder, publish, base)
+            else:
+                response = client.messages.create(**req)
+                first_token = time.perf_counter() - started
+        except Exception as e:
+            get_telemetry().record(latency=time.perf_counter() - started, error=type(e).__name__, **record)
+            raise
+        get_telemetry().record(
+            latency=time.perf_counter() - started,
+            usage=usage_metrics(response.usage),
+            stop_reason=response.stop_reason,
+            time_to_first_token=first_token,
+            **record
+        )
+        # Only the first successful attempt counts for time to first token
+        timing.setdefault("started", started)
+        timing.setdefault("first_token", first_token)
+        return response
+
+    def on_retry(error, delay):
+        placeholder.markdown(f"{type(error).__name__}, retrying in {delay:.0f}s...")
+
+    def send(publish):
+        return complete(
+            lambda req, base: limiter.call(lambda: attempt(req, publish, base), req, CHAT, on_retry),
+            request,
+            get_output_budget().ceiling,
+        )
+
+    def follow(snapshot):
+        now = time.perf_counter()
+        timing.setdefault("first_update", now)
+        if now - timing.get("painted", 0.0) >= STREAM_REFRESH_INTERVAL:
+            show_snapshot(placeholder, snapshot)
+            timing["painted"] = now
+
+    queued = time.perf_counter()
+    limiter = get_scheduler().limiter(st.session_state.api_key)
+    # The key folds in the API key, so only callers billed to the same account share a call
+    flight_key = request_key(dict(request, api_key=st.session_state.api_key))
+    response, shared = get_single_flight().do(flight_key, send, follow)
+    if shared:
+        latency = time.perf_counter() - queued
+        get_telemetry().record(latency=latency, stop_reason=response.stop_reason, coalesced=True, **record)
+        return response, timing.get("first_update", time.perf_counter()) - queued, True
+    get_output_budget().observe(kind, response.usage.output_tokens)
+    # What the writer waited for includes time spent queued and on earlier attempts
+    return response, timing["started"] - queued + timing["first_token"], False
+
+
+def format_metrics(metrics: Dict) -> str:
+    text = (
+        f"First token {metrics['time_to_first_token']:.2f}s · "
+        f"total {metrics['total_latency']:.2f}s"
+    )
+    if metrics.get("response_cache"):
+        text += " · served from response cache"
+    elif metrics.get("coalesced"):
+        text += " · shared with an identical request from another session"
+    elif "input_tokens" in metrics:
+        text += (
+            f" · {metrics['input_tokens']} in / {metrics['output_tokens']} out"
+            f" · cache read {metrics['cache_read_input_tokens']}"
+            f" / write {metrics['cache_creation_input_tokens']}"
+        )
+    if metrics.get("model"):
+        text += f" · {metrics['model']}"
+    if metrics.get("sources"):
+        text += f" · {metrics['sources']} source passages"
+    if metrics.get("categorised"):
+        text += f" · {metrics['categorised']}"
+    if metrics.get("refined"):
+        text += f" · revised the {metrics['refined']} only"
+    if metrics.get("prefetched") is not None:
+        text += f" · prefetched in the background ({metrics['prefetched']:.1f}s)"
+    if metrics.get("regenerated"):
+        text += " · regenerated to avoid a duplicate stem"
+    if metrics.get("duplicate_of"):
+        label, similarity = metrics["duplicate_of"]
+        text += f" · ⚠️ stem {similarity:.0%} similar to {label}"
+    return text
+
+
 # Page header
 st.title("Claude Chatbot")
 st.markdown("Chat with Claude using the Anthropic API")
 
-# Sidebar for configuration
-with st.sidebar:
-    st.header("Configuration")
-    
+
+# Each panel below is a fragment, so interacting with it reruns only that panel.
+# Changes that other panels depend on (new instructions, clearing the chat) call
+# st.rerun() without a scope to refresh the whole app.
+@st.fragment
+def configuration_panel():
     # API key input
     api_key = st.text_input(
         "Anthropic API Key", 
@@ -83,6 +518,20 @@ with st.sidebar:
     if api_key:
         st.session_state.api_key = api_key
     
+    # Streaming toggle
+    st.session_state.stream_responses = st.toggle(
+        "Stream responses",
+        value=st.session_state.stream_responses,
+        help="Show Claude's answer as it is generated instead of waiting for the full response."
+    )
+    
+    # Prompt caching toggle
+    st.session_state.prompt_caching = st.toggle(
+        "Prompt caching",
+        value=st.session_state.prompt_caching,
+        help="Cache the system prompt and conversation so far, so follow-up turns only pay for new tokens."
+    )
+    
     # System message input
     st.subheader("System Instructions")
     system_prompt = st.text_area(
@@ -92,11 +541,108 @@ with st.sidebar:
     )
     if system_prompt != st.session_state.system_prompt:
         st.session_state.system_prompt = system_prompt
-        # Reset messages if instructions change
-        if st.button("Apply Changes"):
-            st.session_state.messages = []
-            st.rerun()
+        st.session_state.system_prompt_changed = True
+        # Prefetched question sets were written to the old instructions
+        fill_prefetch()
+    # Reset messages if instructions change; the chat pane is another fragment, so rerun the whole app
+    if st.session_state.system_prompt_changed and st.button("Apply Changes"):
+        st.session_state.system_prompt_changed = False
+        reset_chat()
+        st.rerun()
+    
+    # Structured output toggle
+    st.session_state.structured_output = st.toggle(
+        "Structured question sets",
+        value=st.session_state.structured_output,
+        help="Have Claude fill in a fixed question-set schema (stem, options, answer, categorisation) instead of free text."
+    )
     
+    # Targeted edits toggle
+    st.session_state.targeted_edits = st.toggle(
+        "Targeted edits",
+        value=st.session_state.targeted_edits,
+        help=(
+            "When a prompt asks to change one section of the last question set (e.g. \"make the stem more "
+            "concise\"), send and rewrite only that section, then patch it into the set."
+        ),
+        disabled=not st.session_state.structured_output
+    )
+    
+    # Local categoriser toggle
+    st.session_state.local_categoriser = st.toggle(
+        "Local categorisation",
+        value=st.session_state.local_categoriser,
+        help=(
+            "Assign UKMLA module and presentation ids on this machine after generation, leaving both lists "
+            "out of the request. Claude is only asked when the local match is not confident."
+        ),
+        disabled=not st.session_state.structured_output
+    )
+    
+    # Model routing toggle
+    st.session_state.model_routing = st.toggle(
+        "Model routing",
+        value=st.session_state.model_routing,
+        help=(
+            "Send saved-prompt refinements and categorisation-only requests to a faster, cheaper model, "
+            "and keep the strongest model for new question sets."
+        )
+    )
+    
+    # Response cache toggle
+    st.session_state.use_response_cache = st.toggle(
+        "Response cache",
+        value=st.session_state.use_response_cache,
+        help="Reuse a stored answer when the exact same request (prompt, history and settings) was sent before."
+    )
+    if st.session_state.use_response_cache:
+        cache_stats = get_response_cache().stats()
+        st.caption(
+            f"Response cache: {cache_stats['hits']} hits · {cache_stats['misses']} misses · "
+            f"{cache_stats['entries']} entries ({cache_stats['bytes'] / 1024:.0f} KB)"
+        )
+    
+    # Near-duplicate stem handling
+    modes = ["Flag", "Regenerate", "Off"]
+    st.session_state.duplicate_stems = st.radio(
+        "Near-duplicate stems",
+        modes,
+        index=modes.index(st.session_state.duplicate_stems),
+        horizontal=True,
+        help="Compare each new stem with every stem generated so far, and flag or regenerate close copies."
+    )
+    
+    # History window settings
+    st.subheader("Conversation History")
+    history = st.session_state.history
+    history.keep_turns = st.number_input(
+        "Turns sent verbatim",
+        min_value=1,
+        max_value=50,
+        value=history.keep_turns,
+        help="Older turns are folded into a short summary instead of being resent."
+    )
+    history.token_budget = st.number_input(
+        "History token budget",
+        min_value=1000,
+        max_value=150000,
+        value=history.token_budget,
+        step=1000
+    )
+    st.session_state.expanded_turns = st.number_input(
+        "Turns shown expanded",
+        min_value=1,
+        max_value=50,
+        value=st.session_state.expanded_turns,
+        help="Older turns are collapsed into pages to keep the page fast."
+    )
+    if history.summary:
+        with st.expander("Conversation summary", expanded=False):
+            st.text(history.summary)
+
+
+@st.fragment
+def saved_prompts_panel():
     # Common Prompts section
     st.subheader("Common Prompts")
     
@@ -111,7 +657,7 @@ with st.sidebar:
         if new_prompt not in st.session_state.saved_prompts:
             st.session_state.saved_prompts.append(new_prompt)
             st.success("Prompt saved!")
-            st.rerun()
+            rerun_fragment()
     
     # Display saved prompts with copy buttons
     if st.session_state.saved_prompts:
@@ -126,630 +672,427 @@ with st.sidebar:
             with col3:
                 if st.button("Delete", key=f"delete_{i}"):
                     st.session_state.saved_prompts.pop(i)
-                    st.rerun()
+                    rerun_fragment()
+
+
+@st.fragment
+def reference_lists_panel():
+    list_name = st.selectbox("List", list(INDEXES), index=2)
+    query = st.text_input(
+        "Search",
+        placeholder="e.g. 57, chest, diab keto",
+        help="Matches list numbers, word prefixes, and close spellings."
+    )
+    matches = search_reference(list_name, query)
+    st.caption(f"{len(matches)} of {len(INDEXES[list_name])} shown")
+    st.markdown("\n".join(f"- **{number}** {name}" for number, name in matches))
+
+
+@st.fragment
+def question_bank_panel():
+    bank_query = st.text_input(
+        "Search questions",
+        placeholder="e.g. hyperpigmentation hyponatraemia",
+        help="Searches stems, lead-ins, explanations and conditions of every question generated so far."
+    )
+    modules = {"All modules": None}
+    modules.update({f"{number} - {name}": number for number, name in INDEXES["Modules"].by_id.items()})
+    module = st.selectbox("Module", list(modules))
+    if not bank_query:
+        st.caption(f"{len(get_question_bank())} questions in the bank")
+        return
+    hits, elapsed = search_bank(bank_query, modules[module])
+    st.caption(f"{len(hits)} matches in {elapsed:.1f} ms")
+    for hit in hits:
+        with st.expander(f"#{hit.id} {hit.condition or 'Question set'}"):
+            st.markdown(hit.snippet)
+            st.divider()
+            st.markdown(hit.body)
+
+
+@st.fragment
+def prefetch_panel():
+    prefetcher = st.session_state.prefetcher
+    st.session_state.prefetch_next = st.toggle(
+        "Prefetch next question",
+        value=st.session_state.prefetch_next,
+        help="Generate the next question sets in the background while you read, so Next question is instant."
+    )
+    if not st.session_state.prefetch_next:
+        prefetcher.cancel()
+        return
+    queue = st.multiselect(
+        "Condition queue",
+        CONDITIONS.names,
+        default=st.session_state.prefetch_queue,
+        help="Conditions to work through, in this order. Leave empty to go through the whole list."
+    )
+    if queue != st.session_state.prefetch_queue or not (prefetcher.queue or prefetcher.pending()):
+        st.session_state.prefetch_queue = queue
+        prefetcher.set_queue(queue or CONDITIONS.names)
+    prefetcher.size = st.number_input("Question sets to keep ready", min_value=1, max_value=5, value=prefetcher.size)
+    fill_prefetch()
+    pending = prefetcher.pending()
+    ready = sum(1 for _, done in pending if done)
+    st.caption(
+        f"{ready} ready · {len(pending) - ready} generating · {len(prefetcher.queue)} more in the queue"
+    )
+
+
+def next_question_controls():
+    """The Next question button, served from the prefetch buffer."""
+    prefetcher = st.session_state.prefetcher
+    fill_prefetch()
+    pending = prefetcher.pending()
+    if not st.session_state.prefetch_next or not pending:
+        return
+    condition, done = pending[0]
+    label = f"Next question: {condition}" if done else f"Next question: {condition} (still generating)"
+    if not st.button(label, key="next_question"):
+        return
+    started = time.perf_counter()
+    condition, future = prefetcher.take()
+    with st.spinner(f"Finishing {condition}..."):
+        result = future.result()
+    fill_prefetch()
+    if result.error:
+        st.error(f"Could not prefetch {condition}: {result.error}")
+        return
+    waited = time.perf_counter() - started
+    metrics = {"time_to_first_token": waited, "total_latency": waited, "prefetched": result.latency, **result.usage}
+    engine = get_engine()
+    duplicates, stem_sig = engine.duplicates(result.text, result.question_set)
+    if duplicates:
+        metrics["duplicate_of"] = duplicates[0]
+    st.session_state.messages += [
+        {"role": "user", "content": result.job.prompt},
+        {"role": "assistant", "content": result.text, "metrics": metrics, "question_set": result.question_set},
+    ]
+    st.session_state.messages = st.session_state.history.trim(st.session_state.messages)
+    engine.bank_answer(result.text, result.question_set, "prefetch", stem_sig)
+    rerun_fragment()
+
+
+# Refreshes on a timer as well, since calls made in other fragments and sessions don't rerun it
+@st.fragment(run_every=10)
+def telemetry_panel():
+    cold_start = get_cold_start()
+    if "first_render" in cold_start:
+        st.caption(
+            f"Cold start: imports {cold_start['imports']:.0f} ms · "
+            f"first render {cold_start['first_render']:.0f} ms"
+        )
+    summary = get_telemetry().summary(st.session_state.session_id)
+    if not summary["calls"]:
+        st.caption("No API calls yet.")
+        return
+
+    def seconds(value):
+        return "–" if value is None else f"{value:.2f}s"
+
+    col1, col2 = st.columns(2)
+    col1.metric("p50 latency", seconds(summary["p50_latency"]))
+    col2.metric("p95 latency", seconds(summary["p95_latency"]))
+    col1.metric("p50 first token", seconds(summary["p50_time_to_first_token"]))
+    col2.metric("p95 first token", seconds(summary["p95_time_to_first_token"]))
+    col1.metric("Tokens / min", f"{summary['tokens_per_minute']:,.0f}")
+    col2.metric("Session spend", f"${summary['session_spend']:.4f}")
+    st.caption(
+        f"{summary['calls']} recent calls across all sessions · {summary['errors']} errors · "
+        f"{summary['coalesced']} shared with an identical in-flight request ({summary['coalesced_rate']:.0%}) · "
+        f"${summary['spend']:.4f} estimated spend since the server started"
+    )
+    for (turn_class, model), stats in sorted(summary["routes"].items()):
+        st.caption(
+            f"{turn_class} → {model}: {stats['calls']} calls · p95 {seconds(stats['p95_latency'])} · "
+            f"${stats['mean_cost']:.4f}/call"
+        )
+    budgets = {kind: limit for kind, limit in get_output_budget().snapshot().items() if limit is not None}
+    if budgets:
+        st.caption("Adaptive max_tokens: " + " · ".join(f"{kind} {limit:,}" for kind, limit in sorted(budgets.items())))
+
+
+# Refreshes on a timer, since turns are routed inside the chat fragment
+@st.fragment(run_every=10)
+def routing_panel():
+    router = get_router()
+    for turn_class, tier_name in router.routes.items():
+        tier = router.tiers[tier_name]
+        st.caption(
+            f"{turn_class.title()}: {tier.name} tier ({tier.model}) · "
+            f"targets p95 {tier.latency_target:.0f}s, ${tier.cost_target:.3f}/call"
+        )
+    if not st.session_state.model_routing:
+        st.caption("Routing is off, so every turn uses the generation tier.")
+    log = st.session_state.route_log
+    if not log:
+        return
+    st.write("Recent turns:")
+    for number, entry in reversed(list(enumerate(log, start=1))[-10:]):
+        st.caption(f"Turn {number} · {entry['turn_class']} → {entry['model']} ({entry['reason']})")
+
+
+@st.fragment
+def source_document_panel():
+    uploaded = st.file_uploader(
+        "Upload a guideline or source document",
+        type=["pdf", "md", "markdown", "txt"],
+        help="Only the passages most relevant to each condition are sent with a request, not the whole document."
+    )
+    previous = st.session_state.source_document
+    if uploaded is None:
+        st.session_state.source_document = None
+    else:
+        try:
+            st.session_state.source_document = get_document_store().load(uploaded.name, uploaded.getvalue())
+        except ValueError as e:
+            st.session_state.source_document = None
+            st.error(str(e))
+    document = st.session_state.source_document
+    if document is not None:
+        st.session_state.source_top_k = st.slider(
+            "Passages per request", min_value=1, max_value=12, value=st.session_state.source_top_k
+        )
+        per_chunk = document.words / len(document.chunks)
+        st.caption(
+            f"{document.name}: {len(document.chunks)} passages, {document.words:,} words · "
+            f"each request sends about {min(st.session_state.source_top_k * per_chunk, document.words):,.0f} of them"
+        )
+    # Anything prefetched with the old passages is regenerated
+    if (previous and previous.digest) != (document and document.digest):
+        fill_prefetch()
+
+
+@st.fragment
+def bulk_generation_panel():
+    with st.expander("Bulk Generation", expanded=False):
+        source = st.radio("Generate from", ["Conditions", "Presentations"], horizontal=True)
+        names = INDEXES[source].names
+        selected = st.multiselect(f"{source} to cover", names)
+        col1, col2 = st.columns(2)
+        with col1:
+            count = st.number_input("Question sets per item", min_value=1, max_value=10, value=1)
+        with col2:
+            concurrency = st.slider("Concurrent requests", min_value=1, max_value=32, value=8)
     
-    # Clear chat button
-    if st.button("Clear Chat"):
-        st.session_state.messages = []
-        st.rerun()
+        if st.button("Generate question sets", disabled=not selected):
+            if not st.session_state.api_key:
+                st.error("Please enter your Anthropic API key in the sidebar.")
+                return
         
-    # Reference Lists in sidebar
-    st.header("Reference Lists")
+            engine = get_engine()
+            jobs = engine.jobs(source[:-1].lower(), selected, count)
+            progress = st.progress(0.0, text=f"0 of {len(jobs)} question sets")
+            status = st.empty()
+            failures = st.container()
+        
+            def on_result(result, stats):
+                progress.progress(stats.done / stats.total, text=f"{stats.done} of {stats.total} question sets")
+                status.caption(
+                    f"{stats.completed} done · {stats.failed} failed · "
+                    f"{stats.per_minute:.1f} sets/min · "
+                    f"{stats.output_tokens / max(stats.elapsed, 1e-9):.0f} output tokens/s"
+                )
+                if result.error:
+                    failures.warning(f"{result.job.item} ({result.job.number}/{result.job.count}): {result.error}")
+        
+            def on_regenerate(held):
+                status.caption(f"Regenerating {held} question sets with near-duplicate stems...")
+        
+            # Every generated set is kept in the question bank; near-duplicates are flagged or asked for again once
+            results = engine.generate_bulk(
+                get_client_registry().build_async(st.session_state.api_key),
+                jobs,
+                concurrency,
+                on_result,
+                limiter=get_scheduler().limiter(st.session_state.api_key),
+                on_regenerate=on_regenerate
+            )
+            st.session_state.bulk_results = results
+    
+        if st.session_state.bulk_results:
+            succeeded = sum(1 for r in st.session_state.bulk_results if not r.error)
+            duplicates = sum(1 for r in st.session_state.bulk_results if r.duplicate_of)
+            caption = f"{succeeded} of {len(st.session_state.bulk_results)} question sets generated in the last run."
+            if duplicates:
+                caption += f" {duplicates} flagged as near-duplicate stems."
+            st.caption(caption)
+            st.download_button(
+                "Download question sets",
+                results_markdown(st.session_state.bulk_results),
+                file_name="question_sets.md",
+                mime="text/markdown"
+            )
+
+
+def render_message(i: int, message: Dict):
+    with st.chat_message(message["role"]):
+        st.markdown(format_message(message))
+        if "metrics" in message:
+            st.caption(format_metrics(message["metrics"]))
+        if message["role"] == "assistant":
+            if "pinned" in message:
+                st.caption(f"Finalised as {message['pinned']}")
+            elif st.button("Pin as final", key=f"pin_{i}", help="Send only a short reference to this question set from now on."):
+                st.session_state.history.pin(message)
+                rerun_fragment()
+
+
+@st.fragment
+def chat_pane():
+    started = time.perf_counter()
     
-    with st.expander("Module List", expanded=False):
-        module_list = """Module
-1 - Acute and emergency,
-2 - Cancer,
-3 - Cardiovascular,
-4 - Child health,
-5 - Clinical Haematology,
-6 - Clinical imaging,
-7 - Dermatology,
-8 - Ear, nose and throat,
-9 - Endocrine and metabolic,
-10 - Gastrointestinal including liver,
-11 - General practice and primary healthcare,
-12 - Infection,
-13 - Mental health,
-14 - Musculoskeletal,
-15 - Neurosciences,
-16 - Obstetrics and gynaecology,
-17 - Ophthalmology,
-18 - Perioperative medicine and anaesthesia,
-19 - Renal and urology,
-20 - Respiratory,
-21 - Surgery,
-22 - Allergy and immunology,
-23 - Clinical biochemistry,
-24 - Clinical pharmacology and therapeutics,
-25 - Genetics and genomics,
-26 - Laboratory haematology,
-27 - Palliative and end of life care,
-28 - Social and population health,
-57 - Geriatric"""
-        st.code(module_list, language=None)
+    # Display chat messages
+    if st.session_state.history.dropped:
+        st.caption(
+            f"{st.session_state.history.dropped} earlier messages have been folded "
+            "into the conversation summary."
+        )
+    messages = st.session_state.messages
     
-    with st.expander("Presentation List", expanded=False):
-        presentation_list = """Presentations
-1. Abdominal distension,
-2. Abdominal mass,
-3. Abnormal cervical smear result,
-4. Abnormal development/developmental delay,
-5. Abnormal eating or exercising behavior,
-6. Abnormal involuntary movements,
-7. Abnormal urinalysis,
-8. Acute abdominal pain,
-9. Acute and chronic pain management,
-10. Acute change in or loss of vision,
-11. Acute joint pain/swelling,
-12. Acute kidney injury,
-13. Acute rash,
-14. Addiction,
-15. Allergies,
-16. Altered sensation, numbness and tingling,
-17. Amenorrhoea,
-18. Anaphylaxis,
-19. Anosmia,
-20. Anxiety, phobias, OCD,
-21. Ascites,
-22. Auditory hallucinations,
-23. Back pain,
-24. Behaviour/personality change,
-25. Behavioural difficulties in childhood,
-26. Bites and stings,
-27. Blackouts and faints,
-28. Bleeding antepartum,
-29. Bleeding from lower GI tract,
-30. Bleeding from upper GI tract,
-31. Bleeding postpartum,
-32. Bone pain,
-33. Breast lump,
-34. Breast tenderness/pain,
-35. Breathlessness,
-36. Bruising,
-37. Burns,
-38. Cardiorespiratory arrest,
-39. Change in bowel habit,
-40. Change in stool color,
-41. Chest pain,
-42. Child abuse,
-43. Chronic abdominal pain,
-44. Chronic joint pain/stiffness,
-45. Chronic kidney disease,
-46. Chronic rash,
-47. Cold, painful, pale, pulseless leg/foot,
-48. Complications of labour,
-49. Confusion,
-50. Congenital abnormalities,
-51. Constipation,
-52. Contraception request/advice,
-53. Cough,
-54. Crying baby,
-55. Cyanosis,
-56. Death and dying,
-57. Decreased appetite,
-58. Decreased/loss of consciousness,
-59. Dehydration,
-60. Deteriorating patient,
-61. Diarrhoea,
-62. Difficulty with breastfeeding,
-63. Diplopia,
-64. Dizziness,
-65. Driving advice,
-66. Dysmorphic child,
-67. Ear and nasal discharge,
-68. Elation/elated mood,
-69. Elder abuse,
-70. Electrolyte abnormalities,
-71. End of life care/symptoms of terminal illness,
-72. Epistaxis,
-73. Erectile dysfunction,
-74. Eye pain/discomfort,
-75. Eye trauma,
-76. Facial pain,
-77. Facial weakness,
-78. Facial/periorbital swelling,
-79. Faecal incontinence,
-80. Falls,
-81. Family history of possible genetic disorder,
-82. Fasciculation,
-83. Fatigue,
-84. Fever,
-85. Fit notes,
-86. Fits/seizures,
-87. Fixed abnormal beliefs,
-88. Flashes and floaters in visual fields,
-89. Food intolerance,
-90. Foreign body in eye,
-91. Frailty,
-92. Gradual change in or loss of vision,
-93. Gynaecomastia,
-94. Haematuria,
-95. Haemoptysis,
-96. Head injury,
-97. Headache,
-98. Hearing loss,
-99. Heart murmurs,
-100. Hoarseness and voice change,
-101. Hyperemesis,
-102. Hypertension,
-103. Immobility,
-104. Incidental findings,
-105. Infant feeding problems,
-106. Intrauterine death,
-107. Jaundice,
-108. Labour,
-109. Lacerations,
-110. Learning disability,
-111. Limb claudication,
-112. Limb weakness,
-113. Limp,
-114. Loin pain,
-115. Loss of libido,
-116. Loss of red reflex,
-117. Low blood pressure,
-118. Low mood/affective problems,
-119. Lump in groin,
-120. Lymphadenopathy,
-121. Massive haemorrhage,
-122. Melaena,
-123. Memory loss,
-124. Menopausal problems,
-125. Menstrual problems,
-126. Mental capacity concerns,
-127. Mental health problems in pregnancy or postpartum,
-128. Misplaced nasogastric tube,
-129. Muscle pain/myalgia,
-130. Musculoskeletal deformities,
-131. Nail abnormalities,
-132. Nasal obstruction,
-133. Nausea,
-134. Neck lump,
-135. Neck pain/stiffness,
-136. Neonatal death or cot death,
-137. Neuromuscular weakness,
-138. Night sweats,
-139. Nipple discharge,
-140. Normal pregnancy and antenatal care,
-141. Oliguria,
-142. Organomegaly,
-143. Overdose,
-144. Pain on inspiration,
-145. Painful ear,
-146. Painful sexual intercourse,
-147. Painful swollen leg,
-148. Pallor,
-149. Palpitations,
-150. Pelvic mass,
-151. Pelvic pain,
-152. Perianal symptoms,
-153. Peripheral oedema and ankle swelling,
-154. Petechial rash,
-155. Pleural effusion,
-156. Poisoning,
-157. Polydipsia (thirst),
-158. Post-surgical care and complications,
-159. Pregnancy risk assessment,
-160. Prematurity,
-161. Pressure of speech,
-162. Pruritus,
-163. Ptosis,
-164. Pubertal development,
-165. Purpura,
-166. Rectal prolapse,
-167. Red eye,
-168. Reduced/change in fetal movements,
-169. Scarring,
-170. Scrotal/testicular pain and/or lump/swelling,
-171. Self-harm,
-172. Shock,
-173. Skin lesion,
-174. Skin or subcutaneous lump,
-175. Skin ulcers,
-176. Sleep problems,
-177. Small for gestational age/large for gestational age,
-178. Snoring,
-179. Soft tissue injury,
-180. Somatisation/medically unexplained physical symptoms,
-181. Sore throat,
-182. Speech and language problems,
-183. Squint,
-184. Stridor,
-185. Struggling to cope at home,
-186. Subfertility,
-187. Substance misuse,
-188. Suicidal thoughts,
-189. Swallowing problems,
-190. The sick child,
-191. Threats to harm others,
-192. Tinnitus,
-193. Trauma,
-194. Travel health advice,
-195. Tremor,
-196. Unsteadiness,
-197. Unwanted pregnancy and termination,
-198. Urethral discharge and genital ulcers/warts,
-199. Urinary incontinence,
-200. Urinary symptoms,
-201. Vaccination,
-202. Vaginal discharge,
-203. Vaginal prolapse,
-204. Vertigo,
-205. Visual hallucinations,
-206. Vomiting,
-207. Vulval itching/lesion,
-208. Vulval/vaginal lump,
-209. Weight gain,
-210. Weight loss,
-211. Wellbeing checks,
-212. Wheeze"""
-        st.code(presentation_list, language=None)
+    # Older turns stay collapsed and are only rendered one page at a time
+    older = max(0, len(messages) - st.session_state.expanded_turns * 2)
+    if older:
+        pages = ["Hidden"] + [
+            f"Messages {start + 1}-{min(start + OLDER_PAGE_SIZE, older)}"
+            for start in range(0, older, OLDER_PAGE_SIZE)
+        ]
+        page = st.selectbox(f"{older} older messages", pages, key="older_page")
+        if page != "Hidden":
+            start = (pages.index(page) - 1) * OLDER_PAGE_SIZE
+            for i in range(start, min(start + OLDER_PAGE_SIZE, older)):
+                message = messages[i]
+                with st.expander(f"{message['role'].title()}: {title(message)}"):
+                    st.markdown(format_message(message))
     
-    with st.expander("Condition List", expanded=False):
-        condition_list = """Condition name
-1. Acid-base abnormality
-2. Acne vulgaris
-3. Acoustic neuroma
-4. Acute bronchitis
-5. Acute cholangitis
-6. Acute coronary syndromes
-7. Acute glaucoma
-8. Acute kidney injury
-9. Acute pancreatitis
-10. Acute stress reaction
-11. Addison's disease
-12. Adverse drug effects
-13. Alcoholic hepatitis
-14. Allergic disorder
-15. Anaemia
-16. Anal fissure
-17. Anaphylaxis
-18. Aneurysms, ischaemic limb and occlusions
-19. Ankylosing spondylitis
-20. Anxiety disorder: generalised
-21. Anxiety disorder: post-traumatic stress disorder
-22. Anxiety, phobias, OCD
-23. Aortic aneurysm
-24. Aortic dissection
-25. Aortic valve disease
-26. Appendicitis
-27. Arrhythmias
-28. Arterial thrombosis
-29. Arterial ulcers
-30. Asbestos-related lung disease
-31. Ascites
-32. Asthma
-33. Asthma COPD overlap syndrome
-34. Atopic dermatitis and eczema
-35. Atrophic vaginitis
-36. Attention deficit hyperactivity disorder
-37. Autism spectrum disorder
-38. Bacterial vaginosis
-39. Basal cell carcinoma
-40. Bell's palsy
-41. Benign eyelid disorders
-42. Benign paroxysmal positional vertigo
-43. Benign prostatic hyperplasia
-44. Biliary atresia
-45. Bipolar affective disorder
-46. Bladder cancer
-47. Blepharitis
-48. Brain abscess
-49. Brain metastases
-50. Breast abscess/mastitis
-51. Breast cancer
-52. Breast cysts
-53. Bronchiectasis
-54. Bronchiolitis
-55. Bursitis
-56. Candidiasis
-57. Cardiac arrest
-58. Cardiac failure
-59. Cataracts
-60. Cellulitis
-61. Central retinal arterial occlusion
-62. Cerebral palsy and hypoxic-ischaemic encephalopathy
-63. Cervical cancer
-64. Cervical screening (HPV)
-65. Chlamydia
-66. Cholecystitis
-67. Chronic fatigue syndrome
-68. Chronic glaucoma
-69. Chronic kidney disease
-70. Chronic obstructive pulmonary disease
-71. Cirrhosis
-72. Coeliac disease
-73. Colorectal tumours
-74. Compartment syndrome
-75. Conjunctivitis
-76. Constipation
-77. Contact dermatitis
-78. Cord prolapse
-79. Covid-19
-80. Croup
-81. Crystal arthropathy
-82. Cushing's syndrome
-83. Cutaneous fungal infection
-84. Cutaneous warts
-85. Cystic fibrosis
-86. Deep vein thrombosis
-87. Dehydration
-88. Delirium
-89. Dementias
-90. Depression
-91. Developmental delay
-92. Diabetes in pregnancy (gestational and pre-existing)
-93. Diabetes insipidus
-94. Diabetes mellitus type 1 and type 2
-95. Diabetic eye disease
-96. Diabetic ketoacidosis
-97. Diabetic nephropathy
-98. Diabetic neuropathy
-99. Disease prevention/screening
-100. Disseminated intravascular coagulation
-101. Diverticular disease
-102. Down's syndrome
-103. Drug overdose
-104. Eating disorders
-105. Ectopic pregnancy
-106. Encephalitis
-107. Endometrial cancer
-108. Endometriosis
-109. Epididymitis and orchitis
-110. Epiglottitis
-111. Epilepsy
-112. Epistaxis
-113. Essential or secondary hypertension
-114. Essential tremor
-115. Extradural haemorrhage
-116. Febrile convulsion
-117. Fibroadenoma
-118. Fibroids
-119. Fibromyalgia
-120. Fibrotic lung disease
-121. Folliculitis
-122. Gallstones and biliary colic
-123. Gangrene
-124. Gastric cancer
-125. Gastrointestinal perforation
-126. Gastro-oesophageal reflux disease
-127. Gonorrhoea
-128. Haemochromatosis
-129. Haemoglobinopathies
-130. Haemophilia
-131. Haemorrhoids
-132. Head lice
-133. Henoch-Schonlein purpura
-134. Hepatitis
-135. Hernias
-136. Herpes simplex virus
-137. Hiatus hernia
-138. Hospital acquired infections
-139. Human immunodeficiency virus
-140. Human papilloma virus infection
-141. Hypercalcaemia of malignancy
-142. Hyperlipidemia
-143. Hyperosmolar hyperglycaemic state
-144. Hyperparathyroidism
-145. Hyperthermia and hypothermia
-146. Hypoglycaemia
-147. Hypoparathyroidism
-148. Hyposplenism/splenectomy
-149. Hypothyroidism
-150. Idiopathic arthritis
-151. Impetigo
-152. Infectious colitis
-153. Infectious diarrhoea
-154. Infectious mononucleosis
-155. Infective endocarditis
-156. Infective keratitis
-157. Inflammatory bowel disease
-158. Influenza
-159. Intestinal ischaemia
-160. Intestinal obstruction and ileus
-161. Intussusception
-162. Iritis
-163. Irritable bowel syndrome
-164. Ischaemic heart disease
-165. Kawasaki disease
-166. Leukaemia
-167. Liver failure
-168. Lower limb fractures
-169. Lower limb soft tissue injury
-170. Lower respiratory tract infection
-171. Lung cancer
-172. Lyme disease
-173. Lymphoma
-174. Macular degeneration
-175. Malabsorption
-176. Malaria
-177. Malignant melanoma
-178. Malnutrition
-179. Measles
-180. Ménière's disease
-181. Meningitis
-182. Menopause
-183. Mesenteric adenitis
-184. Metastatic disease
-185. Migraine
-186. Mitral valve disease
-187. Motor neurone disease
-188. Multi-organ dysfunction syndrome
-189. Multiple myeloma
-190. Multiple sclerosis
-191. Mumps
-192. Muscular dystrophies
-193. Myasthenia gravis
-194. Myeloproliferative disorders
-195. Myocardial infarction
-196. Myocarditis
-197. Necrotising enterocolitis
-198. Necrotising fasciitis
-199. Nephrotic syndrome
-200. Non-accidental injury
-201. Notifiable diseases
-202. Obesity
-203. Obesity and pregnancy
-204. Obstructive sleep apnoea
-205. Occupational lung disease
-206. Oesophageal cancer
-207. Optic neuritis
-208. Osteoarthritis
-209. Osteomalacia
-210. Osteomyelitis
-211. Osteoporosis
-212. Otitis externa
-213. Otitis media
-214. Ovarian cancer
-215. Pancreatic cancer
-216. Pancytopenia
-217. Parkinson's disease
-218. Pathological fracture
-219. Patient on anti-coagulant therapy
-220. Patient on anti-platelet therapy
-221. Pelvic inflammatory disease
-222. Peptic ulcer disease and gastritis
-223. Perianal abscesses and fistulae
-224. Pericardial disease
-225. Periorbital and orbital cellulitis
-226. Peripheral nerve injuries/palsies
-227. Peripheral vascular disease
-228. Peritonitis
-229. Personality disorder
-230. Pituitary tumours
-231. Placenta praevia
-232. Placental abruption
-233. Pneumonia
-234. Pneumothorax
-235. Polycythaemia
-236. Polymyalgia rheumatica
-237. Postpartum haemorrhage
-238. Pre-eclampsia, gestational hypertension
-239. Pressure sores
-240. Prostate cancer
-241. Psoriasis
-242. Pulmonary embolism
-243. Pulmonary hypertension
-244. Pyloric stenosis
-245. Radiculopathies
-246. Raised intracranial pressure
-247. Reactive arthritis
-248. Respiratory arrest
-249. Respiratory failure
-250. Retinal detachment
-251. Rheumatoid arthritis
-252. Rhinosinusitis
-253. Right heart valve disease
-254. Rubella
-255. Sarcoidosis
-256. Scabies
-257. Schizophrenia
-258. Scleritis
-259. Self-harm
-260. Sepsis
-261. Septic arthritis
-262. Sickle cell disease
-263. Somatisation
-264. Spinal cord compression
-265. Spinal cord injury
-266. Spinal fracture
-267. Squamous cell carcinoma
-268. Stroke
-269. Subarachnoid haemorrhage
-270. Subdural haemorrhage
-271. Substance use disorder
-272. Surgical site infection
-273. Syphilis
-274. Systemic lupus erythematosus
-275. Tension headache
-276. Termination of pregnancy
-277. Testicular cancer
-278. Testicular torsion
-279. Thyroid eye disease
-280. Thyroid nodules
-281. Thyrotoxicosis
-282. Tonsillitis
-283. Toxic shock syndrome
-284. Transfusion reactions
-285. Transient ischaemic attacks
-286. Trichomonas vaginalis
-287. Trigeminal neuralgia
-288. Tuberculosis
-289. Unstable angina
-290. Upper limb fractures
-291. Upper limb soft tissue injury
-292. Upper respiratory tract infection
-293. Urinary incontinence
-294. Urinary tract calculi
-295. Urinary tract infection
-296. Urticaria
-297. Uveitis
-298. Varicella zoster
-299. Varicose veins
-300. Vasa praevia
-301. Vasovagal syncope
-302. Venous ulcers
-303. Viral exanthema
-304. Viral gastroenteritis
-305. Viral hepatitides
-306. Visual field defects
-307. Vitamin B12 and/or folate deficiency
-308. Volvulus
-309. VTE in pregnancy and puerperium
-310. Wernicke's encephalopathy
-311. Whooping cough"""
-        st.code(condition_list, language=None)
-
-# Display chat messages
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
-
-# User input
-if prompt := st.chat_input("Ask Claude something..."):
-    # Check if API key is provided
-    if not st.session_state.api_key:
-        st.error("Please enter your Anthropic API key in the sidebar.")
-        st.stop()
+    for i in range(older, len(messages)):
+        render_message(i, messages[i])
     
-    # Display user message
-    with st.chat_message("user"):
-        st.markdown(prompt)
+    # Track render time so we can check it stays flat as the history grows
+    elapsed = (time.perf_counter() - started) * 1000
+    render_times = st.session_state.render_times
+    render_times.append(elapsed)
+    st.caption(
+        f"History rendered in {elapsed:.0f} ms "
+        f"(average {sum(render_times) / len(render_times):.0f} ms over the last {len(render_times)} runs, "
+        f"{len(messages)} messages)"
+    )
+
+    # Serve the next prefetched question set, if prefetching is on
+    next_question_controls()
+    
+    # User input
+    if prompt := st.chat_input("Ask Claude something..."):
+        # Check if API key is provided
+        if not st.session_state.api_key:
+            st.error("Please enter your Anthropic API key in the sidebar.")
+            return
     
-    # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": prompt})
+        # Display user message
+        with st.chat_message("user"):
+            st.markdown(prompt)
     
-    # Display assistant typing indicator
-    with st.chat_message("assistant"):
-        message_placeholder = st.empty()
-        message_placeholder.markdown("Thinking...")
+        # Add user message to chat history
+        st.session_state.messages.append({"role": "user", "content": prompt})
+    
+        # Pick the model tier for this kind of turn
+        engine = get_engine()
+        route = engine.route(st.session_state.messages, st.session_state.saved_prompts)
+        st.session_state.route_log.append(
+            {"turn_class": route.turn_class, "tier": route.tier.name, "model": route.model, "reason": route.reason}
+        )
         
-        try:
-            # Initialize Anthropic client
-            client = anthropic.Anthropic(api_key=st.session_state.api_key)
+        # Display assistant typing indicator
+        with st.chat_message("assistant"):
+            message_placeholder = st.empty()
+            message_placeholder.markdown("Thinking...")
+        
+            try:
+                # Reuse the pooled client for this key
+                client = get_client_registry().get(st.session_state.api_key, st.session_state.session_id)
             
-            # Format messages for the API
-            messages = [
-                {"role": m["role"], "content": m["content"]} 
-                for m in st.session_state.messages
-            ]
+                current_hash = prompt_hash(st.session_state.system_prompt)
+                if st.session_state.prompt_caching and st.session_state.cached_prompt_hash not in (None, current_hash):
+                    st.caption("System prompt changed, so this turn writes a fresh cache.")
             
-            # Call the Claude API
-            response = client.messages.create(
-                model="claude-3-7-sonnet-20250219",
-                max_tokens=1024,
-                temperature=0.7,
-                system=st.session_state.system_prompt,
-                messages=messages
-            )
+                # Only the recent window goes out verbatim; older turns travel as a summary
+                history = st.session_state.history
+                window = history.window(st.session_state.messages)
+                previous = st.session_state.messages[-2] if len(st.session_state.messages) > 1 else {}
             
-            # Display Claude's response
-            message_placeholder.markdown(response.content[0].text)
+                def send(request: Dict, kind: str, route: Route) -> tuple:
+                    return call_claude(client, request, message_placeholder, kind, route)
             
-            # Add Claude's response to chat history
-            st.session_state.messages.append(
-                {"role": "assistant", "content": response.content[0].text}
-            )
+                # The engine edits, generates, categorises, screens and banks; this pane streams and shows it
+                turn = engine.chat_turn(
+                    window,
+                    send,
+                    history.summary,
+                    st.session_state.saved_prompts,
+                    previous=previous.get("question_set"),
+                    route=route,
+                    cache=get_response_cache() if st.session_state.use_response_cache else None,
+                    on_status=message_placeholder.markdown,
+                )
+                # Cleared by the engine if the API rejected cache breakpoints
+                st.session_state.prompt_caching = engine.settings.prompt_caching
+                if st.session_state.prompt_caching and not turn.metrics.get("response_cache"):
+                    st.session_state.cached_prompt_hash = current_hash
             
-        except Exception as e:
-            message_placeholder.error(f"Error: {str(e)}")
\ No newline at end of file
+                # Display Claude's response
+                message_placeholder.markdown(turn.text)
+                st.caption(format_metrics(turn.metrics))
+            
+                # Add Claude's response to chat history
+                st.session_state.messages.append(
+                    {"role": "assistant", "content": turn.text, "metrics": turn.metrics, "question_set": turn.question_set}
+                )
+                st.session_state.messages = history.trim(st.session_state.messages)
+            
+            except Exception as e:
+                message_placeholder.error(f"Error: {str(e)}")
+
+
+# Sidebar for configuration
+with st.sidebar:
+    st.header("Configuration")
+    configuration_panel()
+    saved_prompts_panel()
+    
+    # Clear chat button
+    if st.button("Clear Chat"):
+        reset_chat()
+        st.rerun()
+    
+    # Source material for new question sets
+    st.header("Source Document")
+    source_document_panel()
+    
+    # Reference Lists in sidebar
+    st.header("Reference Lists")
+    reference_lists_panel()
+    
+    # Search everything generated so far
+    st.header("Question Bank")
+    question_bank_panel()
+    
+    # Speculative generation of the next question sets
+    st.header("Next Question")
+    prefetch_panel()
+    
+    # Model tier chosen for each turn
+    st.header("Model Routing")
+    routing_panel()
+    
+    # Latency, token rate and spend of recent API calls
+    st.header("Telemetry")
+    telemetry_panel()
+
+# Bulk generation across the reference lists
+bulk_generation_panel()
+
+chat_pane()
+
+# Only the process's first run records its render time, and only if it got this far
+if cold_start["started"] == SCRIPT_STARTED:
+    cold_start["first_render"] = (time.perf_counter() - SCRIPT_STARTED) * 1000
@@ -0,0 +1 @@
+"""Helpers behind the Qgen Streamlit app."""
@@ -0,0 +1,147 @@
+"""Persistent question bank with a full-text index over stems and explanations."""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from qgen.question_set import QuestionSet
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS questions (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    content_hash TEXT NOT NULL UNIQUE,
+    module_id INTEGER,
+    presentation_id INTEGER,
+    condition TEXT,
+    model TEXT,
+    prompt_hash TEXT,
+    source TEXT,
+    stem TEXT NOT NULL,
+    explanations TEXT NOT NULL,
+    body TEXT NOT NULL,
+    record TEXT
+);
+CREATE INDEX IF NOT EXISTS questions_module ON questions (module_id);
+CREATE INDEX IF NOT EXISTS questions_presentation ON questions (presentation_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+    stem, explanations, condition,
+    content='questions', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3 4'
+);
+CREATE TRIGGER IF NOT EXISTS questions_ai AFTER INSERT ON questions BEGIN
+    INSERT INTO questions_fts (rowid, stem, explanations, condition)
+    VALUES (new.id, new.stem, new.explanations, new.condition);
+END;
+CREATE TRIGGER IF NOT EXISTS questions_ad AFTER DELETE ON questions BEGIN
+    INSERT INTO questions_fts (questions_fts, rowid, stem, explanations, condition)
+    VALUES ('delete', old.id, old.stem, old.explanations, old.condition);
+END;
+"""
+
+
+@dataclass
+class BankHit:
+    id: int
+    snippet: str
+    condition: Optional[str]
+    module_id: Optional[int]
+    presentation_id: Optional[int]
+    body: str
+
+
+def match_query(text: str) -> str:
+    """Turn free text into an FTS5 query: every word must match, as a prefix."""
+    words = re.findall(r"\w+", text.lower())
+    return " ".join(f'"{word}"*' for word in words)
+
+
+class QuestionBank:
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def add(
+        self,
+        text: str,
+        question_set: Optional[QuestionSet] = None,
+        condition: Optional[str] = None,
+        model: Optional[str] = None,
+        prompt_hash: Optional[str] = None,
+        source: str = "chat",
+    ) -> Optional[int]:
+        """Store one answer and return its id, or None if the same text is already banked."""
+        content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if question_set is not None:
+            stem = f"{question_set.stem}\n{question_set.lead_in}"
+            explanations = "\n".join(question_set.explanations)
+            condition = condition or question_set.condition
+            module_id, presentation_id = question_set.module_id, question_set.presentation_id
+            record = json.dumps(question_set.to_dict())
+        else:
+            # Free-text answers are indexed whole, since the sections can't be told apart reliably
+            stem, explanations = text, ""
+            module_id = presentation_id = record = None
+        with self._lock:
+            cursor = self._db.execute(
+                """INSERT OR IGNORE INTO questions (
+                    created, content_hash, module_id, presentation_id, condition,
+                    model, prompt_hash, source, stem, explanations, body, record
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    time.time(), content_hash, module_id, presentation_id, condition,
+                    model, prompt_hash, source, stem, explanations, text, record,
+                ),
+            )
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def search(
+        self,
+        query: str,
+        limit: int = 20,
+        module_id: Optional[int] = None,
+        presentation_id: Optional[int] = None,
+    ) -> List[BankHit]:
+        """Best matches first (BM25), optionally narrowed to a module or presentation."""
+        match = match_query(query)
+        if not match:
+            return []
+        sql = """SELECT q.id, snippet(questions_fts, -1, '**', '**', ' … ', 16),
+                        q.condition, q.module_id, q.presentation_id, q.body
+                 FROM questions_fts JOIN questions q ON q.id = questions_fts.rowid
+                 WHERE questions_fts MATCH ?"""
+        params: list = [match]
+        if module_id is not None:
+            sql += " AND q.module_id = ?"
+            params.append(module_id)
+        if presentation_id is not None:
+            sql += " AND q.presentation_id = ?"
+            params.append(presentation_id)
+        sql += " ORDER BY bm25(questions_fts, 2.0, 1.0, 3.0) LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [BankHit(*row) for row in rows]
+
+    def categorisations(self) -> List[Tuple[str, int, int]]:
+        """(condition, module id, presentation id) of every categorised question set."""
+        with self._lock:
+            return self._db.execute(
+                """SELECT condition, module_id, presentation_id FROM questions
+                   WHERE condition IS NOT NULL AND module_id IS NOT NULL AND presentation_id IS NOT NULL"""
+            ).fetchall()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM questions").fetchone()[0]
+
+    def close(self) -> None:
+        self._db.close()
@@ -0,0 +1,335 @@
+"""Headless whole-syllabus generation through the Message Batches API.
+
+Turns a syllabus slice (modules x presentations x conditions, any of which
+may be left out) into batch submissions that use the app's SBA system
+prompt and model settings, then polls until every batch has ended and
+appends each result to ``results.jsonl`` in the work directory.
+
+Batch IDs are checkpointed to ``checkpoint.json`` as soon as they are
+created, so re-running the same command after an interruption picks up the
+existing batches instead of submitting (and paying for) them again.
+
+    python -m qgen.batch_job --workdir runs/cardio --modules 3 --conditions all --count 2
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import anthropic
+
+from qgen.bank import QuestionBank
+from qgen.dedup import StemIndex, stem_of
+from qgen.documents import TOP_K, Document, DocumentStore
+from qgen.payload import MAX_TOKENS, MODEL, TEMPERATURE, build_system, prompt_hash
+from qgen.prompts import SYSTEM_PROMPT
+from qgen.question_set import STRUCTURED_MAX_TOKENS, extract_question_set, tool_options
+from qgen.reference import CONDITION_LIST, MODULE_LIST, PRESENTATION_LIST, parse_entries
+
+# The API accepts up to 100,000 requests per batch; smaller batches end sooner
+DEFAULT_BATCH_SIZE = 5000
+
+
+@dataclass
+class SyllabusJob:
+    module: Optional[Tuple[int, str]]
+    presentation: Optional[Tuple[int, str]]
+    condition: Optional[Tuple[int, str]]
+    number: int
+    count: int
+
+    @property
+    def custom_id(self) -> str:
+        parts = []
+        for prefix, entry in (("m", self.module), ("p", self.presentation), ("c", self.condition)):
+            if entry is not None:
+                parts.append(f"{prefix}{entry[0]}")
+        parts.append(f"n{self.number}")
+        return "-".join(parts)
+
+    @property
+    def prompt(self) -> str:
+        if self.condition is not None:
+            text = f"Generate a question set on the condition \"{self.condition[1]}\""
+            if self.presentation is not None:
+                text += f" presenting as \"{self.presentation[1]}\""
+        elif self.presentation is not None:
+            text = f"Generate a question set on the presentation \"{self.presentation[1]}\""
+        else:
+            text = "Generate a question set"
+        if self.module is not None:
+            text += f" for the \"{self.module[1]}\" module"
+        text += "."
+        if self.count > 1:
+            text += (
+                f" This is question set {self.number} of {self.count} on this topic;"
+                " use a different clinical scenario and question stem from the others."
+            )
+        return text
+
+    def to_dict(self) -> Dict:
+        return {
+            "custom_id": self.custom_id,
+            "module": self.module[1] if self.module else None,
+            "presentation": self.presentation[1] if self.presentation else None,
+            "condition": self.condition[1] if self.condition else None,
+        }
+
+
+def select_entries(text: str, selection: Optional[str]) -> List[Optional[Tuple[int, str]]]:
+    """Pick list entries by number ("1,4,9-12"), "all", or nothing (dimension left out)."""
+    if not selection:
+        return [None]
+    entries = parse_entries(text)
+    if selection == "all":
+        return list(entries)
+    wanted = set()
+    for part in selection.split(","):
+        low, _, high = part.strip().partition("-")
+        wanted.update(range(int(low), int(high or low) + 1))
+    chosen = [entry for entry in entries if entry[0] in wanted]
+    missing = wanted - {entry[0] for entry in chosen}
+    if missing:
+        raise ValueError(f"No such list entries: {sorted(missing)}")
+    return chosen
+
+
+def syllabus_jobs(
+    modules: Optional[str] = None,
+    presentations: Optional[str] = None,
+    conditions: Optional[str] = None,
+    count: int = 1,
+) -> List[SyllabusJob]:
+    product = itertools.product(
+        select_entries(MODULE_LIST, modules),
+        select_entries(PRESENTATION_LIST, presentations),
+        select_entries(CONDITION_LIST, conditions),
+    )
+    return [
+        SyllabusJob(module, presentation, condition, number, count)
+        for module, presentation, condition in product
+        for number in range(1, count + 1)
+    ]
+
+
+class BatchRunner:
+    """Submits, polls and ingests Message Batches, checkpointing to ``workdir``."""
+
+    def __init__(
+        self,
+        client: anthropic.Anthropic,
+        workdir: Path,
+        system_prompt: str = SYSTEM_PROMPT,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        structured: bool = False,
+        bank: Optional[QuestionBank] = None,
+        stems: Optional[StemIndex] = None,
+        document: Optional[Document] = None,
+        top_k: int = TOP_K,
+        poll_initial: float = 30.0,
+        poll_max: float = 600.0,
+        sleep: Callable[[float], None] = time.sleep,
+        log: Callable[[str], None] = print,
+    ):
+        self.client = client
+        self.workdir = Path(workdir)
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        self.system_prompt = system_prompt
+        self.batch_size = batch_size
+        self.structured = structured
+        self.bank = bank
+        self.stems = stems
+        self.document = document
+        self.top_k = top_k
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+        self.sleep = sleep
+        self.log = log
+        self.checkpoint_path = self.workdir / "checkpoint.json"
+        self.results_path = self.workdir / "results.jsonl"
+        self.state = self._load()
+
+    def content(self, job: SyllabusJob) -> str:
+        """The user message for a job, led by the source passages on its syllabus entries."""
+        if self.document is None:
+            return job.prompt
+        query = " ".join(entry[1] for entry in (job.condition, job.presentation, job.module) if entry is not None)
+        sources = self.document.context(query, self.top_k)
+        return f"{sources}\n\n{job.prompt}" if sources else job.prompt
+
+    def run(self, jobs: List[SyllabusJob]) -> None:
+        self.submit(jobs)
+        self.wait()
+
+    def submit(self, jobs: Iterable[SyllabusJob]) -> None:
+        submitted = set(self.state["jobs"])
+        pending = [job for job in jobs if job.custom_id not in submitted]
+        if not pending:
+            return
+        params = {
+            "model": MODEL,
+            "max_tokens": MAX_TOKENS,
+            "temperature": TEMPERATURE,
+            "system": build_system(self.system_prompt),
+        }
+        if self.structured:
+            params.update(max_tokens=STRUCTURED_MAX_TOKENS, **tool_options())
+        for start in range(0, len(pending), self.batch_size):
+            chunk = pending[start:start + self.batch_size]
+            batch = self.client.messages.batches.create(requests=[
+                {
+                    "custom_id": job.custom_id,
+                    "params": dict(params, messages=[{"role": "user", "content": self.content(job)}]),
+                }
+                for job in chunk
+            ])
+            self.state["batches"].append({"id": batch.id, "ingested": False})
+            self.state["jobs"].update({job.custom_id: job.to_dict() for job in chunk})
+            self._save()
+            self.log(f"Submitted batch {batch.id} with {len(chunk)} requests")
+
+    def wait(self) -> None:
+        """Poll unfinished batches with jittered exponential backoff until all are ingested."""
+        delay = self.poll_initial
+        while True:
+            open_batches = [b for b in self.state["batches"] if not b["ingested"]]
+            if not open_batches:
+                return
+            progressed = False
+            for entry in open_batches:
+                batch = self.client.messages.batches.retrieve(entry["id"])
+                if batch.processing_status != "ended":
+                    counts = batch.request_counts
+                    self.log(f"Batch {batch.id}: {counts.processing} processing, {counts.succeeded} succeeded")
+                    continue
+                self.ingest(entry)
+                progressed = True
+            if progressed:
+                delay = self.poll_initial
+                continue
+            self.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, self.poll_max)
+
+    def ingest(self, entry: Dict) -> None:
+        """Append a finished batch's results to the store, skipping any already written."""
+        seen = self._ingested_ids()
+        written = 0
+        with open(self.results_path, "a", encoding="utf-8") as out:
+            for item in self.client.messages.batches.results(entry["id"]):
+                if item.custom_id in seen:
+                    continue
+                record = dict(self.state["jobs"].get(item.custom_id, {"custom_id": item.custom_id}))
+                record.update(batch_id=entry["id"], status=item.result.type, model=MODEL)
+                if item.result.type == "succeeded":
+                    message = item.result.message
+                    record["text"] = "".join(b.text for b in message.content if b.type == "text")
+                    record["stop_reason"] = message.stop_reason
+                    record["usage"] = message.usage.model_dump()
+                    question_set = None
+                    if self.structured:
+                        try:
+                            question_set = extract_question_set(message)
+                            if question_set is None:
+                                raise ValueError(f"no question set returned (stop reason: {message.stop_reason})")
+                            record["question_set"] = question_set.to_dict()
+                            record["text"] = question_set.to_markdown()
+                        except ValueError as e:
+                            record.update(status="invalid", error=str(e))
+                    if self.stems is not None and record["status"] == "succeeded":
+                        stem = question_set.stem if question_set is not None else stem_of(record["text"])
+                        duplicates = self.stems.check_and_add(stem, item.custom_id)
+                        if duplicates:
+                            record["duplicate_of"] = duplicates[0]
+                    if self.bank is not None and record["status"] == "succeeded":
+                        self.bank.add(
+                            record["text"],
+                            question_set,
+                            condition=record.get("condition"),
+                            model=MODEL,
+                            prompt_hash=prompt_hash(self.system_prompt),
+                            source="batch",
+                        )
+                elif item.result.type == "errored":
+                    record["error"] = str(item.result.error)
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+                written += 1
+        entry["ingested"] = True
+        self._save()
+        self.log(f"Batch {entry['id']} ended; stored {written} results")
+
+    def _ingested_ids(self) -> set:
+        if not self.results_path.exists():
+            return set()
+        with open(self.results_path, encoding="utf-8") as f:
+            return {json.loads(line)["custom_id"] for line in f if line.strip()}
+
+    def _load(self) -> Dict:
+        if self.checkpoint_path.exists():
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                return json.load(f)
+        return {"batches": [], "jobs": {}}
+
+    def _save(self) -> None:
+        tmp = self.checkpoint_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.checkpoint_path)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workdir", required=True, help="Directory for the checkpoint and results.jsonl")
+    parser.add_argument("--modules", help='Module numbers, e.g. "3,9" or "all"')
+    parser.add_argument("--presentations", help='Presentation numbers, e.g. "35,41-44" or "all"')
+    parser.add_argument("--conditions", help='Condition numbers, e.g. "11" or "all"')
+    parser.add_argument("--count", type=int, default=1, help="Question sets per slice entry")
+    parser.add_argument("--system-prompt-file", help="Use these instructions instead of the default SBA prompt")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--structured", action="store_true", help="Return typed question-set records via the tool schema")
+    parser.add_argument("--poll-initial", type=float, default=30.0, help="First poll delay in seconds")
+    parser.add_argument("--poll-max", type=float, default=600.0, help="Longest poll delay in seconds")
+    parser.add_argument("--bank", help="Also add results to the question bank at this SQLite path")
+    parser.add_argument("--stem-index", help="Flag near-duplicate stems against the index at this path, and extend it")
+    parser.add_argument("--document", help="Source document (PDF, markdown or text) to send relevant passages from")
+    parser.add_argument("--top-k", type=int, default=TOP_K, help="Source passages sent with each request")
+    parser.add_argument("--base-url", help="Point at a different Messages API, e.g. a local stand-in")
+    args = parser.parse_args(argv)
+
+    system_prompt = SYSTEM_PROMPT
+    if args.system_prompt_file:
+        system_prompt = Path(args.system_prompt_file).read_text(encoding="utf-8")
+
+    document = None
+    if args.document:
+        path = Path(args.document)
+        document = DocumentStore(Path(args.workdir) / "documents").load(path.name, path.read_bytes())
+
+    jobs = syllabus_jobs(args.modules, args.presentations, args.conditions, args.count)
+    client = anthropic.Anthropic(base_url=args.base_url)
+    runner = BatchRunner(
+        client,
+        Path(args.workdir),
+        system_prompt=system_prompt,
+        batch_size=args.batch_size,
+        structured=args.structured,
+        bank=QuestionBank(args.bank) if args.bank else None,
+        stems=StemIndex(args.stem_index) if args.stem_index else None,
+        document=document,
+        top_k=args.top_k,
+        poll_initial=args.poll_initial,
+        poll_max=args.poll_max,
+    )
+    runner.log(f"{len(jobs)} question sets in this slice")
+    runner.run(jobs)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
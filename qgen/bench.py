@@ -0,0 +1,472 @@
+"""Performance benchmarks, run against the local fake Messages API.
+
+Measures the cold start of ``app.py`` in a fresh process (imports and first
+render), how long a Streamlit rerun takes as the chat history
+grows, time to first token and end-to-end latency of chat turns (through
+the app and through the SDK alone), and the throughput of the bulk engine
+and the HTTP service. Every result is written as one JSON object per line,
+and a run can be checked against an earlier one:
+
+    python -m qgen.bench
+    python -m qgen.bench --only latency bulk --latency 0.3 --tokens-per-second 80 --error-rate 0.05
+    python -m qgen.bench --baseline main_bench.txt --tolerance 0.25
+
+With ``--baseline``, the exit status is 1 when any timing got slower, or any
+rate lower, by more than the tolerance.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from importlib.metadata import version
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+import anthropic
+import numpy as np
+
+from qgen.categorise import Categoriser
+from qgen.engine import Engine, Settings
+from qgen.fake_api import FakeConfig, FakeMessagesAPI, tool_input
+from qgen.question_set import QUESTION_SET_TOOL, QuestionSet
+from qgen.reference import CONDITIONS
+from qgen.scheduler import KeyLimiter
+from qgen.server import GenerationServer
+
+BENCHMARKS = ("coldstart", "rerun", "latency", "bulk", "service")
+
+DEFAULT_APP = Path(__file__).resolve().parent.parent / "app.py"
+
+# Fields that say which measurement a result is, as opposed to what was measured
+IDENTITY = ("benchmark", "messages", "mode", "jobs", "concurrency", "requests", "module")
+
+
+def percentiles(values: Iterable[float], prefix: str, scale: float = 1000.0) -> Dict[str, Optional[float]]:
+    """p50, p95 and mean of ``values`` (seconds), in milliseconds by default."""
+    values = list(values)
+    if not values:
+        return {f"{prefix}_p50_ms": None, f"{prefix}_p95_ms": None, f"{prefix}_mean_ms": None}
+    return {
+        f"{prefix}_p50_ms": round(float(np.percentile(values, 50)) * scale, 2),
+        f"{prefix}_p95_ms": round(float(np.percentile(values, 95)) * scale, 2),
+        f"{prefix}_mean_ms": round(float(np.mean(values)) * scale, 2),
+    }
+
+
+def fast_limiter() -> KeyLimiter:
+    """A limiter that never holds calls back, only retries injected failures quickly."""
+    return KeyLimiter(requests_per_minute=1e9, tokens_per_minute=1e12, max_retries=4, backoff_base=0.01)
+
+
+def synthetic_history(size: int, seed: int = 0) -> List[Dict]:
+    """``size`` chat messages shaped like a writer's session: prompts and structured answers."""
+    rng = random.Random(seed)
+    names = CONDITIONS.names
+    messages = []
+    for i in range(size):
+        if i % 2 == 0:
+            messages.append({"role": "user", "content": f"Generate a question set on {rng.choice(names)}"})
+            continue
+        question_set = QuestionSet.from_dict(tool_input(QUESTION_SET_TOOL, 700, rng))
+        metrics = {
+            "time_to_first_token": 0.8,
+            "total_latency": 9.5,
+            "input_tokens": 400,
+            "output_tokens": 700,
+            "cache_read_input_tokens": 2000,
+            "cache_creation_input_tokens": 0,
+        }
+        messages.append({
+            "role": "assistant",
+            "content": question_set.to_markdown(),
+            "metrics": metrics,
+            "question_set": question_set,
+        })
+    return messages
+
+
+# Run in a fresh interpreter under -X importtime: first and second render of the app, as a new container sees them
+COLD_START = """
+import json, sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+streamlit_done = time.perf_counter()
+print("-- app --", file=sys.stderr, flush=True)
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+at.secrets["QGEN_DATA_DIR"] = sys.argv[2]
+at.run()
+first_done = time.perf_counter()
+at.run()
+print(json.dumps({
+    "streamlit_import": streamlit_done - started,
+    "first_render": first_done - streamlit_done,
+    "warm_render": time.perf_counter() - first_done,
+    "sdk_loaded": "anthropic" in sys.modules,
+    "error": str(at.exception[0].value) if at.exception else None,
+}))
+"""
+
+
+def import_times(report: str) -> Dict[str, float]:
+    """Cumulative seconds per top-level import in ``-X importtime`` output after the app marker."""
+    times = {}
+    _, _, report = report.partition("-- app --")
+    for line in report.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        # Nested imports are indented under the one that pulled them in
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def bench_coldstart(app: Path, runs: int, log: Callable[[str], None], top: int = 5) -> List[Dict]:
+    """Imports, first render and second render of the app in ``runs`` fresh processes (medians).
+
+    ``app_import`` counts what the script imports beyond Streamlit itself,
+    which a deployed server has already loaded before the first page view.
+    The slowest of those imports get a result each, so a new heavy dependency
+    on the first-render path shows up as its own regression.
+    """
+    samples, imports = [], []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as data_dir:
+            process = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", COLD_START, str(app), data_dir],
+                capture_output=True, text=True, check=True,
+            )
+        samples.append(json.loads(process.stdout.strip().splitlines()[-1]))
+        imports.append(import_times(process.stderr))
+
+    def median_ms(values: Iterable[float]) -> float:
+        return round(statistics.median(values) * 1000, 2)
+
+    result = {
+        "benchmark": "coldstart",
+        "runs": runs,
+        "streamlit_import_ms": median_ms(sample["streamlit_import"] for sample in samples),
+        "app_import_ms": median_ms(sum(times.values()) for times in imports),
+        "first_render_ms": median_ms(sample["first_render"] for sample in samples),
+        "warm_render_ms": median_ms(sample["warm_render"] for sample in samples),
+        "sdk_loaded": any(sample["sdk_loaded"] for sample in samples),
+        "error": next((sample["error"] for sample in samples if sample["error"]), None),
+    }
+    log(
+        f"coldstart    first render {result['first_render_ms']:>8.1f} ms  imports {result['app_import_ms']:>8.1f} ms"
+        f"  warm {result['warm_render_ms']:>6.1f} ms  SDK {'loaded' if result['sdk_loaded'] else 'not loaded'}"
+    )
+    results = [result]
+    names = sorted(imports[0], key=lambda name: statistics.median(times.get(name, 0) for times in imports))
+    for name in reversed(names[-top:]):
+        results.append({
+            "benchmark": "coldstart_import",
+            "module": name,
+            "import_ms": median_ms(times.get(name, 0) for times in imports),
+        })
+        log(f"coldstart    import {name:<30} {results[-1]['import_ms']:>8.1f} ms")
+    return results
+
+
+def bench_rerun(
+    api: FakeMessagesAPI, app: Path, sizes: List[int], runs: int, turns: int, log: Callable[[str], None]
+) -> List[Dict]:
+    """Rerun time of the whole app at each history size, then a few chat turns on top of it."""
+    from streamlit.testing.v1 import AppTest
+
+    results = []
+    # Cached resources outlive each AppTest, so every size shares one data directory
+    with tempfile.TemporaryDirectory() as data_dir:
+        for size in sizes:
+            at = AppTest.from_file(str(app), default_timeout=120)
+            at.secrets["ANTHROPIC_BASE_URL"] = api.base_url
+            at.secrets["QGEN_DATA_DIR"] = data_dir
+            at.session_state["api_key"] = "sk-bench"
+            # Every turn should reach the API, not the response cache
+            at.session_state["use_response_cache"] = False
+            started = time.perf_counter()
+            at.run()
+            first = time.perf_counter() - started
+            at.session_state["messages"] = synthetic_history(size)
+            times = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                at.run()
+                times.append(time.perf_counter() - started)
+            result = {"benchmark": "rerun", "messages": size, "runs": runs, "first_run_ms": round(first * 1000, 2)}
+            result.update(percentiles(times, "rerun"))
+            result["error"] = str(at.exception[0].value) if at.exception else None
+            results.append(result)
+            log(f"rerun        {size:>4} messages  p50 {result['rerun_p50_ms']:>8.1f} ms")
+            if at.exception:
+                log(f"rerun        {size:>4} messages  failed: {result['error']}")
+                continue
+
+            ttft, e2e, rerun, failures = [], [], [], 0
+            for condition in conditions(turns):
+                at.chat_input[0].set_value(f"Generate a question set on {condition}")
+                started = time.perf_counter()
+                at.run()
+                rerun.append(time.perf_counter() - started)
+                metrics = at.session_state["messages"][-1].get("metrics") if at.session_state["messages"] else None
+                if at.exception or at.error or not metrics:
+                    failures += 1
+                    continue
+                ttft.append(metrics["time_to_first_token"])
+                e2e.append(metrics["total_latency"])
+            result = {"benchmark": "chat_turn", "messages": size, "turns": turns, "failed": failures}
+            result.update(percentiles(ttft, "ttft"))
+            result.update(percentiles(e2e, "e2e"))
+            result.update(percentiles(rerun, "rerun"))
+            results.append(result)
+            log(f"chat turn    {size:>4} messages  ttft p50 {result['ttft_p50_ms'] or 0:>8.1f} ms")
+        return results
+
+
+def bench_latency(api: FakeMessagesAPI, requests: int, log: Callable[[str], None]) -> List[Dict]:
+    """Time to first token and end-to-end latency through the SDK, streamed and not."""
+    client = anthropic.Anthropic(api_key="sk-bench", base_url=api.base_url, max_retries=0)
+    results = []
+    for structured in (True, False):
+        engine = Engine(Settings(structured=structured), categoriser=Categoriser())
+        for stream in (True, False):
+            mode = f"{'stream' if stream else 'blocking'}-{'structured' if structured else 'text'}"
+            ttft, e2e, failures = [], [], 0
+            for condition in conditions(requests):
+                turns = [{"role": "user", "content": f"Generate a question set on {condition}"}]
+                request = engine.chat_request(turns)
+                started = time.perf_counter()
+                try:
+                    if stream:
+                        first = None
+                        with client.messages.stream(**request) as events:
+                            for event in events:
+                                if first is None and event.type in ("text", "input_json"):
+                                    first = time.perf_counter() - started
+                            events.get_final_message()
+                        ttft.append(first)
+                    else:
+                        client.messages.create(**request)
+                except anthropic.APIStatusError:
+                    failures += 1
+                    continue
+                e2e.append(time.perf_counter() - started)
+            result = {"benchmark": "latency", "mode": mode, "requests": requests, "failed": failures}
+            if stream:
+                result.update(percentiles(ttft, "ttft"))
+            result.update(percentiles(e2e, "e2e"))
+            results.append(result)
+            log(f"latency      {mode:<20} e2e p50 {result['e2e_p50_ms'] or 0:>8.1f} ms")
+    client.close()
+    return results
+
+
+def conditions(count: int) -> List[str]:
+    names = CONDITIONS.names
+    return [names[i % len(names)] for i in range(count)]
+
+
+def throughput(benchmark: str, jobs: int, concurrency: int, elapsed: float, completed: List[tuple]) -> Dict:
+    """Rates and latency percentiles from the (latency, output tokens) of every completed job."""
+    result = {
+        "benchmark": benchmark,
+        "jobs": jobs,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "completed": len(completed),
+        "failed": jobs - len(completed),
+        "sets_per_minute": round(len(completed) / elapsed * 60, 1),
+        "output_tokens_per_second": round(sum(tokens for _, tokens in completed) / elapsed, 1),
+    }
+    result.update(percentiles([latency for latency, _ in completed], "latency"))
+    return result
+
+
+def bench_engine(api: FakeMessagesAPI, jobs: int, concurrency: int) -> Dict:
+    """``Engine.generate_bulk``, the path the app's bulk panel takes."""
+    engine = Engine(Settings(duplicate_stems="Off"), categoriser=Categoriser())
+    client = anthropic.AsyncAnthropic(api_key="sk-bench", base_url=api.base_url, max_retries=0)
+    batch = engine.jobs("condition", conditions(jobs), 1)
+    started = time.perf_counter()
+    results = engine.generate_bulk(client, batch, concurrency, limiter=fast_limiter())
+    elapsed = time.perf_counter() - started
+    completed = [(r.latency, r.usage.get("output_tokens", 0)) for r in results if not r.error]
+    return throughput("bulk", jobs, concurrency, elapsed, completed)
+
+
+def bench_service(api: FakeMessagesAPI, jobs: int, concurrency: int, per_request: int = 5) -> Dict:
+    """POST /generate to an in-process ``GenerationServer``, ``concurrency`` requests at a time.
+
+    Each request carries ``per_request`` conditions, and the server gets
+    ``concurrency`` workers.
+    """
+    engine = Engine(Settings(duplicate_stems="Off"), categoriser=Categoriser())
+    names = conditions(jobs)
+    bodies = [
+        json.dumps({"items": names[start:start + per_request]}).encode("utf-8")
+        for start in range(0, len(names), per_request)
+    ]
+
+    async def post(port: int, body: bytes) -> Dict:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(
+            b"POST /generate HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n"
+            b"Content-Type: application/json\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        )
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        return json.loads(response.partition(b"\r\n\r\n")[2])
+
+    async def main() -> tuple:
+        client = anthropic.AsyncAnthropic(api_key="sk-bench", base_url=api.base_url, max_retries=0)
+        service = GenerationServer(engine, client, fast_limiter(), workers=concurrency, max_pending=jobs)
+        server = await asyncio.start_server(service.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        callers = asyncio.Semaphore(concurrency)
+
+        async def call(body: bytes) -> Dict:
+            async with callers:
+                return await post(port, body)
+
+        async with client, server:
+            started = time.perf_counter()
+            responses = await asyncio.gather(*(call(body) for body in bodies))
+            return responses, time.perf_counter() - started
+
+    responses, elapsed = asyncio.run(main())
+    completed = [
+        (result["latency"], result["usage"].get("output_tokens", 0))
+        for response in responses
+        for result in response.get("results", [])
+        if not result["error"]
+    ]
+    return throughput("service", jobs, concurrency, elapsed, completed)
+
+
+def bench_bulk(
+    api: FakeMessagesAPI, jobs: int, concurrencies: List[int], service: bool, log: Callable[[str], None]
+) -> List[Dict]:
+    results = []
+    for concurrency in concurrencies:
+        result = bench_service(api, jobs, concurrency) if service else bench_engine(api, jobs, concurrency)
+        results.append(result)
+        log(
+            f"{result['benchmark']:<12} {jobs} jobs x{concurrency:<3} {result['sets_per_minute']:>8.1f} sets/min"
+            f"  {result['failed']} failed"
+        )
+    return results
+
+
+def compare(current: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    """Regressions past ``tolerance`` between two runs, matched on their identity fields.
+
+    Timings (``*_ms``) regress when they grow; rates (``*_per_minute``,
+    ``*_per_second``) when they fall.
+    """
+
+    def identity(result: Dict) -> tuple:
+        return tuple(result.get(field) for field in IDENTITY)
+
+    earlier = {identity(result): result for result in baseline}
+    regressions = []
+    for result in current:
+        before = earlier.get(identity(result))
+        if before is None:
+            continue
+        name = " ".join(str(value) for value in identity(result) if value is not None)
+        for metric, value in result.items():
+            old = before.get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            if metric.endswith("_ms") and value > old * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {old} -> {value} ms")
+            elif metric.endswith(("_per_minute", "_per_second")) and value < old * (1 - tolerance):
+                regressions.append(f"{name}: {metric} {old} -> {value}")
+    return regressions
+
+
+def read_results(path: Path) -> List[Dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="Run just these benchmarks")
+    parser.add_argument("--output", default="bench_output.txt", help="Where to write the JSON-lines results")
+    parser.add_argument("--baseline", help="Earlier results to check this run against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Slowdown allowed before it counts, e.g. 0.25")
+    parser.add_argument("--app", default=str(DEFAULT_APP), help="The Streamlit script to rerun")
+    parser.add_argument("--history", type=int, nargs="+", default=[0, 20, 100, 200], help="Chat history sizes")
+    parser.add_argument("--runs", type=int, default=5, help="Reruns timed at each history size")
+    parser.add_argument("--cold-starts", type=int, default=5, help="Fresh processes for the cold-start timings")
+    parser.add_argument("--turns", type=int, default=3, help="Chat turns timed at each history size")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per latency mode")
+    parser.add_argument("--jobs", type=int, default=100, help="Question sets per throughput run")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--latency", type=float, default=0.2, help="Fake API seconds to first byte")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--tokens-per-second", type=float, default=400.0, help="Fake API output rate")
+    parser.add_argument("--output-tokens", type=int, default=700)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=529)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    config = FakeConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second,
+        output_tokens=args.output_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        seed=args.seed,
+    )
+    results = [{
+        "benchmark": "environment",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "streamlit": version("streamlit"),
+        "anthropic": version("anthropic"),
+        "fake_api": vars(config),
+    }]
+    selected = args.only or BENCHMARKS
+    with FakeMessagesAPI(config) as api:
+        if "coldstart" in selected:
+            results += bench_coldstart(Path(args.app), args.cold_starts, print)
+        if "rerun" in selected:
+            results += bench_rerun(api, Path(args.app), args.history, args.runs, args.turns, print)
+        if "latency" in selected:
+            results += bench_latency(api, args.requests, print)
+        if "bulk" in selected:
+            results += bench_bulk(api, args.jobs, args.concurrency, False, print)
+        if "service" in selected:
+            results += bench_bulk(api, args.jobs, args.concurrency, True, print)
+        results[0]["fake_api_requests"] = api.stats.requests
+        results[0]["fake_api_errors"] = api.stats.errors
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, read_results(Path(args.baseline)), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+        print(f"No regressions past {args.tolerance:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""Concurrent bulk question generation over the condition or presentation lists."""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import anthropic
+
+from qgen.categorise import Categoriser, fallback_request
+from qgen.continuation import complete_async
+from qgen.payload import MAX_TOKENS, MODEL, TEMPERATURE, usage_metrics
+from qgen.question_set import QuestionSet, extract_question_set
+from qgen.refine import apply_revision
+from qgen.scheduler import BULK, KeyLimiter
+from qgen.telemetry import OnCall, reported, reported_async
+
+
+@dataclass
+class BulkJob:
+    kind: str
+    item: str
+    number: int
+    count: int
+    # Extra instruction appended to the prompt, e.g. when regenerating a duplicate
+    note: str = ""
+    # Passages from an uploaded source document, sent ahead of the prompt
+    sources: str = ""
+
+    @property
+    def prompt(self) -> str:
+        text = f"Generate a question set on the {self.kind} \"{self.item}\"."
+        if self.count > 1:
+            text += (
+                f" This is question set {self.number} of {self.count} on this {self.kind};"
+                " use a different clinical scenario and question stem from the others."
+            )
+        if self.note:
+            text += f" {self.note}"
+        return text
+
+    @property
+    def content(self) -> str:
+        """The user message sent for this job: any source passages, then the prompt."""
+        return f"{self.sources}\n\n{self.prompt}" if self.sources else self.prompt
+
+
+@dataclass
+class BulkResult:
+    job: BulkJob
+    text: str = ""
+    error: Optional[str] = None
+    latency: float = 0.0
+    usage: Dict[str, int] = field(default_factory=dict)
+    stop_reason: Optional[str] = None
+    question_set: Optional[QuestionSet] = None
+    # (label, similarity) of the closest earlier stem, if this one is a near-duplicate
+    duplicate_of: Optional[Tuple[str, float]] = None
+
+
+@dataclass
+class BulkStats:
+    total: int
+    completed: int = 0
+    failed: int = 0
+    output_tokens: int = 0
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    @property
+    def per_minute(self) -> float:
+        return self.completed / self.elapsed * 60 if self.elapsed else 0.0
+
+    @property
+    def done(self) -> int:
+        return self.completed + self.failed
+
+
+def make_jobs(kind: str, items: List[str], count: int) -> List[BulkJob]:
+    return [
+        BulkJob(kind=kind, item=item, number=number, count=count)
+        for item in items
+        for number in range(1, count + 1)
+    ]
+
+
+def job_result(
+    job: BulkJob,
+    response,
+    request: Dict,
+    started: float,
+    categoriser: Optional[Categoriser] = None,
+) -> BulkResult:
+    """Turn a finished response into a result, checking for the question set if one was asked for.
+
+    With a ``categoriser``, a question set that came without module and
+    presentation ids gets them assigned locally. Where the tool was only
+    offered, not forced, a text answer is kept as it is.
+    """
+    question_set = None
+    if "tools" in request:
+        question_set = extract_question_set(response, categoriser.fill if categoriser is not None else None)
+        if question_set is None and request["tool_choice"]["type"] == "tool":
+            raise ValueError(f"no question set returned (stop reason: {response.stop_reason})")
+    if question_set is None:
+        text = "".join(block.text for block in response.content if block.type == "text")
+    else:
+        text = question_set.to_markdown()
+    return BulkResult(
+        job,
+        text=text,
+        latency=time.perf_counter() - started,
+        usage=usage_metrics(response.usage),
+        stop_reason=response.stop_reason,
+        question_set=question_set,
+    )
+
+
+def categorisation_request(
+    result: BulkResult, request: Dict, system, categoriser: Optional[Categoriser]
+) -> Optional[Dict]:
+    """The request asking Claude to categorise a result, if the local categoriser was unsure of it."""
+    if categoriser is None or result.question_set is None or not categoriser.unsure(result.question_set.to_dict()):
+        return None
+    return fallback_request(
+        result.question_set, model=request["model"], temperature=request["temperature"], system=system
+    )
+
+
+def apply_categorisation(result: BulkResult, response, categoriser: Categoriser) -> None:
+    """Patch Claude's categorisation into a result and remember it for the condition."""
+    result.question_set = apply_revision(result.question_set, "categorisation", response)
+    result.text = result.question_set.to_markdown()
+    for name, value in usage_metrics(response.usage).items():
+        result.usage[name] = result.usage.get(name, 0) + value
+    question_set = result.question_set
+    categoriser.learn(question_set.condition, question_set.module_id, question_set.presentation_id)
+
+
+async def _generate(
+    send: Callable[[Dict], Awaitable],
+    job: BulkJob,
+    system,
+    request: Dict,
+    categoriser: Optional[Categoriser],
+) -> BulkResult:
+    """The pipeline behind ``generate_one`` and ``generate_one_sync``; ``send`` makes one API call."""
+    started = time.perf_counter()
+    params = dict(system=system, messages=[{"role": "user", "content": job.content}], **request)
+    try:
+        # A truncated answer is picked up where it stopped rather than failed
+        response = await complete_async(lambda params, base: send(params), params)
+        result = job_result(job, response, request, started, categoriser)
+        # Only a question set the local categoriser is unsure of is sent to Claude to categorise
+        fallback = categorisation_request(result, request, system, categoriser)
+        if fallback is not None:
+            apply_categorisation(result, await send(fallback), categoriser)
+            result.latency = time.perf_counter() - started
+        return result
+    except Exception as e:
+        return BulkResult(job, error=f"{type(e).__name__}: {e}", latency=time.perf_counter() - started)
+
+
+async def generate_one(
+    client: "anthropic.AsyncAnthropic",
+    job: BulkJob,
+    system,
+    request: Dict,
+    limiter: Optional[KeyLimiter] = None,
+    categoriser: Optional[Categoriser] = None,
+    on_call: Optional[OnCall] = None,
+) -> BulkResult:
+    """Generate one job; with a ``limiter`` its calls wait in the bulk lane.
+
+    ``on_call`` is told about every attempt, retries and continuations included.
+    """
+    def create(params: Dict):
+        return client.messages.create(**params)
+
+    if on_call is not None:
+        create = reported_async(create, on_call)
+
+    async def send(params: Dict):
+        if limiter is None:
+            return await create(params)
+        return await limiter.call_async(lambda: create(params), params, BULK)
+
+    return await _generate(send, job, system, request, categoriser)
+
+
+def generate_one_sync(
+    client: "anthropic.Anthropic",
+    job: BulkJob,
+    system,
+    request: Dict,
+    limiter: Optional[KeyLimiter] = None,
+    categoriser: Optional[Categoriser] = None,
+    on_call: Optional[OnCall] = None,
+) -> BulkResult:
+    """``generate_one`` for worker threads outside an event loop.
+
+    The same pipeline runs on a private event loop, with each call made by
+    the blocking client.
+    """
+    def create(params: Dict):
+        return client.messages.create(**params)
+
+    if on_call is not None:
+        create = reported(create, on_call)
+
+    async def send(params: Dict):
+        if limiter is None:
+            return create(params)
+        return limiter.call(lambda: create(params), params, BULK)
+
+    return asyncio.run(_generate(send, job, system, request, categoriser))
+
+
+async def run_bulk(
+    client: "anthropic.AsyncAnthropic",
+    jobs: List[BulkJob],
+    system,
+    concurrency: int = 8,
+    on_result: Optional[Callable[[BulkResult, BulkStats], None]] = None,
+    request: Optional[Dict] = None,
+    limiter: Optional[KeyLimiter] = None,
+    categoriser: Optional[Categoriser] = None,
+    semaphore: Optional[asyncio.Semaphore] = None,
+    on_call: Optional[OnCall] = None,
+) -> List[BulkResult]:
+    """Fan the jobs out with at most ``concurrency`` requests in flight.
+
+    Every job shares the same ``system`` blocks (see ``build_system``), so
+    with caching on, the instructions are read from the prompt cache after
+    the first response. ``request`` holds the model settings, and the
+    question-set tool if answers should come through it. ``on_result``
+    is called on the event loop thread as each job finishes.
+    With a ``limiter``, jobs run in its bulk lane, behind any chat turns on
+    the same key, and transient failures are retried. With a
+    ``categoriser``, question sets that come back without module and
+    presentation ids are categorised locally, and by Claude only when it is
+    unsure. Passing a ``semaphore`` shares one concurrency limit between
+    several runs, in place of ``concurrency``. ``on_call`` is told about
+    every API call attempt, for telemetry.
+    """
+    if request is None:
+        request = dict(model=MODEL, max_tokens=MAX_TOKENS, temperature=TEMPERATURE)
+    semaphore = semaphore or asyncio.Semaphore(concurrency)
+    stats = BulkStats(total=len(jobs))
+
+    async def worker(job: BulkJob) -> BulkResult:
+        async with semaphore:
+            result = await generate_one(client, job, system, request, limiter, categoriser, on_call)
+        if result.error:
+            stats.failed += 1
+        else:
+            stats.completed += 1
+            stats.output_tokens += result.usage.get("output_tokens", 0)
+        if on_result is not None:
+            on_result(result, stats)
+        return result
+
+    return await asyncio.gather(*(worker(job) for job in jobs))
+
+
+def results_markdown(results: List[BulkResult]) -> str:
+    sections = []
+    for result in results:
+        if result.error:
+            continue
+        heading = f"## {result.job.item} ({result.job.number}/{result.job.count})"
+        if result.duplicate_of:
+            label, similarity = result.duplicate_of
+            heading += f"\n\n_Stem {similarity:.0%} similar to {label}_"
+        sections.append(f"{heading}\n\n{result.text}")
+    return "\n\n---\n\n".join(sections)
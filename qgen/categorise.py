@@ -0,0 +1,189 @@
+"""Local UKMLA module and presentation categorisation, with Claude as the fallback."""
+import re
+import threading
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from qgen.reference import CONDITIONS, MODULES, PRESENTATIONS, ReferenceIndex
+from qgen.refine import build_request as build_revision
+
+CATEGORISE_INSTRUCTION = "choose the UKMLA module and presentation this question set fits best."
+
+# Words that describe each module's territory, since most module names are a word or two
+MODULE_TERMS: Dict[int, str] = {
+    1: "emergency resuscitation trauma shock collapse overdose poisoning arrest unconscious injury",
+    2: "cancer tumour malignancy malignant carcinoma metastatic metastases lymphoma oncology chemotherapy mass",
+    3: "heart cardiac coronary myocardial angina arrhythmia atrial ventricular hypertension valve murmur aortic "
+       "ecg troponin palpitations chest pain",
+    4: "child infant neonate neonatal baby toddler paediatric boy girl newborn",
+    5: "anaemia haemoglobin bleeding clotting platelets thrombocytopenia sickle haemophilia coagulation bruising",
+    6: "imaging radiograph xray ct mri ultrasound scan",
+    7: "skin rash lesion eczema psoriasis pruritus itching dermatitis mole blister plaques",
+    8: "ear nose throat hearing tinnitus vertigo sinus tonsil epistaxis hoarseness",
+    9: "endocrine thyroid diabetes insulin glucose cortisol adrenal pituitary hormone hyponatraemia "
+       "calcium addison cushing hyperpigmentation",
+    10: "abdominal liver bowel gastric hepatic jaundice vomiting diarrhoea colon pancreas oesophagus stool",
+    11: "primary care gp chronic screening vaccination community",
+    12: "infection fever sepsis bacterial viral antibiotics pyrexia culture",
+    13: "depression anxiety psychosis mood suicidal hallucinations psychiatric delusions self harm",
+    14: "joint bone fracture arthritis muscle tendon back spine",
+    15: "neurological stroke seizure epilepsy headache migraine weakness neuropathy brain nerve tremor",
+    16: "pregnancy pregnant gestation menstrual uterus ovarian vaginal cervical postpartum antenatal",
+    17: "eye vision visual retina cornea glaucoma conjunctiva",
+    18: "anaesthesia anaesthetic postoperative preoperative airway sedation",
+    19: "kidney renal urinary bladder prostate creatinine haematuria urine dysuria",
+    20: "lung breathlessness cough asthma pneumonia respiratory wheeze sputum pleural",
+    21: "surgical hernia appendix obstruction operation abscess",
+    22: "allergy allergic anaphylaxis immune immunodeficiency urticaria angioedema",
+    23: "electrolytes potassium sodium acid base biochemistry",
+    24: "drug adverse medication dose toxicity interaction prescribing",
+    25: "genetic inherited chromosomal mutation syndrome familial",
+    26: "blood film count marrow",
+    27: "palliative terminal dying end life symptom control",
+    28: "public health epidemiology deprivation social population",
+    57: "elderly older frailty falls dementia",
+}
+
+# Fields of a question set read when categorising, and how much each counts
+FIELD_WEIGHTS = (("condition", 3), ("stem", 1), ("lead_in", 1))
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+# Words that turn up in every stem or list entry and say nothing about where a question belongs
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have he her his in is it of on or she that the this to was were "
+    "which with what who most likely appropriate next step diagnosis management investigation following "
+    "patient presents presenting year old man woman male female history examination reveals shows "
+    "disease disorder disorders syndrome syndromes condition conditions including other".split()
+)
+
+
+def terms(text: str) -> List[str]:
+    """Word stems: tokens cut to six characters, so "cardiac"/"cardiology" or "renal"/"renally" meet."""
+    words = _TOKEN.findall(text.lower().replace("'", ""))
+    return [word[:6] for word in words if word not in STOPWORDS and not word.isdigit()]
+
+
+@dataclass
+class Categorisation:
+    module_id: int
+    presentation_id: int
+    module_confidence: float
+    presentation_confidence: float
+    # "mapping" when the condition has been categorised before, otherwise "similarity"
+    source: str
+
+    @property
+    def confidence(self) -> float:
+        return min(self.module_confidence, self.presentation_confidence)
+
+
+class _Labels:
+    """TF-IDF vectors for one reference list, as a normalised dense matrix."""
+
+    def __init__(self, index: ReferenceIndex, extra: Optional[Dict[int, str]] = None):
+        self.ids = list(index.ids)
+        documents = [Counter(terms(f"{index.by_id[i]} {(extra or {}).get(i, '')}")) for i in self.ids]
+        vocabulary = sorted({term for document in documents for term in document})
+        self.columns = {term: column for column, term in enumerate(vocabulary)}
+        frequency = np.zeros(len(vocabulary))
+        matrix = np.zeros((len(self.ids), len(vocabulary)))
+        for row, document in enumerate(documents):
+            for term, count in document.items():
+                matrix[row, self.columns[term]] = 1 + np.log(count)
+                frequency[self.columns[term]] += 1
+        self.idf = np.log((1 + len(self.ids)) / (1 + frequency)) + 1
+        matrix *= self.idf
+        self.matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    def rank(self, weighted: Counter, temperature: float) -> Tuple[int, float]:
+        """Best id and its softmax share of the cosine similarities."""
+        query = np.zeros(len(self.columns))
+        for term, weight in weighted.items():
+            column = self.columns.get(term)
+            if column is not None:
+                query[column] = weight
+        query *= self.idf
+        norm = np.linalg.norm(query)
+        if not norm:
+            return self.ids[0], 0.0
+        scores = self.matrix @ (query / norm)
+        best = int(np.argmax(scores))
+        shares = np.exp((scores - scores[best]) / temperature)
+        return self.ids[best], float(1 / shares.sum())
+
+
+class Categoriser:
+    """Assigns module and presentation ids from a question set's text.
+
+    Conditions already categorised (by Claude, or confidently here) at least
+    ``min_votes`` times reuse the most common answer. Anything else is
+    matched against the module and presentation lists by TF-IDF cosine
+    similarity, with confidence the softmax share of the best match. Below
+    ``threshold`` the caller should ask Claude instead.
+    """
+
+    def __init__(self, threshold: float = 0.5, temperature: float = 0.1, min_votes: int = 2):
+        self.threshold = threshold
+        self.temperature = temperature
+        self.min_votes = min_votes
+        self._modules = _Labels(MODULES, MODULE_TERMS)
+        self._presentations = _Labels(PRESENTATIONS)
+        self._votes: Dict[str, Counter] = defaultdict(Counter)
+        self._lock = threading.Lock()
+        # A condition that is itself a presentation (e.g. "Anaphylaxis") maps to it directly
+        self._same_name = {
+            name.lower(): PRESENTATIONS.lookup(name)
+            for name in CONDITIONS.names
+            if PRESENTATIONS.lookup(name) is not None
+        }
+
+    def learn(self, condition: Optional[str], module_id: int, presentation_id: int) -> None:
+        if condition:
+            with self._lock:
+                self._votes[condition.strip().lower()][(module_id, presentation_id)] += 1
+
+    def learn_all(self, categorisations: Iterable[Tuple[Optional[str], int, int]]) -> None:
+        for condition, module_id, presentation_id in categorisations:
+            self.learn(condition, module_id, presentation_id)
+
+    def categorise(self, data: Dict) -> Categorisation:
+        """Categorise a (possibly partial) question-set record."""
+        condition = str(data.get("condition") or "").strip().lower()
+        with self._lock:
+            votes = self._votes.get(condition)
+            top = votes.most_common(1)[0] if votes else None
+            total = sum(votes.values()) if votes else 0
+        if top is not None and top[1] >= self.min_votes:
+            (module_id, presentation_id), count = top
+            share = count / total
+            return Categorisation(module_id, presentation_id, share, share, "mapping")
+        weighted: Counter = Counter()
+        for field, weight in FIELD_WEIGHTS:
+            for term in terms(str(data.get(field) or "")):
+                weighted[term] += weight
+        module_id, module_confidence = self._modules.rank(weighted, self.temperature)
+        presentation_id = self._same_name.get(condition)
+        if presentation_id is not None:
+            presentation_confidence = 1.0
+        else:
+            presentation_id, presentation_confidence = self._presentations.rank(weighted, self.temperature)
+        return Categorisation(module_id, presentation_id, module_confidence, presentation_confidence, "similarity")
+
+    def fill(self, data: Dict) -> Dict:
+        """The record with module and presentation ids added, if it came without them."""
+        if "module_id" in data and "presentation_id" in data:
+            return data
+        result = self.categorise(data)
+        return dict(data, module_id=result.module_id, presentation_id=result.presentation_id)
+
+    def unsure(self, data: Dict) -> bool:
+        return self.categorise(data).confidence < self.threshold
+
+
+def fallback_request(question_set, **params) -> Dict:
+    """A request asking Claude to categorise a question set the local categoriser was unsure of."""
+    return build_revision(question_set, "categorisation", CATEGORISE_INSTRUCTION, **params)
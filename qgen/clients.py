@@ -0,0 +1,120 @@
+"""Process-wide Anthropic clients, one per API key, shared across sessions."""
+import threading
+from typing import TYPE_CHECKING, Dict, Optional, Set
+
+if TYPE_CHECKING:
+    import anthropic
+
+
+class ClientRegistry:
+    """Hands out one pooled client per API key and closes it once no session uses it.
+
+    Every Streamlit session that calls ``get`` is recorded as an owner of the
+    key it asked for. When a session switches to a different key it releases
+    the old one, and the old client is closed as soon as it has no owners left,
+    so rotated keys don't keep idle connections open.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 30.0,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 120.0,
+        max_retries: int = 2,
+        base_url: Optional[str] = None,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.base_url = base_url
+        self._clients: Dict[str, "anthropic.Anthropic"] = {}
+        self._owners: Dict[str, Set[str]] = {}
+        self._session_keys: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str, session_id: str) -> "anthropic.Anthropic":
+        with self._lock:
+            previous = self._session_keys.get(session_id)
+            if previous is not None and previous != api_key:
+                self._release(session_id, previous)
+            client = self._clients.get(api_key)
+            if client is None:
+                client = self._build(api_key)
+                self._clients[api_key] = client
+            self._owners.setdefault(api_key, set()).add(session_id)
+            self._session_keys[session_id] = api_key
+            return client
+
+    def close(self) -> None:
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+            self._owners.clear()
+            self._session_keys.clear()
+
+    def build_async(self, api_key: str) -> "anthropic.AsyncAnthropic":
+        """Build an async client with the same pool settings.
+
+        Async clients are tied to the event loop they run on, so callers own
+        the returned client and close it when their loop finishes.
+        """
+        import anthropic
+
+        limits, timeout = self._pool()
+        http_client = anthropic.DefaultAsyncHttpxClient(limits=limits, timeout=timeout)
+        return anthropic.AsyncAnthropic(
+            api_key=api_key,
+            base_url=self.base_url,
+            timeout=timeout,
+            max_retries=self.max_retries,
+            http_client=http_client,
+        )
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def _pool(self) -> tuple:
+        """httpx limits and timeout for a client.
+
+        The SDK and httpx are imported here, on the first client, rather than
+        with this module, so a page load that never calls the API skips them.
+        """
+        import httpx
+
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        return limits, httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+
+    def _build(self, api_key: str) -> "anthropic.Anthropic":
+        import anthropic
+
+        limits, timeout = self._pool()
+        http_client = anthropic.DefaultHttpxClient(limits=limits, timeout=timeout)
+        return anthropic.Anthropic(
+            api_key=api_key,
+            base_url=self.base_url,
+            timeout=timeout,
+            max_retries=self.max_retries,
+            http_client=http_client,
+        )
+
+    def _release(self, session_id: str, api_key: str) -> None:
+        self._session_keys.pop(session_id, None)
+        owners = self._owners.get(api_key)
+        if owners is None:
+            return
+        owners.discard(session_id)
+        if not owners:
+            del self._owners[api_key]
+            client = self._clients.pop(api_key, None)
+            if client is not None:
+                client.close()
@@ -0,0 +1,202 @@
+"""Pick up responses cut off at ``max_tokens``, and size ``max_tokens`` from what replies actually need."""
+import math
+import threading
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Deque, Dict, Generator, Optional, Tuple
+
+import numpy as np
+
+# Follow-up requests allowed for one answer before it is returned as it stands
+MAX_CONTINUATIONS = 3
+
+# Most output tokens any one request is given
+MAX_OUTPUT_TOKENS = 8192
+
+CONTINUE_NOTE = (
+    "Your previous output was cut off by the length limit. The fields recorded so far are kept; "
+    "call the tool again with only the remaining fields."
+)
+
+
+def _tool_call(message):
+    for block in message.content:
+        if block.type == "tool_use":
+            return block
+    return None
+
+
+def settled_input(block) -> Dict:
+    """The fields of a truncated tool call that can be trusted.
+
+    The field being written when the output stopped may be incomplete (a list
+    with items missing, say), so the last one is always asked for again.
+    """
+    fields = dict(block.input or {})
+    if fields:
+        fields.pop(list(fields)[-1])
+    return fields
+
+
+def settled_output(message):
+    """What a truncated response has settled so far: its text, or the trusted fields of its tool call."""
+    block = _tool_call(message)
+    if block is None:
+        return "".join(b.text for b in message.content if b.type == "text").rstrip()
+    return settled_input(block)
+
+
+def continuation_request(request: Dict, message, ceiling: int = MAX_OUTPUT_TOKENS) -> Optional[Dict]:
+    """The follow-up request that picks up where a ``max_tokens``-truncated response stopped.
+
+    Plain text is continued by prefilling the assistant turn with what was
+    written so far. A truncated tool call is sent back with its settled fields
+    and the tool narrowed to the fields still missing, so nothing already
+    generated is generated (and paid for as output) again. A tool call that
+    settled nothing (one long field, say) is asked for again with twice the
+    output it has used so far, up to ``ceiling``; returns None when it is
+    already there, since the same request would only stop in the same place.
+    """
+    block = _tool_call(message)
+    if block is None:
+        # Trailing whitespace is stripped, since the API rejects a final assistant turn ending in it
+        prefill = {"role": "assistant", "content": settled_output(message)}
+        return dict(request, messages=list(request["messages"]) + [prefill])
+    known = settled_input(block)
+    if not known:
+        max_tokens = min(ceiling, 2 * max(request["max_tokens"], message.usage.output_tokens))
+        return dict(request, max_tokens=max_tokens) if max_tokens > request["max_tokens"] else None
+    tool = next(t for t in request["tools"] if t["name"] == block.name)
+    schema = tool["input_schema"]
+    missing = [field for field in schema["required"] if field not in known]
+    narrowed = dict(
+        tool,
+        input_schema=dict(
+            schema,
+            properties={field: schema["properties"][field] for field in missing},
+            required=missing,
+        ),
+    )
+    return dict(
+        request,
+        messages=list(request["messages"]) + [
+            {
+                "role": "assistant",
+                "content": [{"type": "tool_use", "id": block.id, "name": block.name, "input": known}],
+            },
+            {
+                "role": "user",
+                "content": [{"type": "tool_result", "tool_use_id": block.id, "content": CONTINUE_NOTE}],
+            },
+        ],
+        tools=[narrowed],
+    )
+
+
+def merge(first, continuation):
+    """One message holding the output of a truncated response and its continuation."""
+    usage = first.usage.model_copy(update={
+        name: (getattr(first.usage, name, 0) or 0) + (getattr(continuation.usage, name, 0) or 0)
+        for name in type(first.usage).model_fields
+        if name.endswith("tokens")
+    })
+    block = _tool_call(first)
+    if block is None:
+        text = settled_output(first) + "".join(b.text for b in continuation.content if b.type == "text")
+        content = [first.content[0].model_copy(update={"text": text})] if first.content else continuation.content
+    else:
+        later = _tool_call(continuation)
+        merged = dict(settled_input(block), **(later.input if later is not None else {}))
+        content = [block.model_copy(update={"input": merged})]
+    return first.model_copy(update={
+        "content": content,
+        "usage": usage,
+        "stop_reason": continuation.stop_reason,
+    })
+
+
+def _calls(request: Dict, ceiling: int) -> Generator[Tuple[Dict, object], object, object]:
+    """The calls that complete ``request``: yields (request, settled output) for each and is sent its response."""
+    response = yield request, None
+    for _ in range(MAX_CONTINUATIONS):
+        if response.stop_reason != "max_tokens":
+            break
+        follow_up = continuation_request(request, response, ceiling)
+        if follow_up is None:
+            break
+        later = yield follow_up, settled_output(response)
+        response = merge(response, later)
+    return response
+
+
+def complete(send: Callable[[Dict, object], object], request: Dict, ceiling: int = MAX_OUTPUT_TOKENS):
+    """Send ``request``, continue the answer while it stops at ``max_tokens``, and return it as one message.
+
+    ``send(request, base)`` makes one call. ``base`` is what the answer had
+    settled before that call (None for the first), for callers that show the
+    output as it arrives; others can ignore it. No follow-up is given more
+    than ``ceiling`` output tokens.
+    """
+    calls = _calls(request, ceiling)
+    call = next(calls)
+    while True:
+        response = send(*call)
+        try:
+            call = calls.send(response)
+        except StopIteration as done:
+            return done.value
+
+
+async def complete_async(send: Callable[[Dict, object], Awaitable], request: Dict, ceiling: int = MAX_OUTPUT_TOKENS):
+    """``complete`` with a ``send`` that returns an awaitable."""
+    calls = _calls(request, ceiling)
+    call = next(calls)
+    while True:
+        response = await send(*call)
+        try:
+            call = calls.send(response)
+        except StopIteration as done:
+            return done.value
+
+
+class OutputBudget:
+    """Chooses ``max_tokens`` per request type from the output sizes seen so far.
+
+    Until ``min_samples`` answers of a type have been seen the caller's
+    default is used; after that the limit is the 95th percentile of recent
+    output sizes plus ``headroom``, rounded up and kept within
+    [``floor``, ``ceiling``]. Truncated answers are recorded at their full,
+    continued size, so a type that keeps running over grows its budget.
+    """
+
+    def __init__(
+        self,
+        floor: int = 256,
+        ceiling: int = MAX_OUTPUT_TOKENS,
+        headroom: float = 1.25,
+        window: int = 50,
+        min_samples: int = 5,
+    ):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self._sizes: Dict[str, Deque[int]] = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def observe(self, kind: str, output_tokens: int) -> None:
+        with self._lock:
+            self._sizes[kind].append(output_tokens)
+
+    def max_tokens(self, kind: str, default: int) -> int:
+        with self._lock:
+            sizes = list(self._sizes.get(kind, ()))
+        if len(sizes) < self.min_samples:
+            return default
+        target = float(np.percentile(sizes, 95)) * self.headroom
+        # Round up to a multiple of 128 so the limit doesn't change on every answer
+        return int(min(self.ceiling, max(self.floor, math.ceil(target / 128) * 128)))
+
+    def snapshot(self) -> Dict[str, Optional[int]]:
+        with self._lock:
+            kinds = list(self._sizes)
+        return {kind: self.max_tokens(kind, None) for kind in kinds}
@@ -0,0 +1,13 @@
+"""Text shipped with the package: the default system prompt and the UKMLA lists."""
+from functools import lru_cache
+from importlib.resources import files
+
+
+@lru_cache(maxsize=None)
+def load(name: str) -> str:
+    """The contents of a data file, read once per process.
+
+    Files end with a newline for the sake of editors and diffs; it is not
+    part of the text, so prompt hashes match the old inline literals.
+    """
+    return files(__name__).joinpath(name).read_text(encoding="utf-8").removesuffix("\n")
@@ -0,0 +1,153 @@
+"""Near-duplicate question stem detection with MinHash signatures and LSH banding."""
+import json
+import os
+import re
+import threading
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+SHINGLE = 3
+
+# Appended to the request when a near-duplicate stem is regenerated
+REGENERATE_NOTE = (
+    "A question set with a very similar stem already exists; "
+    "use a different clinical scenario and question stem."
+)
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+# Fixed seed so signatures written in one run stay comparable in the next
+_rng = np.random.RandomState(1_000_003)
+_A = _rng.randint(1, 1 << 32, size=NUM_PERM, dtype=np.uint64)[:, None]
+_B = _rng.randint(0, 1 << 32, size=NUM_PERM, dtype=np.uint64)[:, None]
+# Mixes the ROWS values of a band into one integer bucket key
+_BAND_MIX = _rng.randint(1, 1 << 63, size=ROWS, dtype=np.uint64) | np.uint64(1)
+
+
+def stem_of(text: str) -> str:
+    """The question stem section of a free-text answer, or the whole answer if there isn't one."""
+    match = re.search(r"question stem\W*\n(.*?)(?:\n\W*lead-in|\Z)", text, re.IGNORECASE | re.DOTALL)
+    return match.group(1).strip() if match else text
+
+
+def shingles(text: str) -> np.ndarray:
+    """32-bit hashes of the word 3-grams in a stem (whole words for very short stems)."""
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    tokens = np.array([zlib.crc32(word.encode()) for word in words], dtype=np.uint64)
+    if len(tokens) < SHINGLE:
+        return np.unique(tokens)
+    combined = tokens[:-2] * np.uint64(0x9E3779B1) ^ tokens[1:-1] * np.uint64(0x85EBCA77) ^ tokens[2:]
+    return np.unique(combined & MAX_HASH)
+
+
+def signature(text: str) -> np.ndarray:
+    """MinHash signature: for each of NUM_PERM hash functions, the minimum over all shingles."""
+    values = shingles(text)
+    if not len(values):
+        return np.full(NUM_PERM, MAX_HASH, dtype=np.uint32)
+    # a < 2**32 and x < 2**32, so a * x + b stays inside uint64 before the modulo
+    hashed = (_A * values[None, :] + _B) % MERSENNE_PRIME & MAX_HASH
+    return hashed.min(axis=1).astype(np.uint32)
+
+
+def band_keys(signatures: np.ndarray) -> np.ndarray:
+    """One bucket key per (signature, band), for a 2-D array of signatures."""
+    bands = signatures.reshape(len(signatures), BANDS, ROWS).astype(np.uint64)
+    return (bands * _BAND_MIX).sum(axis=2, dtype=np.uint64)
+
+
+class StemIndex:
+    """In-process LSH index over stem signatures, appended to disk as it grows.
+
+    Candidates come from any of BANDS bands of ROWS rows colliding (recall
+    stays high down to roughly 0.4 Jaccard similarity) and are then confirmed
+    against ``threshold`` using the estimated similarity of the full
+    signatures.
+    """
+
+    def __init__(self, path: Optional[str] = None, threshold: float = 0.5):
+        self.threshold = threshold
+        self.labels: List[str] = []
+        self._signatures = np.empty((0, NUM_PERM), dtype=np.uint32)
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in range(BANDS)]
+        self._lock = threading.Lock()
+        self._path = Path(path) if path else None
+        if self._path is not None:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def query(self, text: str, sig: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """Stored stems at least ``threshold`` similar to ``text``, most similar first."""
+        sig = signature(text) if sig is None else sig
+        with self._lock:
+            candidates = set()
+            for buckets, key in zip(self._buckets, band_keys(sig[None, :])[0].tolist()):
+                candidates.update(buckets.get(key, ()))
+            if not candidates:
+                return []
+            rows = np.fromiter(candidates, dtype=np.int64)
+            similarity = (self._signatures[rows] == sig).mean(axis=1)
+        keep = similarity >= self.threshold
+        matches = sorted(zip(similarity[keep], rows[keep]), reverse=True)
+        return [(self.labels[row], float(score)) for score, row in matches]
+
+    def add(self, text: str, label: str, sig: Optional[np.ndarray] = None) -> None:
+        sig = signature(text) if sig is None else sig
+        with self._lock:
+            self._insert(sig, label)
+            if self._path is not None:
+                with open(self._path.with_suffix(".sig"), "ab") as f:
+                    f.write(sig.tobytes())
+                with open(self._path.with_suffix(".labels"), "a", encoding="utf-8") as f:
+                    f.write(json.dumps(label) + "\n")
+
+    def check_and_add(self, text: str, label: str) -> List[Tuple[str, float]]:
+        """Return the near-duplicates of ``text`` and then index it."""
+        sig = signature(text)
+        matches = self.query(text, sig)
+        self.add(text, label, sig)
+        return matches
+
+    def _insert(self, sig: np.ndarray, label: str) -> None:
+        row = len(self.labels)
+        if row == len(self._signatures):
+            # Grow geometrically so adding stays amortised O(1)
+            grown = np.empty((max(64, row * 2), NUM_PERM), dtype=np.uint32)
+            grown[:row] = self._signatures
+            self._signatures = grown
+        self._signatures[row] = sig
+        self.labels.append(label)
+        for buckets, key in zip(self._buckets, band_keys(sig[None, :])[0].tolist()):
+            buckets.setdefault(key, []).append(row)
+
+    def _load(self) -> None:
+        sig_path = self._path.with_suffix(".sig")
+        label_path = self._path.with_suffix(".labels")
+        text = label_path.read_text(encoding="utf-8") if label_path.exists() else ""
+        # Anything after the last newline is a label cut short by a crash
+        lines = text.split("\n")[:-1]
+        signatures = np.fromfile(sig_path, dtype=np.uint32) if sig_path.exists() else np.empty(0, dtype=np.uint32)
+        # A crash between the two appends can leave one file a row ahead. Both are cut back
+        # to the rows they share, or the next add would pair its label with the orphaned signature.
+        rows = min(len(lines), len(signatures) // NUM_PERM)
+        if sig_path.exists() and len(signatures) != rows * NUM_PERM:
+            os.truncate(sig_path, rows * NUM_PERM * signatures.itemsize)
+        kept = "".join(line + "\n" for line in lines[:rows])
+        if kept != text:
+            label_path.write_text(kept, encoding="utf-8")
+        self.labels = [json.loads(line) for line in lines[:rows]]
+        self._signatures = signatures[: rows * NUM_PERM].reshape(rows, NUM_PERM).copy()
+        keys = band_keys(self._signatures)
+        for band, buckets in enumerate(self._buckets):
+            for row, key in enumerate(keys[:, band].tolist()):
+                buckets.setdefault(key, []).append(row)
@@ -0,0 +1,180 @@
+"""Uploaded source documents: chunking, a BM25 index, and the passages sent for each condition."""
+import hashlib
+import io
+import json
+import math
+import re
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+CHUNK_WORDS = 200
+TOP_K = 4
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were which with".split()
+)
+
+# Words every generation prompt contains, which say nothing about the condition being asked for
+PROMPT_WORDS = frozenset(
+    "generate question questions set sets sba condition presentation module please make write new "
+    "different clinical scenario stem use".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def extract_text(name: str, data: bytes) -> str:
+    """Plain text of an uploaded PDF, markdown or text file.
+
+    Raises ValueError for a PDF when pypdf isn't installed.
+    """
+    if name.lower().endswith(".pdf"):
+        try:
+            from pypdf import PdfReader
+        except ImportError as e:
+            raise ValueError("Reading PDFs needs the pypdf package (pip install pypdf)") from e
+        reader = PdfReader(io.BytesIO(data))
+        return "\n\n".join(page.extract_text() or "" for page in reader.pages)
+    return data.decode("utf-8", errors="replace")
+
+
+def chunk_text(text: str, words: int = CHUNK_WORDS) -> List[str]:
+    """Pack paragraphs into chunks of about ``words`` words.
+
+    Paragraphs are kept whole where they fit, so a chunk reads as running
+    text, and markdown headings stay with the paragraph they introduce. A
+    paragraph longer than a chunk is split into word windows.
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        length = len(paragraph.split())
+        if current and size + length > words:
+            # A heading belongs with the text under it, so it moves on to the next chunk
+            carried = [current.pop()] if current[-1].startswith("#") else []
+            if current:
+                chunks.append("\n\n".join(current))
+            current, size = carried, sum(len(p.split()) for p in carried)
+        if length > words:
+            tokens = paragraph.split()
+            windows = [" ".join(tokens[start:start + words]) for start in range(0, len(tokens), words)]
+            windows[0] = "\n\n".join(current + windows[:1])
+            chunks.extend(windows)
+            current, size = [], 0
+            continue
+        current.append(paragraph)
+        size += length
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+class BM25Index:
+    """Okapi BM25 over a list of chunks, with postings held as numpy arrays."""
+
+    def __init__(self, chunks: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        counts = [Counter(tokenize(chunk)) for chunk in chunks]
+        self.lengths = np.array([sum(c.values()) for c in counts], dtype=np.float64)
+        self.average_length = float(self.lengths.mean()) if len(chunks) else 0.0
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        for i, c in enumerate(counts):
+            for term, tf in c.items():
+                ids, tfs = postings.setdefault(term, ([], []))
+                ids.append(i)
+                tfs.append(tf)
+        self.postings = {
+            term: (np.array(ids), np.array(tfs, dtype=np.float64))
+            for term, (ids, tfs) in postings.items()
+        }
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.lengths))
+        n = len(self.lengths)
+        for term in set(tokenize(query)) - PROMPT_WORDS:
+            if term not in self.postings:
+                continue
+            ids, tf = self.postings[term]
+            idf = math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[ids] / self.average_length)
+            scores[ids] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query: str, k: int = TOP_K) -> List[int]:
+        """Indices of the ``k`` best-matching chunks with a nonzero score, best first."""
+        scores = self.scores(query)
+        best = np.argsort(-scores, kind="stable")[:k]
+        return [int(i) for i in best if scores[i] > 0]
+
+
+class Document:
+    def __init__(self, name: str, digest: str, chunks: List[str]):
+        self.name = name
+        self.digest = digest
+        self.chunks = chunks
+        self.index = BM25Index(chunks)
+
+    @property
+    def words(self) -> int:
+        return sum(len(chunk.split()) for chunk in self.chunks)
+
+    def passages(self, query: str, k: int = TOP_K) -> List[Tuple[int, str]]:
+        """The top ``k`` chunks for ``query``, in document order so they read naturally."""
+        return [(i, self.chunks[i]) for i in sorted(self.index.search(query, k))]
+
+    def context(self, query: str, k: int = TOP_K) -> str:
+        """The relevant passages as a block to put ahead of the prompt, or "" if none match."""
+        passages = self.passages(query, k)
+        if not passages:
+            return ""
+        body = "\n".join(f'<passage index="{i + 1}">\n{text}\n</passage>' for i, text in passages)
+        return f'<document name="{self.name}">\n{body}\n</document>'
+
+
+class DocumentStore:
+    """Chunks uploaded documents once per file hash and keeps their indexes.
+
+    Chunks are saved under ``path`` as ``<sha256>.json``, so the same file
+    uploaded again, by any session or after a restart, is not parsed again.
+    """
+
+    def __init__(self, path: Optional[str] = None, chunk_words: int = CHUNK_WORDS):
+        self.chunk_words = chunk_words
+        self._path = Path(path) if path else None
+        if self._path is not None:
+            self._path.mkdir(parents=True, exist_ok=True)
+        self._documents: Dict[str, Document] = {}
+        self._lock = threading.Lock()
+
+    def load(self, name: str, data: bytes) -> Document:
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            document = self._documents.get(digest)
+        if document is not None:
+            return document
+        saved = self._path / f"{digest}.json" if self._path is not None else None
+        if saved is not None and saved.exists():
+            chunks = json.loads(saved.read_text(encoding="utf-8"))["chunks"]
+        else:
+            chunks = chunk_text(extract_text(name, data), self.chunk_words)
+            if not chunks:
+                raise ValueError(f"No text found in {name}")
+            if saved is not None:
+                saved.write_text(json.dumps({"name": name, "chunks": chunks}), encoding="utf-8")
+        document = Document(name, digest, chunks)
+        with self._lock:
+            self._documents[digest] = document
+        return document
@@ -0,0 +1,586 @@
+"""Question generation without Streamlit: requests, API calls and what happens to the answers.
+
+The app, the HTTP service (``qgen.server``) and any other caller share this
+engine. It turns settings into Messages API requests, sends them through the
+bulk pipeline (continuations, local categorisation and rate limiting
+included) or the chat-turn pipeline (targeted edits, categorisation and
+near-duplicate regeneration), and handles the results: adaptive
+``max_tokens``, telemetry, near-duplicate screening and the question bank.
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field, replace
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import anthropic
+
+from qgen.bank import QuestionBank
+from qgen.bulk import BulkJob, BulkResult, BulkStats, generate_one_sync, make_jobs, run_bulk
+from qgen.categorise import Categoriser, fallback_request
+from qgen.continuation import OutputBudget, complete
+from qgen.dedup import REGENERATE_NOTE, StemIndex, signature, stem_of
+from qgen.documents import TOP_K, Document
+from qgen.payload import MAX_TOKENS, TEMPERATURE, build_messages, build_system, prompt_hash, usage_metrics
+from qgen.prompts import SYSTEM_PROMPT
+from qgen.question_set import STRUCTURED_MAX_TOKENS, QuestionSet, extract_question_set, tool_options
+from qgen.refine import SECTION_LABELS, apply_revision, asks_for_new_question, build_request as build_revision, detect_section, is_edit
+from qgen.response_cache import ResponseCache, request_key
+from qgen.router import CATEGORISATION, GENERATION, Route, Router
+from qgen.scheduler import CHAT, KeyLimiter
+from qgen.telemetry import OnCall, Telemetry, reported
+
+DUPLICATE_MODES = ("Flag", "Regenerate", "Off")
+
+
+@dataclass
+class Settings:
+    """The choices a writer makes in the sidebar, or a service caller per process."""
+    system_prompt: str = SYSTEM_PROMPT
+    structured: bool = True
+    prompt_caching: bool = True
+    local_categorisation: bool = True
+    routing: bool = True
+    # Rewrite only the section an edit of the last question set is about
+    targeted_edits: bool = True
+    # What to do with a near-duplicate stem: Flag, Regenerate or Off
+    duplicate_stems: str = "Flag"
+    top_k: int = TOP_K
+    # Telemetry session the calls are recorded under
+    session: Optional[str] = None
+
+    def __post_init__(self):
+        if self.duplicate_stems not in DUPLICATE_MODES:
+            raise ValueError(f"duplicate_stems must be one of {', '.join(DUPLICATE_MODES)}")
+
+
+# Sends one chat request and returns (final message, time_to_first_token, shared); see ``Engine.chat_turn``
+Send = Callable[[Dict, str, Route], tuple]
+
+
+@dataclass
+class ChatTurn:
+    """The answer to one chat turn, with the route it took and the metrics shown beside it."""
+    text: str
+    question_set: Optional[QuestionSet]
+    route: Route
+    metrics: Dict = field(default_factory=dict)
+    error: Optional[str] = None
+
+
+def output_kind(kind: str, structured: bool) -> str:
+    """The request type adaptive ``max_tokens`` is tracked under."""
+    return f"{kind}-structured" if structured else kind
+
+
+def question_stem(text: str, question_set=None) -> str:
+    return question_set.stem if question_set is not None else stem_of(text)
+
+
+class Engine:
+    """Generates question sets for one set of ``Settings``.
+
+    Every shared resource is optional, so a caller that only wants requests
+    built can leave them all out. Engines are cheap: the app makes one per
+    script run from the session's settings and its process-wide resources.
+    """
+
+    def __init__(
+        self,
+        settings: Optional[Settings] = None,
+        router: Optional[Router] = None,
+        budget: Optional[OutputBudget] = None,
+        categoriser: Optional[Categoriser] = None,
+        bank: Optional[QuestionBank] = None,
+        stems: Optional[StemIndex] = None,
+        telemetry: Optional[Telemetry] = None,
+        document: Optional[Document] = None,
+    ):
+        self.settings = settings or Settings()
+        self.router = router or Router()
+        self.budget = budget or OutputBudget()
+        self.categoriser = categoriser
+        self.bank = bank
+        self.stems = stems
+        self.telemetry = telemetry
+        self.document = document
+
+    @property
+    def prompt_hash(self) -> str:
+        return prompt_hash(self.settings.system_prompt)
+
+    @property
+    def local_categoriser(self) -> Optional[Categoriser]:
+        """The categoriser to use for structured answers, or None when Claude picks the ids itself."""
+        if self.settings.structured and self.settings.local_categorisation:
+            return self.categoriser
+        return None
+
+    @property
+    def generation_model(self) -> str:
+        return self.router.tier(GENERATION).model
+
+    def max_tokens(self, kind: str) -> int:
+        default = STRUCTURED_MAX_TOKENS if self.settings.structured else MAX_TOKENS
+        return self.budget.max_tokens(output_kind(kind, self.settings.structured), default)
+
+    def sources(self, query: str) -> str:
+        """Passages of the source document relevant to ``query``, or "" without one."""
+        if self.document is None:
+            return ""
+        return self.document.context(query, self.settings.top_k)
+
+    def generation_request(self) -> Dict:
+        """Model settings for a single-turn generation, with the adaptive output cap."""
+        request = dict(model=self.generation_model, max_tokens=self.max_tokens("generate"), temperature=TEMPERATURE)
+        if self.settings.structured:
+            request.update(tool_options(categorised=self.local_categoriser is None))
+        return request
+
+    def chat_request(
+        self,
+        turns: List[Dict],
+        model: Optional[str] = None,
+        summary: str = "",
+        cache: Optional[bool] = None,
+        sources: str = "",
+        max_tokens: Optional[int] = None,
+        new_question: bool = True,
+    ) -> Dict:
+        """A full request for a conversation, with ``sources`` sent ahead of the last turn only.
+
+        In structured mode the answer is forced through the question-set tool
+        only for ``new_question`` turns; any other turn may answer in text.
+        """
+        cache = self.settings.prompt_caching if cache is None else cache
+        if sources:
+            turns = turns[:-1] + [dict(turns[-1], content=f"{sources}\n\n{turns[-1]['content']}")]
+        request = dict(
+            model=model or self.generation_model,
+            max_tokens=max_tokens or self.max_tokens("chat"),
+            temperature=TEMPERATURE,
+            system=build_system(self.settings.system_prompt, cache, summary),
+            messages=build_messages(turns, cache),
+        )
+        if self.settings.structured:
+            request.update(tool_options(categorised=self.local_categoriser is None, forced=new_question))
+        return request
+
+    @staticmethod
+    def new_question(turns: List[Dict]) -> bool:
+        """Whether the last turn wants a new question set: it has no answer to follow up, or asks for one."""
+        has_answer = len(turns) > 1 and turns[-2]["role"] == "assistant"
+        return not has_answer or asks_for_new_question(turns[-1]["content"])
+
+    def route(self, turns: List[Dict], saved_prompts=()) -> Route:
+        """The model tier for the last turn of a conversation."""
+        prompt = turns[-1]["content"]
+        has_answer = len(turns) > 1 and turns[-2]["role"] == "assistant"
+        section = detect_section(prompt, saved_prompts) if has_answer else None
+        return self.router.route(prompt, saved_prompts, section, has_answer, self.settings.routing)
+
+    def jobs(self, kind: str, items: List[str], count: int = 1) -> List[BulkJob]:
+        """Bulk jobs for ``count`` question sets per item, each with its source passages."""
+        return [replace(job, sources=self.sources(job.item)) for job in make_jobs(kind, items, count)]
+
+    def observe(self, result: BulkResult, kind: str = "generate") -> None:
+        """Feed a finished job's full, continued output size into the output budget."""
+        if not result.error:
+            self.budget.observe(output_kind(kind, self.settings.structured), result.usage.get("output_tokens", 0))
+
+    def call_logger(self, source: str, route: str = GENERATION) -> OnCall:
+        """An ``OnCall`` recording each API call attempt in telemetry.
+
+        Calls made here are not streamed, so time to first token is the
+        whole call.
+        """
+
+        def on_call(request: Dict, latency: float, response, error: Optional[Exception]) -> None:
+            if error is not None:
+                self.log_call(source, request["model"], latency, error=type(error).__name__, route=route)
+                return
+            self.log_call(
+                source,
+                request["model"],
+                latency,
+                usage=usage_metrics(response.usage),
+                stop_reason=response.stop_reason,
+                time_to_first_token=latency,
+                route=route,
+            )
+
+        return on_call
+
+    def log_call(self, source: str, model: str, latency: float, **fields) -> None:
+        """Record one call in telemetry under this engine's session and prompt, if there is telemetry."""
+        if self.telemetry is not None:
+            self.telemetry.record(
+                source=source,
+                model=model,
+                latency=latency,
+                session=self.settings.session,
+                prompt_hash=self.prompt_hash,
+                **fields
+            )
+
+    def duplicates(self, text: str, question_set=None) -> Tuple[List[Tuple[str, float]], Optional[object]]:
+        """Earlier stems close to this answer's, and its stem signature (both empty when screening is off)."""
+        if self.stems is None or self.settings.duplicate_stems == "Off":
+            return [], None
+        stem = question_stem(text, question_set)
+        sig = signature(stem)
+        return self.stems.query(stem, sig), sig
+
+    def bank_answer(
+        self,
+        text: str,
+        question_set,
+        source: str,
+        stem_sig=None,
+        model: Optional[str] = None,
+        condition: Optional[str] = None,
+    ) -> Optional[int]:
+        """Store a new answer in the question bank and index its stem for later duplicate checks."""
+        if self.bank is None:
+            return None
+        bank_id = self.bank.add(
+            text,
+            question_set,
+            condition=condition,
+            model=model or self.generation_model,
+            prompt_hash=self.prompt_hash,
+            source=source,
+        )
+        if bank_id is not None and self.stems is not None:
+            self.stems.add(question_stem(text, question_set), f"question #{bank_id}", stem_sig)
+        return bank_id
+
+    def store(self, results: List[BulkResult], source: str, model: str, hold_duplicates: bool = True) -> List[int]:
+        """Bank successful results and index their stems, returning the positions held back.
+
+        Each stem is checked against everything generated before it
+        (including earlier results in the same list) and near-duplicates are
+        flagged; in Regenerate mode, with ``hold_duplicates``, they are left
+        out of the bank instead so they can be asked for again.
+        """
+        hold = hold_duplicates and self.settings.duplicate_stems == "Regenerate"
+        held = []
+        for i, result in enumerate(results):
+            if result.error:
+                continue
+            duplicates, sig = self.duplicates(result.text, result.question_set)
+            if duplicates and hold:
+                held.append(i)
+                continue
+            result.duplicate_of = duplicates[0] if duplicates else None
+            condition = result.job.item if result.job.kind == "condition" else None
+            self.bank_answer(result.text, result.question_set, source, sig, model, condition)
+        return held
+
+    async def generate_many(
+        self,
+        client: "anthropic.AsyncAnthropic",
+        jobs: List[BulkJob],
+        concurrency: int = 8,
+        on_result: Optional[Callable[[BulkResult, BulkStats], None]] = None,
+        limiter: Optional[KeyLimiter] = None,
+        semaphore: Optional[asyncio.Semaphore] = None,
+        source: str = "bulk",
+        on_regenerate: Optional[Callable[[int], None]] = None,
+    ) -> List[BulkResult]:
+        """Generate, record and bank every job, asking once more for near-duplicates in Regenerate mode.
+
+        ``on_result`` sees each first-pass result as it finishes, and
+        ``on_regenerate`` is told how many are being asked for again.
+        """
+        request = self.generation_request()
+        model = request["model"]
+
+        def observe(result: BulkResult, stats: BulkStats) -> None:
+            self.observe(result)
+            if on_result is not None:
+                on_result(result, stats)
+
+        options = dict(
+            limiter=limiter,
+            categoriser=self.local_categoriser,
+            semaphore=semaphore,
+            on_call=self.call_logger(source),
+        )
+        system = build_system(self.settings.system_prompt, self.settings.prompt_caching)
+        results = await run_bulk(client, jobs, system, concurrency, observe, request, **options)
+        held = self.store(results, source, model)
+        if held:
+            if on_regenerate is not None:
+                on_regenerate(len(held))
+            retry_jobs = [replace(results[i].job, note=REGENERATE_NOTE) for i in held]
+            retried = await run_bulk(
+                client, retry_jobs, system, concurrency,
+                lambda result, stats: self.observe(result), request, **options
+            )
+            for i, result in zip(held, retried):
+                results[i] = result
+            self.store(retried, source, model, hold_duplicates=False)
+        return results
+
+    def generate_bulk(self, client: "anthropic.AsyncAnthropic", jobs: List[BulkJob], *args, **kwargs) -> List[BulkResult]:
+        """Run ``generate_many`` to completion from synchronous code and close the client."""
+
+        async def main() -> List[BulkResult]:
+            async with client:
+                return await self.generate_many(client, jobs, *args, **kwargs)
+
+        return asyncio.run(main())
+
+    def generate_sync(
+        self,
+        client: "anthropic.Anthropic",
+        job: BulkJob,
+        limiter: Optional[KeyLimiter] = None,
+        source: str = "prefetch",
+    ) -> BulkResult:
+        """Generate and record one job from a worker thread, leaving banking to whoever uses it."""
+        request = self.generation_request()
+        system = build_system(self.settings.system_prompt, self.settings.prompt_caching)
+        result = generate_one_sync(
+            client, job, system, request, limiter, self.local_categoriser, self.call_logger(source)
+        )
+        self.observe(result)
+        return result
+
+    def sender(
+        self,
+        create: Callable[[Dict], object],
+        source: str = "service",
+        limiter: Optional[KeyLimiter] = None,
+    ) -> Send:
+        """A ``Send`` hook for ``chat_turn`` around ``create``, which makes one blocking Messages API call.
+
+        With a ``limiter`` each call waits in its chat lane. Truncated answers
+        are continued, every attempt (retries and continuations included) is
+        recorded in telemetry, and each answer's full size in the output
+        budget. Nothing is streamed or shared, so time to first token is the
+        whole call.
+        """
+
+        def send(request: Dict, kind: str, route: Route) -> tuple:
+            call = reported(create, self.call_logger(source, route.turn_class))
+
+            def attempt(params: Dict, base) -> object:
+                if limiter is None:
+                    return call(params)
+                return limiter.call(lambda: call(params), params, CHAT)
+
+            started = time.perf_counter()
+            response = complete(attempt, request, self.budget.ceiling)
+            self.budget.observe(kind, response.usage.output_tokens)
+            return response, time.perf_counter() - started, False
+
+        return send
+
+    def categorise(self, question_set: QuestionSet, send: Send, on_status: Callable[[str], None]) -> tuple:
+        """Keep the local categorisation if it is confident, otherwise ask Claude and learn its answer.
+
+        Returns (question set, note on how it was categorised).
+        """
+        categoriser = self.local_categoriser
+        verdict = categoriser.categorise(question_set.to_dict())
+        if verdict.confidence >= categoriser.threshold:
+            return question_set, f"categorised locally ({verdict.confidence:.0%} confident)"
+        on_status("Checking the module and presentation...")
+        tier = self.router.tier(CATEGORISATION if self.settings.routing else GENERATION)
+        route = Route(CATEGORISATION, tier, "local categoriser unsure")
+        system = build_system(self.settings.system_prompt, self.settings.prompt_caching)
+        request = fallback_request(question_set, model=route.model, temperature=TEMPERATURE, system=system)
+        response, _, _ = send(request, "refine-categorisation", route)
+        revised = apply_revision(question_set, "categorisation", response)
+        categoriser.learn(revised.condition, revised.module_id, revised.presentation_id)
+        return revised, f"categorised by Claude (local match {verdict.confidence:.0%} confident)"
+
+    def revise(
+        self,
+        question_set: QuestionSet,
+        section: str,
+        instruction: str,
+        send: Send,
+        route: Route,
+        source: str = "refine",
+    ) -> ChatTurn:
+        """Rewrite one section of a question set with the routed model, and bank the patched set."""
+        kind = f"refine-{section}"
+        system = build_system(self.settings.system_prompt, self.settings.prompt_caching)
+        request = build_revision(
+            question_set, section, instruction, model=route.model, temperature=TEMPERATURE, system=system
+        )
+        request["max_tokens"] = self.budget.max_tokens(kind, request["max_tokens"])
+        started = time.perf_counter()
+        response, first_token, shared = send(request, kind, route)
+        revised = apply_revision(question_set, section, response)
+        text = revised.to_markdown()
+        metrics = {
+            "time_to_first_token": first_token,
+            "total_latency": time.perf_counter() - started,
+            "refined": SECTION_LABELS[section],
+            "model": route.model,
+        }
+        if shared:
+            metrics["coalesced"] = True
+        else:
+            metrics.update(usage_metrics(response.usage))
+            self.bank_answer(text, revised, source, model=route.model)
+        return ChatTurn(text, revised, route, metrics)
+
+    def chat_turn(
+        self,
+        turns: List[Dict],
+        send: Send,
+        summary: str = "",
+        saved_prompts: Iterable[str] = (),
+        previous: Optional[QuestionSet] = None,
+        route: Optional[Route] = None,
+        cache: Optional[ResponseCache] = None,
+        on_status: Optional[Callable[[str], None]] = None,
+        source: str = "chat",
+    ) -> ChatTurn:
+        """Answer the last turn of a conversation, then screen and bank the answer.
+
+        ``send`` makes each API call, so the caller decides how: streamed
+        into a page, shared with identical in-flight requests, or blocking
+        (see ``sender``). ``previous`` is the question set of the last
+        answer; with targeted edits on, an edit of one of its sections only
+        sends and rewrites that section. A new question set is categorised
+        locally where possible and checked for near-duplicate stems (asked
+        for again once in Regenerate mode); an edit of the last answer is
+        not, since it shares that answer's stem. With a response ``cache``,
+        an identical earlier request is answered from it. Raises on failure;
+        if the API rejects cache breakpoints, prompt caching is turned off in
+        ``settings`` and the turn sent again without them.
+        """
+        import anthropic
+
+        on_status = on_status or (lambda status: None)
+        prompt = turns[-1]["content"]
+        has_answer = len(turns) > 1 and turns[-2]["role"] == "assistant"
+        route = route or self.route(turns, saved_prompts)
+        section = detect_section(prompt, saved_prompts) if has_answer else None
+        if section is not None and previous is not None and self.settings.targeted_edits:
+            return self.revise(previous, section, prompt, send, route)
+
+        structured = self.settings.structured
+        kind = output_kind("chat", structured)
+        max_tokens = self.max_tokens("chat")
+        new_question = self.new_question(turns)
+        revising = has_answer and is_edit(prompt, saved_prompts)
+        # New question sets get the source passages for this prompt; they go with this turn only
+        sources = self.sources(prompt) if route.turn_class == GENERATION else ""
+        categoriser = self.local_categoriser
+        categorisation = {}
+
+        def build_request(cache_prompt: bool, turns: List[Dict] = turns) -> Dict:
+            return self.chat_request(turns, route.model, summary, cache_prompt, sources, max_tokens, new_question)
+
+        def generate(turns: List[Dict]) -> tuple:
+            """Call Claude and return (response, time_to_first_token, text, question_set, shared)."""
+            caching = self.settings.prompt_caching
+            try:
+                response, first_token, shared = send(build_request(caching, turns), kind, route)
+            except anthropic.BadRequestError as e:
+                # Fall back to an uncached request if cache breakpoints are rejected
+                if not caching or "cache_control" not in str(e):
+                    raise
+                self.settings.prompt_caching = False
+                response, first_token, shared = send(build_request(False, turns), kind, route)
+            text = "".join(block.text for block in response.content if block.type == "text")
+            if not structured:
+                return response, first_token, text, None, shared
+            question_set = extract_question_set(response, categoriser.fill if categoriser else None)
+            if question_set is None and not new_question:
+                return response, first_token, text, None, shared
+            if question_set is None:
+                raise ValueError(f"Claude did not return a question set (stop reason: {response.stop_reason})")
+            if categoriser is not None:
+                question_set, categorisation["note"] = self.categorise(question_set, send, on_status)
+            elif self.categoriser is not None:
+                # Claude's own categorisations teach the local categoriser for next time
+                self.categoriser.learn(question_set.condition, question_set.module_id, question_set.presentation_id)
+            return response, first_token, question_set.to_markdown(), question_set, shared
+
+        # Serve an identical earlier request from the response cache
+        cache_key = request_key(build_request(False))
+        cached = cache.get(cache_key) if cache is not None else None
+        started = time.perf_counter()
+        if cached is not None:
+            question_set = QuestionSet.from_dict(cached["question_set"]) if cached.get("question_set") else None
+            metrics = {
+                "time_to_first_token": time.perf_counter() - started,
+                "total_latency": time.perf_counter() - started,
+                "response_cache": True,
+                "model": route.model,
+            }
+            return ChatTurn(cached["text"], question_set, route, metrics)
+
+        response, first_token, text, question_set, shared = generate(turns)
+        metrics = {"coalesced": True} if shared else {}
+        # Check a new stem against every earlier one, and ask again once if it is a close copy.
+        # A shared answer is checked and banked by the caller that sent the request, and a
+        # text reply to a question about the last set has no stem to check.
+        stem_sig = None
+        answered_in_text = structured and question_set is None
+        if self.settings.duplicate_stems != "Off" and not shared and not revising and not answered_in_text:
+            duplicates, stem_sig = self.duplicates(text, question_set)
+            if duplicates and self.settings.duplicate_stems == "Regenerate":
+                on_status("Near-duplicate stem, regenerating...")
+                retry = turns[:-1] + [{"role": "user", "content": f"{prompt}\n\n{REGENERATE_NOTE}"}]
+                response, first_token, text, question_set, shared = generate(retry)
+                metrics["regenerated"] = True
+                duplicates, stem_sig = self.duplicates(text, question_set)
+            if duplicates:
+                metrics["duplicate_of"] = duplicates[0]
+        metrics.update({
+            "time_to_first_token": first_token,
+            "total_latency": time.perf_counter() - started,
+            "model": route.model,
+        })
+        if sources:
+            metrics["sources"] = sources.count("<passage ")
+        if categorisation:
+            metrics["categorised"] = categorisation["note"]
+        if not shared:
+            metrics.update(usage_metrics(response.usage))
+            if cache is not None:
+                cache.put(cache_key, {
+                    "text": text,
+                    "stop_reason": response.stop_reason,
+                    "question_set": question_set.to_dict() if question_set else None,
+                })
+            # Keep every answer in the question bank, and index new stems for later duplicate checks
+            self.bank_answer(text, question_set, source, stem_sig, route.model)
+        return ChatTurn(text, question_set, route, metrics)
+
+    async def chat(
+        self,
+        client: "anthropic.AsyncAnthropic",
+        turns: List[Dict],
+        summary: str = "",
+        limiter: Optional[KeyLimiter] = None,
+        source: str = "service",
+        previous: Optional[QuestionSet] = None,
+    ) -> ChatTurn:
+        """``chat_turn`` with an async client, reporting a failure in the result instead of raising.
+
+        The pipeline runs in a worker thread, waiting there in the limiter's
+        chat lane, and its API calls are made on this event loop.
+        """
+        loop = asyncio.get_running_loop()
+
+        def create(params: Dict):
+            return asyncio.run_coroutine_threadsafe(client.messages.create(**params), loop).result()
+
+        send = self.sender(create, source, limiter)
+        route = self.route(turns)
+        try:
+            return await asyncio.to_thread(
+                self.chat_turn, turns, send, summary, previous=previous, route=route, source=source
+            )
+        except Exception as e:
+            return ChatTurn("", None, route, error=f"{type(e).__name__}: {e}")
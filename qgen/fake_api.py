@@ -0,0 +1,437 @@
+"""A local stand-in for the Messages API, for benchmarks and offline runs.
+
+Answers ``POST /v1/messages`` with made-up question sets after a set
+latency, writes the output at a set token rate (streamed as server-sent
+events when asked), and fails a set share of requests with an overloaded
+error. Tool requests get tool input for every required field of the tool's
+schema, so structured output, continuations and categorisation all work
+against it. The Message Batches endpoints are served too: a batch ends a
+set latency after it is created, and its results are drawn the same way.
+
+    python -m qgen.fake_api --port 8765 --latency 0.8 --tokens-per-second 60
+
+and point the app at it with ``ANTHROPIC_BASE_URL = "http://127.0.0.1:8765"``
+in ``.streamlit/secrets.toml``.
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+WORDS = (
+    "patient acute chronic fever pain history examination blood pressure pulse renal hepatic cardiac "
+    "respiratory abdominal tenderness serum sodium potassium glucose insulin thyroid cortisol lesion "
+    "infection treatment management diagnosis imaging biopsy dose week month onset weight fatigue"
+).split()
+
+# Characters of JSON or text per output token, for pacing and truncation
+CHARS_PER_TOKEN = 4
+
+# Output tokens per made-up word, counting the space after it
+TOKENS_PER_WORD = 2
+
+# Tokens written per streamed delta
+CHUNK_TOKENS = 8
+
+
+@dataclass
+class FakeConfig:
+    # Seconds before the first byte of a response, and the +/- share it varies by
+    latency: float = 0.5
+    jitter: float = 0.0
+    # Output tokens per second once writing starts; 0 writes everything at once
+    tokens_per_second: float = 0.0
+    output_tokens: int = 600
+    # Share of requests refused, and the status they get (529 overloaded, 429 rate limited, 500...)
+    error_rate: float = 0.0
+    error_status: int = 529
+    seed: Optional[int] = None
+
+    def __post_init__(self):
+        if not 0 <= self.error_rate <= 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        if self.latency < 0 or self.tokens_per_second < 0 or self.output_tokens < 1:
+            raise ValueError("latency and tokens_per_second can't be negative, and output_tokens must be positive")
+
+
+class _Stats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.streamed = 0
+        self.batches = 0
+        # Messages requests being answered right now, and the most there have been at once
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+
+
+def _words(rng: random.Random, tokens: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(max(1, tokens // TOKENS_PER_WORD)))
+
+
+def _field(name: str, schema: Dict, rng: random.Random, tokens: int):
+    if "enum" in schema:
+        return schema["enum"][0] if name != "correct" else rng.choice(schema["enum"])
+    if schema.get("type") == "integer":
+        return 1
+    if schema.get("type") == "array":
+        size = schema.get("minItems", 3)
+        return [_words(rng, tokens // size).capitalize() + "." for _ in range(size)]
+    return _words(rng, tokens).capitalize() + "."
+
+
+def tool_input(tool: Dict, tokens: int, rng: random.Random, known: int = 0) -> Dict:
+    """Made-up input for every required field of ``tool``.
+
+    A whole answer is about ``tokens`` long; ``known`` fields were already
+    written by an earlier, truncated response, so only the rest is made.
+    """
+    schema = tool["input_schema"]
+    required = schema.get("required", list(schema.get("properties", {})))
+    share = max(1, tokens // max(1, len(required) + known))
+    return {name: _field(name, schema["properties"].get(name, {}), rng, share) for name in required}
+
+
+def written_so_far(messages: List[Dict]) -> Tuple[int, int]:
+    """(tool fields, text tokens) a continuation request says were already written."""
+    fields = tokens = 0
+    for message in messages:
+        if message["role"] != "assistant":
+            continue
+        if isinstance(message["content"], str):
+            # Only a final assistant turn is a prefill; earlier ones are just conversation
+            if message is messages[-1]:
+                tokens += len(message["content"]) // CHARS_PER_TOKEN
+            continue
+        for block in message["content"]:
+            if block.get("type") == "tool_use":
+                fields += len(block.get("input") or {})
+    return fields, tokens
+
+
+def truncate_input(fields: Dict, tokens: int) -> Dict:
+    """The leading fields of a tool input that fit in ``tokens``, as a truncated response would hold."""
+    kept: Dict = {}
+    for name, value in fields.items():
+        if len(json.dumps(dict(kept, **{name: value}))) > tokens * CHARS_PER_TOKEN:
+            break
+        kept[name] = value
+    return kept
+
+
+class FakeMessagesAPI:
+    """Serves the fake API on a background thread; ``port=0`` picks a free port."""
+
+    def __init__(self, config: Optional[FakeConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or FakeConfig()
+        self.stats = _Stats()
+        self._rng = random.Random(self.config.seed)
+        self._rng_lock = threading.Lock()
+        self._batches: Dict[str, Dict] = {}
+        self._batches_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def start(self) -> "FakeMessagesAPI":
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeMessagesAPI":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def draw(self) -> Tuple[random.Random, bool, float]:
+        """A per-request generator, whether to fail the request, and its latency."""
+        config = self.config
+        with self._rng_lock:
+            seed = self._rng.random()
+            failed = self._rng.random() < config.error_rate
+            latency = config.latency * (1 + self._rng.uniform(-config.jitter, config.jitter))
+        return random.Random(seed), failed, max(0.0, latency)
+
+    def message(self, body: Dict, rng: random.Random) -> Tuple[Dict, List[str]]:
+        """The complete message for a request, and its output as the chunks a stream would carry."""
+        known, prefilled = written_so_far(body.get("messages", [])[-2:])
+        # A tool that is offered but not forced is left unused, as for a question about an earlier answer
+        forced = (body.get("tool_choice") or {}).get("type") in ("tool", "any")
+        tools = (body.get("tools") or []) if forced else []
+        # A continued answer only has the rest left to write
+        wanted = self.config.output_tokens if tools else max(1, self.config.output_tokens - prefilled)
+        limit = min(wanted, int(body.get("max_tokens", wanted)))
+        stop_reason = "max_tokens" if wanted > limit else "end_turn"
+        usage = {
+            "input_tokens": len(json.dumps(body)) // CHARS_PER_TOKEN,
+            "output_tokens": limit,
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+        }
+        step = CHUNK_TOKENS * CHARS_PER_TOKEN
+        if tools:
+            tool = tools[0]
+            fields = tool_input(tool, self.config.output_tokens, rng, known)
+            if len(json.dumps(fields)) > limit * CHARS_PER_TOKEN:
+                stop_reason = "max_tokens"
+                fields = truncate_input(fields, limit)
+            else:
+                stop_reason = "tool_use"
+                usage["output_tokens"] = max(1, len(json.dumps(fields)) // CHARS_PER_TOKEN)
+            block = {
+                "type": "tool_use",
+                "id": f"toolu_{rng.getrandbits(48):012x}",
+                "name": tool["name"],
+                "input": fields,
+            }
+            encoded = json.dumps(fields)
+        else:
+            # Carrying on from a prefilled turn starts a new word
+            encoded = (" " if prefilled else "") + _words(rng, limit)
+            block = {"type": "text", "text": encoded}
+        message = {
+            "id": f"msg_{rng.getrandbits(48):012x}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", ""),
+            "content": [block],
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": usage,
+        }
+        return message, [encoded[start:start + step] for start in range(0, len(encoded), step)]
+
+    def events(self, message: Dict, chunks: List[str]) -> Iterator[Tuple[str, Dict]]:
+        block = message["content"][0]
+        start = dict(message, content=[], stop_reason=None, usage=dict(message["usage"], output_tokens=1))
+        yield "message_start", {"type": "message_start", "message": start}
+        empty = dict(block, input={}) if block["type"] == "tool_use" else dict(block, text="")
+        yield "content_block_start", {"type": "content_block_start", "index": 0, "content_block": empty}
+        for chunk in chunks:
+            if block["type"] == "tool_use":
+                delta = {"type": "input_json_delta", "partial_json": chunk}
+            else:
+                delta = {"type": "text_delta", "text": chunk}
+            yield "content_block_delta", {"type": "content_block_delta", "index": 0, "delta": delta}
+        yield "content_block_stop", {"type": "content_block_stop", "index": 0}
+        yield "message_delta", {
+            "type": "message_delta",
+            "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+            "usage": {"output_tokens": message["usage"]["output_tokens"]},
+        }
+        yield "message_stop", {"type": "message_stop"}
+
+    def create_batch(self, body: Dict) -> Dict:
+        """Answer every request of a batch up front; the batch reports them once its latency has passed."""
+        created = datetime.now(timezone.utc)
+        results = []
+        for request in body.get("requests", []):
+            rng, failed, _ = self.draw()
+            if failed:
+                kind = "rate_limit_error" if self.config.error_status == 429 else "overloaded_error"
+                error = {"type": "error", "error": {"type": kind, "message": "Injected failure"}}
+                result = {"type": "errored", "error": error}
+            else:
+                result = {"type": "succeeded", "message": self.message(request["params"], rng)[0]}
+            results.append({"custom_id": request["custom_id"], "result": result})
+        batch = {
+            "id": f"msgbatch_{uuid.uuid4().hex[:24]}",
+            "created_at": created,
+            "ends_at": time.monotonic() + self.config.latency,
+            "results": results,
+        }
+        with self._batches_lock:
+            self._batches[batch["id"]] = batch
+        with self.stats.lock:
+            self.stats.batches += 1
+            self.stats.requests += len(results)
+            self.stats.errors += sum(item["result"]["type"] == "errored" for item in results)
+        return self.batch(batch["id"])
+
+    def batch(self, batch_id: str) -> Optional[Dict]:
+        """The API's view of a batch, or None if there is no such batch."""
+        with self._batches_lock:
+            batch = self._batches.get(batch_id)
+        if batch is None:
+            return None
+        ended = time.monotonic() >= batch["ends_at"]
+        results = batch["results"]
+        succeeded = sum(item["result"]["type"] == "succeeded" for item in results)
+        created = batch["created_at"]
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else len(results),
+                "succeeded": succeeded if ended else 0,
+                "errored": len(results) - succeeded if ended else 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "created_at": created.isoformat(),
+            "ended_at": datetime.now(timezone.utc).isoformat() if ended else None,
+            "expires_at": (created + timedelta(days=1)).isoformat(),
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"{self.base_url}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def batch_results(self, batch_id: str) -> Optional[List[Dict]]:
+        with self._batches_lock:
+            batch = self._batches.get(batch_id)
+        if batch is None or time.monotonic() < batch["ends_at"]:
+            return None
+        return batch["results"]
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status: int, payload: Dict, headers: Optional[Dict[str, str]] = None) -> None:
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def not_found(self) -> None:
+                self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+            def do_GET(self):
+                parts = self.path.split("?")[0].strip("/").split("/")
+                if parts[:3] != ["v1", "messages", "batches"] or len(parts) not in (4, 5):
+                    self.not_found()
+                    return
+                if len(parts) == 4:
+                    batch = api.batch(parts[3])
+                    if batch is None:
+                        self.not_found()
+                    else:
+                        self.send_json(200, batch)
+                    return
+                results = api.batch_results(parts[3]) if parts[4] == "results" else None
+                if results is None:
+                    self.not_found()
+                    return
+                data = "".join(json.dumps(item) + "\n" for item in results).encode("utf-8")
+                self.send_response(200)
+                self.send_header("content-type", "application/binary")
+                self.send_header("content-length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get("content-length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                path = self.path.split("?")[0].rstrip("/")
+                if path == "/v1/messages/batches":
+                    self.send_json(200, api.create_batch(body))
+                    return
+                if path != "/v1/messages":
+                    self.not_found()
+                    return
+                rng, failed, latency = api.draw()
+                with api.stats.lock:
+                    api.stats.requests += 1
+                    api.stats.errors += failed
+                    api.stats.streamed += bool(body.get("stream"))
+                    api.stats.in_flight += 1
+                    api.stats.peak_in_flight = max(api.stats.peak_in_flight, api.stats.in_flight)
+                try:
+                    self.answer(body, rng, failed, latency)
+                finally:
+                    with api.stats.lock:
+                        api.stats.in_flight -= 1
+
+            def answer(self, body: Dict, rng: random.Random, failed: bool, latency: float) -> None:
+                time.sleep(latency)
+                if failed:
+                    kind = "rate_limit_error" if api.config.error_status == 429 else "overloaded_error"
+                    error = {"type": "error", "error": {"type": kind, "message": "Injected failure"}}
+                    self.send_json(api.config.error_status, error, {"retry-after": "0"})
+                    return
+                message, chunks = api.message(body, rng)
+                rate = api.config.tokens_per_second
+                pause = CHUNK_TOKENS / rate if rate else 0.0
+                if not body.get("stream"):
+                    time.sleep(pause * len(chunks))
+                    self.send_json(200, message)
+                    return
+                self.send_response(200)
+                self.send_header("content-type", "text/event-stream")
+                self.send_header("transfer-encoding", "chunked")
+                self.end_headers()
+                for event, data in api.events(message, chunks):
+                    frame = f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(frame), frame))
+                    self.wfile.flush()
+                    if event == "content_block_delta" and pause:
+                        time.sleep(pause)
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds before the first byte")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Share the latency varies by, e.g. 0.2")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Output rate; 0 for no limit")
+    parser.add_argument("--output-tokens", type=int, default=600, help="Output tokens per answer, before max_tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests refused, e.g. 0.05")
+    parser.add_argument("--error-status", type=int, default=529)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+    config = FakeConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second,
+        output_tokens=args.output_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        seed=args.seed,
+    )
+    api = FakeMessagesAPI(config, args.host, args.port)
+    print(f"Fake Messages API on {api.base_url}")
+    try:
+        api.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""Token-budgeted chat history: recent turns verbatim, older turns folded into a summary."""
+from typing import Dict, List, Optional
+
+# Rough Claude tokeniser ratio for English prose; good enough for budgeting
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def first_line(text: str, limit: int) -> str:
+    line = next((l.strip() for l in text.splitlines() if l.strip()), "")
+    return line if len(line) <= limit else line[: limit - 1].rstrip() + "…"
+
+
+class HistoryWindow:
+    """Decides what part of the chat history is sent to the API on each turn.
+
+    The new prompt and the ``keep_turns`` turns before it are sent verbatim
+    as long as they fit in ``token_budget``. Anything older is folded into a
+    running summary, one line per message, and each message is summarised
+    exactly once. Folding happens in batches down to ``keep_turns // 2``
+    turns (at least one) before the new prompt, so the verbatim
+    window (and the prompt-cache prefix built on it) stays stable between
+    folds instead of shifting on every turn.
+
+    Assistant messages pinned as finalised are sent as a short reference
+    rather than in full. Once more than ``max_stored_messages`` have been
+    folded away they are dropped from the stored history altogether, so a
+    session's memory stays bounded however long it runs.
+    """
+
+    def __init__(
+        self,
+        keep_turns: int = 6,
+        token_budget: int = 12000,
+        max_summary_lines: int = 40,
+        max_stored_messages: int = 200,
+    ):
+        self.keep_turns = keep_turns
+        self.token_budget = token_budget
+        self.max_summary_lines = max_summary_lines
+        self.max_stored_messages = max_stored_messages
+        self.summary_lines: List[str] = []
+        self.omitted_lines = 0
+        self.folded = 0
+        self.dropped = 0
+        self.pin_count = 0
+
+    def pin(self, message: Dict) -> str:
+        """Mark an assistant message as a finalised question set and return its reference."""
+        if "pinned" not in message:
+            self.pin_count += 1
+            message["pinned"] = f"QS-{self.pin_count}"
+        return message["pinned"]
+
+    @property
+    def summary(self) -> str:
+        if not self.summary_lines:
+            return ""
+        lines = list(self.summary_lines)
+        if self.omitted_lines:
+            lines.insert(0, f"({self.omitted_lines} earlier messages omitted)")
+        return "Summary of the earlier conversation:\n" + "\n".join(lines)
+
+    def window(self, messages: List[Dict]) -> List[Dict]:
+        """Fold old messages as needed and return the verbatim window for the API."""
+        live = messages[self.folded:]
+        start = self._verbatim_start(live)
+        if start > 0:
+            # Over the limit: fold a batch at once so the window doesn't slide every turn.
+            # The list ends with the new prompt, so the kept turns start one message earlier.
+            batch_start = len(live) - 1 - max(1, self.keep_turns // 2) * 2
+            cut = min(max(start, batch_start), len(live) - 1)
+            for message in live[:cut]:
+                self._fold(message)
+            self.folded += cut
+            live = live[cut:]
+        # The API expects the conversation to open with a user turn
+        while live and live[0]["role"] != "user":
+            self._fold(live[0])
+            self.folded += 1
+            live = live[1:]
+        return [self._outgoing(m) for m in live]
+
+    def trim(self, messages: List[Dict]) -> List[Dict]:
+        """Drop folded messages beyond ``max_stored_messages`` from the stored history."""
+        excess = self.folded - self.max_stored_messages
+        if excess <= 0:
+            return messages
+        self.folded -= excess
+        self.dropped += excess
+        return messages[excess:]
+
+    def _verbatim_start(self, live: List[Dict]) -> int:
+        """Index into ``live`` of the oldest message that may stay verbatim."""
+        # Whole turns before the new prompt, which is always the last message
+        start = max(0, len(live) - 1 - self.keep_turns * 2)
+        used = 0
+        for index in range(len(live) - 1, start - 1, -1):
+            used += estimate_tokens(self._outgoing(live[index])["content"])
+            if used > self.token_budget and index < len(live) - 1:
+                return index + 1
+        return start
+
+    def _fold(self, message: Dict) -> None:
+        if message["role"] == "user":
+            line = f"- Writer asked: {first_line(message['content'], 160)}"
+        elif "pinned" in message:
+            line = f"- Finalised question set {message['pinned']}: {first_line(message['content'], 120)}"
+        else:
+            line = f"- Claude answered: {first_line(message['content'], 200)}"
+        self.summary_lines.append(line)
+        overflow = len(self.summary_lines) - self.max_summary_lines
+        if overflow > 0:
+            del self.summary_lines[:overflow]
+            self.omitted_lines += overflow
+
+    @staticmethod
+    def _outgoing(message: Dict) -> Dict:
+        ref: Optional[str] = message.get("pinned")
+        if ref is None:
+            return {"role": message["role"], "content": message["content"]}
+        return {
+            "role": message["role"],
+            "content": (
+                f"[Finalised question set {ref}, pinned and not repeated here. "
+                f"Opening line: {first_line(message['content'], 120)}]"
+            ),
+        }
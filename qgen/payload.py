@@ -0,0 +1,59 @@
+"""Build Messages API payloads, with prompt-cache breakpoints where they pay off."""
+import hashlib
+from typing import Dict, List, Union
+
+# Generation settings shared by the chat, bulk and batch paths
+MODEL = "claude-3-7-sonnet-20250219"
+MAX_TOKENS = 1024
+TEMPERATURE = 0.7
+
+EPHEMERAL = {"type": "ephemeral"}
+
+
+def prompt_hash(system_prompt: str) -> str:
+    return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def build_system(system_prompt: str, cache: bool = True, summary: str = "") -> Union[str, List[Dict]]:
+    """Return the system prompt, as cacheable text blocks when caching is on.
+
+    The conversation summary goes after the breakpoint, so folding new turns
+    into it never invalidates the cached instructions.
+    """
+    if not cache or not system_prompt:
+        return "\n\n".join(part for part in (system_prompt, summary) if part)
+    blocks = [{"type": "text", "text": system_prompt, "cache_control": EPHEMERAL}]
+    if summary:
+        blocks.append({"type": "text", "text": summary})
+    return blocks
+
+
+def build_messages(history: List[Dict], cache: bool = True) -> List[Dict]:
+    """Format chat history for the API.
+
+    With caching on, the last message carries a breakpoint so that the whole
+    conversation up to this turn is written to the cache, and the next turn
+    (which only appends to it) reads that prefix back instead of paying for it
+    again.
+    """
+    messages = [{"role": m["role"], "content": m["content"]} for m in history]
+    if cache and messages:
+        last = messages[-1]
+        content = last["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        else:
+            content = [dict(block) for block in content]
+        content[-1]["cache_control"] = EPHEMERAL
+        messages[-1] = {"role": last["role"], "content": content}
+    return messages
+
+
+def usage_metrics(usage) -> Dict[str, int]:
+    """Pull token counts, including cache reads and writes, out of ``response.usage``."""
+    return {
+        "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+    }
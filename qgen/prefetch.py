@@ -0,0 +1,60 @@
+"""Speculative generation of the next question set while the writer is still reading."""
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Callable, Deque, Hashable, Iterable, List, Optional, Tuple
+
+from qgen.bulk import BulkResult
+
+
+class Prefetcher:
+    """Keeps up to ``size`` question sets for the next conditions in a queue generating or ready.
+
+    Work is submitted to a shared executor. Everything buffered belongs to
+    one ``key`` (the settings the requests were built from); when the key
+    changes, e.g. because the system prompt was edited, pending work is
+    cancelled, anything already running is discarded, and the conditions go
+    back to the front of the queue to be generated again.
+    """
+
+    def __init__(self, executor: Executor, size: int = 2):
+        self.executor = executor
+        self.size = size
+        self.key: Optional[Hashable] = None
+        self.queue: Deque[str] = deque()
+        self._buffer: Deque[Tuple[str, Future]] = deque()
+        self._lock = threading.Lock()
+
+    def set_queue(self, conditions: Iterable[str]) -> None:
+        with self._lock:
+            self._cancel()
+            self.queue = deque(conditions)
+
+    def fill(self, key: Hashable, generate: Callable[[str], BulkResult]) -> None:
+        """Top the buffer up from the queue, first dropping anything built for a different ``key``."""
+        with self._lock:
+            if key != self.key:
+                self._cancel()
+                self.key = key
+            while len(self._buffer) < self.size and self.queue:
+                condition = self.queue.popleft()
+                self._buffer.append((condition, self.executor.submit(generate, condition)))
+
+    def take(self) -> Optional[Tuple[str, Future]]:
+        with self._lock:
+            return self._buffer.popleft() if self._buffer else None
+
+    def pending(self) -> List[Tuple[str, bool]]:
+        with self._lock:
+            return [(condition, future.done()) for condition, future in self._buffer]
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._cancel()
+
+    def _cancel(self) -> None:
+        # Futures that have started can't be stopped; their results are simply never served
+        while self._buffer:
+            condition, future = self._buffer.pop()
+            future.cancel()
+            self.queue.appendleft(condition)
@@ -0,0 +1,5 @@
+"""Default SBA instructions given to Claude."""
+from qgen.data import load
+
+# Kept as a data file (qgen/data/system_prompt.txt) so it can be edited without touching code
+SYSTEM_PROMPT = load("system_prompt.txt")
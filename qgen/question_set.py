@@ -0,0 +1,197 @@
+"""Typed question-set records produced through a tool schema instead of free-form markdown."""
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from qgen.reference import MODULES, PRESENTATIONS
+
+LETTERS = ("A", "B", "C", "D", "E")
+
+TOOL_NAME = "record_question_set"
+
+# A full set with five explanations doesn't fit in the chat's 1024 tokens once JSON-encoded
+STRUCTURED_MAX_TOKENS = 2048
+
+
+def _catalogue(index) -> str:
+    return "; ".join(f"{number} - {name}" for number, name in index.by_id.items())
+
+
+QUESTION_SET_TOOL = {
+    "name": TOOL_NAME,
+    "description": "Record one complete SBA question set, following the system instructions for every section.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "condition": {"type": "string", "description": "The condition the question is really testing."},
+            "stem": {"type": "string", "description": "Question stem."},
+            "lead_in": {"type": "string", "description": "Lead-in question."},
+            "options": {
+                "type": "array",
+                "items": {"type": "string"},
+                "minItems": 5,
+                "maxItems": 5,
+                "description": "Answer options A to E, in order, without the letter prefix.",
+            },
+            "correct": {"type": "string", "enum": list(LETTERS)},
+            "difficulty": {"type": "string", "description": "Why the question set is difficult."},
+            "explanations": {
+                "type": "array",
+                "items": {"type": "string"},
+                "minItems": 5,
+                "maxItems": 5,
+                "description": "Why each option A to E is right or wrong, in the same order as the options.",
+            },
+            "module_id": {
+                "type": "integer",
+                "enum": list(MODULES.by_id),
+                "description": "UKMLA module: " + _catalogue(MODULES),
+            },
+            "presentation_id": {
+                "type": "integer",
+                "enum": list(PRESENTATIONS.by_id),
+                "description": "UKMLA presentation: " + _catalogue(PRESENTATIONS),
+            },
+        },
+        "required": [
+            "condition", "stem", "lead_in", "options", "correct",
+            "difficulty", "explanations", "module_id", "presentation_id",
+        ],
+    },
+}
+
+
+@dataclass(slots=True)
+class QuestionSet:
+    condition: str
+    stem: str
+    lead_in: str
+    options: Tuple[str, ...]
+    correct: str
+    difficulty: str
+    explanations: Tuple[str, ...]
+    module_id: int
+    presentation_id: int
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "QuestionSet":
+        """Build a record from tool input, raising ValueError if it doesn't fit the schema or lists."""
+        try:
+            record = cls(
+                condition=str(data.get("condition", "")).strip(),
+                stem=str(data["stem"]).strip(),
+                lead_in=str(data["lead_in"]).strip(),
+                options=tuple(str(o).strip() for o in data["options"]),
+                correct=str(data["correct"]).strip().upper(),
+                difficulty=str(data["difficulty"]).strip(),
+                explanations=tuple(str(e).strip() for e in data["explanations"]),
+                module_id=int(data["module_id"]),
+                presentation_id=int(data["presentation_id"]),
+            )
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Incomplete question set: {e}") from e
+        record.validate()
+        return record
+
+    def validate(self) -> None:
+        if len(self.options) != len(LETTERS) or len(self.explanations) != len(LETTERS):
+            raise ValueError("A question set needs exactly five options and five explanations")
+        if self.correct not in LETTERS:
+            raise ValueError(f"Correct answer must be one of A-E, not {self.correct!r}")
+        if self.module_id not in MODULES.by_id:
+            raise ValueError(f"Unknown module id {self.module_id}")
+        if self.presentation_id not in PRESENTATIONS.by_id:
+            raise ValueError(f"Unknown presentation id {self.presentation_id}")
+
+    @property
+    def module(self) -> str:
+        return MODULES.by_id[self.module_id]
+
+    @property
+    def presentation(self) -> str:
+        return PRESENTATIONS.by_id[self.presentation_id]
+
+    def to_dict(self) -> Dict:
+        data = asdict(self)
+        data["options"] = list(self.options)
+        data["explanations"] = list(self.explanations)
+        return data
+
+    def to_markdown(self) -> str:
+        return render_markdown(self.to_dict())
+
+
+def render_markdown(data: Dict) -> str:
+    """Markdown for a complete or partially streamed question set."""
+    parts: List[str] = []
+    if data.get("stem"):
+        parts.append(f"**Question Stem**\n{data['stem']}")
+    if data.get("lead_in"):
+        parts.append(f"**Lead-In**\n{data['lead_in']}")
+    options = data.get("options") or []
+    if options:
+        lines = [f"{letter} - {text}" for letter, text in zip(LETTERS, options)]
+        parts.append("**Answer Options**\n" + "\n".join(lines))
+    if data.get("correct"):
+        parts.append(f"**Correct Answer**\n{data['correct']}")
+    if data.get("difficulty"):
+        parts.append(f"**Why the question set is difficult**\n{data['difficulty']}")
+    explanations = data.get("explanations") or []
+    if explanations:
+        lines = [f"{letter} - {text}" for letter, text in zip(LETTERS, explanations)]
+        parts.append("**Explanations**\n" + "\n".join(lines))
+    module_id = data.get("module_id")
+    if module_id in MODULES.by_id:
+        parts.append(f"**Module**\n{module_id} - {MODULES.by_id[module_id]}")
+    presentation_id = data.get("presentation_id")
+    if presentation_id in PRESENTATIONS.by_id:
+        parts.append(f"**Presentation**\n{presentation_id} - {PRESENTATIONS.by_id[presentation_id]}")
+    return "\n\n".join(parts)
+
+
+CATEGORISATION_FIELDS = ("module_id", "presentation_id")
+
+
+def question_set_tool(categorised: bool = True) -> Dict:
+    """The question-set tool, optionally without the module and presentation fields.
+
+    Leaving them out drops both UKMLA catalogues from the request, for when
+    the ids are assigned locally after generation.
+    """
+    if categorised:
+        return QUESTION_SET_TOOL
+    schema = QUESTION_SET_TOOL["input_schema"]
+    return dict(
+        QUESTION_SET_TOOL,
+        input_schema=dict(
+            schema,
+            properties={k: v for k, v in schema["properties"].items() if k not in CATEGORISATION_FIELDS},
+            required=[field for field in schema["required"] if field not in CATEGORISATION_FIELDS],
+        ),
+    )
+
+
+def tool_options(categorised: bool = True, forced: bool = True) -> Dict:
+    """Extra request arguments offering the question-set tool, and forcing the answer through it if ``forced``.
+
+    Unforced, Claude picks: a rewritten set comes back through the tool and
+    an answer to a question about the set as text.
+    """
+    return {
+        "tools": [question_set_tool(categorised)],
+        "tool_choice": {"type": "tool", "name": TOOL_NAME} if forced else {"type": "auto"},
+    }
+
+
+def extract_question_set(message, fill: Optional[Callable[[Dict], Dict]] = None) -> Optional[QuestionSet]:
+    """Return the validated record from a response's tool call, or None if there isn't one.
+
+    ``fill`` completes a record that came without module and presentation
+    ids, e.g. ``Categoriser.fill``.
+    """
+    for block in message.content:
+        if block.type == "tool_use" and block.name == TOOL_NAME:
+            data = block.input
+            if fill is not None:
+                data = fill(data)
+            return QuestionSet.from_dict(data)
+    return None
@@ -0,0 +1,104 @@
+"""UKMLA reference lists used to categorise and target questions."""
+import bisect
+import difflib
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+from qgen.data import load
+
+# The lists live in qgen/data, one entry per line under a header line
+MODULE_LIST = load("modules.txt")
+PRESENTATION_LIST = load("presentations.txt")
+CONDITION_LIST = load("conditions.txt")
+
+
+def parse_entries(text: str) -> List[Tuple[int, str]]:
+    """Return (number, name) pairs from one of the lists, without the header or trailing commas."""
+    entries = []
+    for line in text.splitlines()[1:]:
+        line = line.strip().rstrip(",")
+        for sep in (" - ", ". "):
+            number, found, name = line.partition(sep)
+            if found and number.isdigit():
+                entries.append((int(number), name))
+                break
+    return entries
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", text.lower().replace("'", ""))
+
+
+class ReferenceIndex:
+    """An id -> name map over one list, with prefix and fuzzy search.
+
+    Built once at import; every query after that is a few dictionary and
+    bisect lookups instead of a scan over the raw list text.
+    """
+
+    def __init__(self, kind: str, entries: List[Tuple[int, str]]):
+        self.kind = kind
+        self.by_id: Dict[int, str] = dict(entries)
+        self.ids: List[int] = [number for number, _ in entries]
+        self._by_name: Dict[str, int] = {name.lower(): number for number, name in entries}
+        self._postings: Dict[str, Set[int]] = {}
+        for number, name in entries:
+            for token in tokenize(name):
+                self._postings.setdefault(token, set()).add(number)
+        self._tokens: List[str] = sorted(self._postings)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def names(self) -> List[str]:
+        return [self.by_id[number] for number in self.ids]
+
+    def lookup(self, name: str) -> Optional[int]:
+        """Exact, case-insensitive name to id."""
+        return self._by_name.get(name.strip().lower())
+
+    def search(self, query: str, limit: int = 25) -> List[Tuple[int, str]]:
+        """Entries matching every query word as a prefix, falling back to fuzzy matches."""
+        query = query.strip()
+        if not query:
+            return [(number, self.by_id[number]) for number in self.ids[:limit]]
+        if query.isdigit():
+            number = int(query)
+            return [(number, self.by_id[number])] if number in self.by_id else []
+        words = tokenize(query)
+        matches: Optional[Set[int]] = None
+        for word in words:
+            found = self._prefix(word)
+            matches = found if matches is None else matches & found
+            if not matches:
+                break
+        if matches:
+            return [(number, self.by_id[number]) for number in self.ids if number in matches][:limit]
+        return self.fuzzy(query, limit)
+
+    def fuzzy(self, query: str, limit: int = 25, cutoff: float = 0.6) -> List[Tuple[int, str]]:
+        """Tolerate typos by matching names and single words with difflib."""
+        hits: Set[int] = set()
+        for name in difflib.get_close_matches(query.lower(), self._by_name, n=limit, cutoff=cutoff):
+            hits.add(self._by_name[name])
+        for word in tokenize(query):
+            for token in difflib.get_close_matches(word, self._tokens, n=5, cutoff=cutoff + 0.1):
+                hits |= self._postings[token]
+        return [(number, self.by_id[number]) for number in self.ids if number in hits][:limit]
+
+    def _prefix(self, word: str) -> Set[int]:
+        found: Set[int] = set()
+        start = bisect.bisect_left(self._tokens, word)
+        for token in self._tokens[start:]:
+            if not token.startswith(word):
+                break
+            found |= self._postings[token]
+        return found
+
+
+MODULES = ReferenceIndex("module", parse_entries(MODULE_LIST))
+PRESENTATIONS = ReferenceIndex("presentation", parse_entries(PRESENTATION_LIST))
+CONDITIONS = ReferenceIndex("condition", parse_entries(CONDITION_LIST))
+
+INDEXES = {"Modules": MODULES, "Presentations": PRESENTATIONS, "Conditions": CONDITIONS}
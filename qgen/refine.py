@@ -0,0 +1,145 @@
+"""Section-targeted edits: rewrite one part of a question set instead of regenerating all of it."""
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from qgen.question_set import LETTERS, QUESTION_SET_TOOL, QuestionSet, render_markdown
+
+SECTION_TOOL_NAME = "revise_section"
+
+# Fields each section rewrites, the fields sent alongside as context, and the output cap for the reply
+SECTIONS: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...], int]] = {
+    "stem": (("stem",), ("condition", "lead_in", "options", "correct"), 600),
+    "lead_in": (("lead_in",), ("condition", "stem", "options", "correct"), 200),
+    # New options would leave the old explanations and answer behind, so they are rewritten together
+    "options": (("options", "correct", "explanations"), ("condition", "stem", "lead_in"), 1500),
+    "difficulty": (("difficulty",), ("stem", "lead_in", "options", "correct"), 600),
+    "explanations": (("explanations",), ("stem", "lead_in", "options", "correct"), 1500),
+    "categorisation": (("module_id", "presentation_id"), ("condition", "stem"), 100),
+}
+
+SECTION_LABELS = {
+    "stem": "question stem",
+    "lead_in": "lead-in",
+    "options": "answer options",
+    "difficulty": "difficulty rationale",
+    "explanations": "explanations",
+    "categorisation": "module and presentation categorisation",
+}
+
+# Checked in order, so "explanation of option B" is an explanations edit, not an options one.
+# "module" or "presentation" alone is usually a topic ("a question for the presentation chest pain"),
+# so categorisation needs the word itself, both lists, or their ids.
+_KEYWORDS: List[Tuple[str, str]] = [
+    ("explanations", r"explanation|rationale for (each|the) option"),
+    ("difficulty", r"difficult|why .* hard"),
+    ("categorisation", r"categori[sz]|\bmodule\b.*\bpresentation\b|\bpresentation\b.*\bmodule\b|"
+                       r"\b(module|presentation) (ids?|numbers?)\b"),
+    ("lead_in", r"lead[- ]?in"),
+    ("stem", r"\bstem\b|vignette|scenario"),
+    ("options", r"\boptions?\b|answers?\b|distractors?"),
+]
+
+# Words that change what is already there
+_EDIT_VERBS = (
+    r"\b(make|shorten|lengthen|rewrite|reword|rephrase|change|edit|revise|fix|correct|improve|simplify|"
+    r"clarify|condense|expand|adjust|tweak|update|replace|remove|add|swap|recategori[sz]e)\b"
+)
+
+# Words that ask for a question set that does not exist yet
+_NEW_QUESTION = r"\b(generate|write|create|new|another)\b"
+
+
+def normalise(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+def asks_for_new_question(instruction: str) -> bool:
+    return re.search(_NEW_QUESTION, instruction, re.IGNORECASE) is not None
+
+
+def is_edit(instruction: str, saved_prompts: Iterable[str] = ()) -> bool:
+    """Whether a prompt asks to change the last answer rather than for something new.
+
+    Saved prompts always are; anything else needs an edit verb and no sign
+    of wanting a new question set ("write another question with a harder stem").
+    """
+    if normalise(instruction) in {normalise(saved) for saved in saved_prompts}:
+        return True
+    if asks_for_new_question(instruction):
+        return False
+    return re.search(_EDIT_VERBS, instruction, re.IGNORECASE) is not None
+
+
+def detect_section(instruction: str, saved_prompts: Iterable[str] = ()) -> Optional[str]:
+    """The one section an edit request is about, or None if it is not an edit or names none or several."""
+    if not is_edit(instruction, saved_prompts):
+        return None
+    found = [section for section, pattern in _KEYWORDS if re.search(pattern, instruction, re.IGNORECASE)]
+    return found[0] if len(found) == 1 else None
+
+
+def section_tool(section: str) -> Dict:
+    fields, _, _ = SECTIONS[section]
+    properties = QUESTION_SET_TOOL["input_schema"]["properties"]
+    return {
+        "name": SECTION_TOOL_NAME,
+        "description": f"Record the revised {SECTION_LABELS[section]} of the question set.",
+        "input_schema": {
+            "type": "object",
+            "properties": {field: properties[field] for field in fields},
+            "required": list(fields),
+        },
+    }
+
+
+def _describe(question_set: QuestionSet, fields) -> str:
+    data = question_set.to_dict()
+    parts = []
+    for field in fields:
+        if field == "condition":
+            parts.append(f"**Condition**\n{data['condition']}")
+        elif field in ("options", "explanations"):
+            lines = [f"{letter} - {text}" for letter, text in zip(LETTERS, data[field])]
+            parts.append(f"**{field.title()}**\n" + "\n".join(lines))
+        else:
+            parts.append(render_markdown({field: data[field]}))
+    return "\n\n".join(part for part in parts if part)
+
+
+def build_request(question_set: QuestionSet, section: str, instruction: str, **params) -> Dict:
+    """A single-turn request carrying only the targeted section and the context it depends on.
+
+    ``params`` supplies the model, temperature and system prompt.
+    """
+    fields, context, max_tokens = SECTIONS[section]
+    label = SECTION_LABELS[section]
+    prompt = (
+        f"Here is part of an SBA question set.\n\n{_describe(question_set, context)}\n\n"
+        f"Current {label}:\n\n{_describe(question_set, fields)}\n\n"
+        f"Revise only the {label}: {instruction}\n"
+        "Keep everything else about the question consistent with the parts shown."
+    )
+    return dict(
+        params,
+        max_tokens=max_tokens,
+        messages=[{"role": "user", "content": prompt}],
+        tools=[section_tool(section)],
+        tool_choice={"type": "tool", "name": SECTION_TOOL_NAME},
+    )
+
+
+def apply_revision(question_set: QuestionSet, section: str, message) -> QuestionSet:
+    """Patch the section from a response's tool call into a copy of the question set.
+
+    Raises ValueError if the reply has no revision or the patched set is invalid.
+    """
+    fields, _, _ = SECTIONS[section]
+    for block in message.content:
+        if block.type == "tool_use" and block.name == SECTION_TOOL_NAME:
+            missing = [field for field in fields if field not in block.input]
+            if missing:
+                raise ValueError(f"Revision is missing {', '.join(missing)} (stop reason: {message.stop_reason})")
+            data = question_set.to_dict()
+            data.update({field: block.input[field] for field in fields})
+            return QuestionSet.from_dict(data)
+    raise ValueError(f"Claude did not return a revision (stop reason: {message.stop_reason})")
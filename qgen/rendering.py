@@ -0,0 +1,72 @@
+"""Formatting of chat messages for display, memoised by content hash."""
+import hashlib
+import re
+from functools import lru_cache
+from typing import Dict, List
+
+# Section names the SBA instructions ask Claude to produce
+SECTION_HEADINGS = (
+    "question set",
+    "question stem",
+    "lead-in",
+    "answer options",
+    "correct answer",
+    "why the question",
+    "explanations",
+    "module",
+    "presentation",
+)
+
+HEADING = re.compile(r"^[#*\s]*(?P<title>[A-Za-z][A-Za-z -]{2,60}?)[*\s]*:?[*\s]*$")
+
+
+def digest(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def message_digest(message: Dict) -> str:
+    """Content hash of a message, computed once and kept on the message."""
+    if message.get("digest") is None:
+        message["digest"] = digest(message["content"])
+    return message["digest"]
+
+
+def format_message(message: Dict) -> str:
+    return _format(message_digest(message), message["content"])
+
+
+def title(message: Dict, limit: int = 80) -> str:
+    return _title(message_digest(message), message["content"], limit)
+
+
+@lru_cache(maxsize=1024)
+def _format(key: str, text: str) -> str:
+    """Bold the SBA section headings and keep single line breaks.
+
+    Markdown folds consecutive lines into one paragraph, which runs answer
+    options A-E together, so prose lines are joined with hard breaks instead.
+    """
+    lines = text.split("\n")
+    out: List[str] = []
+    in_code = False
+    for i, line in enumerate(lines):
+        fence = line.lstrip().startswith("```")
+        if fence:
+            in_code = not in_code
+        if in_code or fence or not line.strip():
+            out.append(line)
+            continue
+        match = HEADING.match(line)
+        if match and match.group("title").lower().startswith(SECTION_HEADINGS):
+            line = f"**{match.group('title').strip()}**"
+        following = lines[i + 1] if i + 1 < len(lines) else ""
+        if following.strip() and not following.lstrip().startswith("```"):
+            line += "  "
+        out.append(line)
+    return "\n".join(out)
+
+
+@lru_cache(maxsize=1024)
+def _title(key: str, text: str, limit: int) -> str:
+    line = next((l.strip(" #*") for l in text.splitlines() if l.strip(" #*")), "(empty)")
+    return line if len(line) <= limit else line[: limit - 1].rstrip() + "…"
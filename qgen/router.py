@@ -0,0 +1,106 @@
+"""Route each chat turn to a model tier by what it asks for."""
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
+
+from qgen.payload import MODEL
+from qgen.refine import is_edit, normalise
+
+# Turn classes
+GENERATION = "generation"
+REFINEMENT = "refinement"
+CATEGORISATION = "categorisation"
+
+FAST_MODEL = "claude-3-5-haiku-20241022"
+
+
+@dataclass(frozen=True)
+class Tier:
+    name: str
+    model: str
+    # p95 seconds per call and USD per call the tier is expected to stay within
+    latency_target: float
+    cost_target: float
+
+
+DEFAULT_TIERS = {
+    "strong": Tier("strong", MODEL, latency_target=30.0, cost_target=0.05),
+    "fast": Tier("fast", FAST_MODEL, latency_target=8.0, cost_target=0.005),
+}
+
+DEFAULT_ROUTES = {
+    GENERATION: "strong",
+    REFINEMENT: "fast",
+    CATEGORISATION: "fast",
+}
+
+
+@dataclass(frozen=True)
+class Route:
+    turn_class: str
+    tier: Tier
+    reason: str
+
+    @property
+    def model(self) -> str:
+        return self.tier.model
+
+
+def classify(
+    prompt: str,
+    saved_prompts: Iterable[str] = (),
+    section: Optional[str] = None,
+    has_answer: bool = False,
+) -> tuple:
+    """Return (turn class, reason) for a chat turn.
+
+    ``section`` is the question-set section the prompt targets, if any, and
+    ``has_answer`` whether there is an earlier answer for it to act on.
+    Without one, every turn is a new generation, and so is any turn that
+    is not confirmed as an edit of that answer, whatever sections it names.
+    """
+    if not has_answer:
+        return GENERATION, "no earlier answer to edit"
+    if not is_edit(prompt, saved_prompts):
+        return GENERATION, "not an edit of the last answer"
+    if section == "categorisation":
+        return CATEGORISATION, "asks only for the module and presentation"
+    if normalise(prompt) in {normalise(saved) for saved in saved_prompts}:
+        return REFINEMENT, "saved prompt"
+    if section is not None:
+        return REFINEMENT, f"edits the {section.replace('_', '-')} only"
+    return GENERATION, "free-form request"
+
+
+class Router:
+    """Maps turn classes to model tiers.
+
+    With ``enabled`` off every turn goes to the tier for new generation,
+    which is how the app behaved before routing existed.
+    """
+
+    def __init__(
+        self,
+        tiers: Optional[Dict[str, Tier]] = None,
+        routes: Optional[Dict[str, str]] = None,
+    ):
+        self.tiers = dict(tiers or DEFAULT_TIERS)
+        self.routes = dict(DEFAULT_ROUTES, **(routes or {}))
+        unknown = {tier for tier in self.routes.values() if tier not in self.tiers}
+        if unknown:
+            raise ValueError(f"Routes name unknown tiers: {', '.join(sorted(unknown))}")
+
+    def tier(self, turn_class: str) -> Tier:
+        return self.tiers[self.routes[turn_class]]
+
+    def route(
+        self,
+        prompt: str,
+        saved_prompts: Iterable[str] = (),
+        section: Optional[str] = None,
+        has_answer: bool = False,
+        enabled: bool = True,
+    ) -> Route:
+        turn_class, reason = classify(prompt, saved_prompts, section, has_answer)
+        if not enabled:
+            return Route(turn_class, self.tier(GENERATION), "routing off")
+        return Route(turn_class, self.tier(turn_class), reason)
@@ -0,0 +1,234 @@
+"""Rate-limit-aware scheduling of Messages API calls.
+
+Every API key gets one ``KeyLimiter`` per process, shared by all sessions.
+It holds two token buckets, one for requests per minute and one for tokens
+per minute, and admits calls in priority order: while an interactive chat
+turn is waiting for capacity, bulk jobs stand aside. Failed calls that are
+worth retrying (429, 529, 5xx, timeouts, dropped connections) are retried
+with jittered exponential backoff, and a ``retry-after`` from the API pauses
+every call on that key rather than only the one that was refused.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Priority lanes: lower numbers go first
+CHAT = 0
+BULK = 1
+
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+# How often a call that is standing aside for a higher lane checks again, in seconds
+YIELD_INTERVAL = 0.05
+
+
+def estimate_request_tokens(request: Dict) -> int:
+    """Rough token cost of a request before it is sent: its prompt at ~4 characters per token plus ``max_tokens``."""
+    prompt = json.dumps([request.get("system"), request.get("messages"), request.get("tools")])
+    return len(prompt) // 4 + request.get("max_tokens", 0)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the API asked us to wait, from the ``retry-after-ms`` or ``retry-after`` header."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # An HTTP date rather than a number of seconds; fall back to backoff
+        pass
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    # Only ever reached after a call, so the SDK is loaded by then
+    import anthropic
+
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in RETRY_STATUSES
+    # Covers timeouts too, which subclass APIConnectionError
+    return isinstance(error, anthropic.APIConnectionError)
+
+
+def usage_tokens(response) -> int:
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return 0
+    return (getattr(usage, "input_tokens", 0) or 0) + (getattr(usage, "output_tokens", 0) or 0)
+
+
+class TokenBucket:
+    """Refills continuously at ``per_minute`` up to ``capacity``. Not thread-safe on its own."""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60
+        self.capacity = capacity or per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until ``amount`` is available (amounts above capacity only need a full bucket)."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        # May go negative for oversized requests, which then delays whoever comes next
+        self.level -= amount
+
+    def give_back(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+
+class KeyLimiter:
+    """Request and token budgets for one API key, with priority lanes and retries."""
+
+    def __init__(
+        self,
+        requests_per_minute: float = 50,
+        tokens_per_minute: float = 40000,
+        max_retries: int = 4,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.paused_until = 0.0
+        self._waiting: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int, priority: int) -> float:
+        """Take capacity for one call and return 0, or return how long to wait before asking again."""
+        with self._lock:
+            now = time.monotonic()
+            if self.paused_until > now:
+                return self.paused_until - now
+            if any(count for lane, count in self._waiting.items() if lane < priority):
+                return YIELD_INTERVAL
+            wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+            if wait > 0:
+                return wait
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            return 0.0
+
+    def settle(self, estimated: int, actual: int) -> None:
+        """Correct the token bucket once the real usage of a call is known."""
+        with self._lock:
+            if actual < estimated:
+                self.tokens.give_back(estimated - actual)
+            else:
+                self.tokens.take(actual - estimated)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every call on this key for ``seconds``, e.g. after a 429 with retry-after."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def backoff(self, error: Exception, attempt: int) -> Optional[float]:
+        """Delay before retrying ``error``, or None if it shouldn't be retried."""
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        requested = retry_after(error)
+        if requested is not None:
+            self.pause(requested)
+            delay = max(delay, requested)
+        return delay
+
+    def call(
+        self,
+        fn: Callable[[], T],
+        request: Dict,
+        priority: int = CHAT,
+        on_retry: Optional[Callable[[Exception, float], None]] = None,
+    ) -> T:
+        """Run ``fn`` (which sends ``request``) once there is capacity, retrying transient failures."""
+        estimated = estimate_request_tokens(request)
+        for attempt in range(self.max_retries + 1):
+            self._queue(priority, 1)
+            try:
+                while (wait := self.reserve(estimated, priority)) > 0:
+                    time.sleep(wait)
+            finally:
+                self._queue(priority, -1)
+            try:
+                result = fn()
+            except Exception as e:
+                self.settle(estimated, 0)
+                delay = self.backoff(e, attempt)
+                if delay is None:
+                    raise
+                if on_retry is not None:
+                    on_retry(e, delay)
+                time.sleep(delay)
+                continue
+            self.settle(estimated, usage_tokens(result))
+            return result
+
+    async def call_async(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        request: Dict,
+        priority: int = BULK,
+        on_retry: Optional[Callable[[Exception, float], None]] = None,
+    ) -> T:
+        """``call`` for coroutines, sleeping on the event loop instead of blocking it."""
+        estimated = estimate_request_tokens(request)
+        for attempt in range(self.max_retries + 1):
+            self._queue(priority, 1)
+            try:
+                while (wait := self.reserve(estimated, priority)) > 0:
+                    await asyncio.sleep(wait)
+            finally:
+                self._queue(priority, -1)
+            try:
+                result = await fn()
+            except Exception as e:
+                self.settle(estimated, 0)
+                delay = self.backoff(e, attempt)
+                if delay is None:
+                    raise
+                if on_retry is not None:
+                    on_retry(e, delay)
+                await asyncio.sleep(delay)
+                continue
+            self.settle(estimated, usage_tokens(result))
+            return result
+
+    def _queue(self, priority: int, change: int) -> None:
+        with self._lock:
+            self._waiting[priority] += change
+
+
+class Scheduler:
+    """One ``KeyLimiter`` per API key, created on first use with the same limits."""
+
+    def __init__(self, **limits):
+        self.limits = limits
+        self._limiters: Dict[str, KeyLimiter] = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, api_key: str) -> KeyLimiter:
+        # Keyed by a digest so the raw key isn't held in yet another place
+        key = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+        with self._lock:
+            if key not in self._limiters:
+                self._limiters[key] = KeyLimiter(**self.limits)
+            return self._limiters[key]
@@ -0,0 +1,358 @@
+"""Question generation over HTTP, for the LMS integration and batch tooling.
+
+A small asyncio HTTP/1.1 server around ``qgen.engine``, so generations can
+be driven by the thousand without a Streamlit session per caller. Every API
+call in the process shares one pool of ``--workers`` slots, and requests
+that would push the number of waiting generations past ``--max-pending``
+are turned away with 503 and a Retry-After header rather than queued
+without bound.
+
+    python -m qgen.server --port 8080 --workers 16
+
+Endpoints take and return JSON:
+
+    GET  /health     liveness and the generations admitted but not finished
+    GET  /stats      telemetry summary and the adaptive output limits
+    POST /generate   {"kind": "condition", "items": ["Addison's disease"], "count": 2}
+    POST /chat       {"messages": [{"role": "user", "content": "..."}], "summary": ""}
+
+An assistant turn in /chat may carry the ``question_set`` record a
+previous answer returned, so that an edit of one of its sections ("make
+the stem more concise") only sends and rewrites that section.
+
+The API key is read from ANTHROPIC_API_KEY.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from http import HTTPStatus
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import anthropic
+
+from qgen.bank import QuestionBank
+from qgen.bulk import BulkResult
+from qgen.categorise import Categoriser
+from qgen.continuation import OutputBudget
+from qgen.dedup import StemIndex
+from qgen.documents import TOP_K, DocumentStore
+from qgen.engine import DUPLICATE_MODES, ChatTurn, Engine, Settings
+from qgen.prompts import SYSTEM_PROMPT
+from qgen.question_set import QuestionSet
+from qgen.router import Router
+from qgen.scheduler import KeyLimiter
+from qgen.telemetry import Telemetry
+
+KINDS = ("condition", "presentation")
+MAX_COUNT = 10
+MAX_BODY_BYTES = 1 << 20
+
+# Seconds a refused caller is told to wait before trying again
+RETRY_AFTER = 5
+
+
+class HTTPError(Exception):
+    def __init__(self, status: HTTPStatus, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+def result_payload(result: BulkResult) -> Dict:
+    return {
+        "kind": result.job.kind,
+        "item": result.job.item,
+        "number": result.job.number,
+        "count": result.job.count,
+        "text": result.text,
+        "question_set": result.question_set.to_dict() if result.question_set is not None else None,
+        "error": result.error,
+        "latency": result.latency,
+        "usage": result.usage,
+        "stop_reason": result.stop_reason,
+        "duplicate_of": list(result.duplicate_of) if result.duplicate_of else None,
+    }
+
+
+def chat_payload(turn: ChatTurn) -> Dict:
+    metrics = turn.metrics
+    return {
+        "text": turn.text,
+        "question_set": turn.question_set.to_dict() if turn.question_set is not None else None,
+        "error": turn.error,
+        "latency": metrics.get("total_latency"),
+        "usage": {name: metrics[name] for name in ("input_tokens", "output_tokens") if name in metrics},
+        "duplicate_of": list(metrics["duplicate_of"]) if metrics.get("duplicate_of") else None,
+        "regenerated": bool(metrics.get("regenerated")),
+        "refined": metrics.get("refined"),
+        "categorised": metrics.get("categorised"),
+        "turn_class": turn.route.turn_class,
+        "model": turn.route.model,
+        "reason": turn.route.reason,
+    }
+
+
+def parse_generate(body: Dict) -> Tuple[str, List[str], int]:
+    """Validate a /generate body, returning (kind, items, count)."""
+    kind = body.get("kind", "condition")
+    if kind not in KINDS:
+        raise ValueError(f"kind must be one of {', '.join(KINDS)}")
+    items = body.get("items", [body["item"]] if "item" in body else [])
+    if not isinstance(items, list) or not items or not all(isinstance(item, str) and item.strip() for item in items):
+        raise ValueError("items must be a non-empty list of names")
+    count = body.get("count", 1)
+    # bool is an int subclass, so True would otherwise pass as 1
+    if type(count) is not int or not 1 <= count <= MAX_COUNT:
+        raise ValueError(f"count must be a whole number from 1 to {MAX_COUNT}")
+    return kind, [item.strip() for item in items], count
+
+
+def parse_chat(body: Dict) -> Tuple[List[Dict], str, Optional[QuestionSet]]:
+    """Validate a /chat body, returning (turns, summary, question set of the last answer)."""
+    turns = body.get("messages")
+    if not turns or not isinstance(turns, list):
+        raise ValueError("messages must be a non-empty list")
+    for turn in turns:
+        if not isinstance(turn, dict) or turn.get("role") not in ("user", "assistant"):
+            raise ValueError('each message needs a role of "user" or "assistant"')
+        if not isinstance(turn.get("content"), str):
+            raise ValueError("message content must be text")
+    if turns[-1]["role"] != "user":
+        raise ValueError("the last message must be from the user")
+    previous = None
+    record = turns[-2].get("question_set") if len(turns) > 1 else None
+    if record is not None:
+        if not isinstance(record, dict):
+            raise ValueError("question_set must be an object")
+        previous = QuestionSet.from_dict(record)
+    messages = [{"role": turn["role"], "content": turn["content"]} for turn in turns]
+    return messages, str(body.get("summary", "")), previous
+
+
+class GenerationServer:
+    """Serves one engine over HTTP with a process-wide worker limit and bounded admission."""
+
+    def __init__(
+        self,
+        engine: Engine,
+        client: anthropic.AsyncAnthropic,
+        limiter: Optional[KeyLimiter] = None,
+        workers: int = 16,
+        max_pending: int = 1000,
+    ):
+        self.engine = engine
+        self.client = client
+        self.limiter = limiter
+        self.workers = workers
+        self.max_pending = max_pending
+        # Generations admitted and not yet finished, across every connection
+        self.pending = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Made on first use so it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        return self._semaphore
+
+    def admit(self, generations: int) -> None:
+        if self.pending + generations > self.max_pending:
+            raise HTTPError(
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                f"{self.pending} generations already waiting; try again shortly",
+                {"Retry-After": str(RETRY_AFTER)},
+            )
+        self.pending += generations
+
+    async def generate(self, body: Dict) -> Dict:
+        kind, items, count = parse_generate(body)
+        jobs = self.engine.jobs(kind, items, count)
+        self.admit(len(jobs))
+        try:
+            results = await self.engine.generate_many(
+                self.client, jobs, limiter=self.limiter, semaphore=self.semaphore, source="service"
+            )
+        finally:
+            self.pending -= len(jobs)
+        return {
+            "results": [result_payload(result) for result in results],
+            "failed": sum(1 for result in results if result.error),
+        }
+
+    async def chat(self, body: Dict) -> Dict:
+        turns, summary, previous = parse_chat(body)
+        self.admit(1)
+        try:
+            async with self.semaphore:
+                turn = await self.engine.chat(self.client, turns, summary, self.limiter, previous=previous)
+        finally:
+            self.pending -= 1
+        return chat_payload(turn)
+
+    def health(self) -> Dict:
+        return {"status": "ok", "workers": self.workers, "pending": self.pending}
+
+    def stats(self) -> Dict:
+        summary = self.engine.telemetry.summary() if self.engine.telemetry is not None else {}
+        if "routes" in summary:
+            summary["routes"] = {f"{route}/{model}": figures for (route, model), figures in summary["routes"].items()}
+        return {"telemetry": summary, "max_tokens": self.engine.budget.snapshot(), "pending": self.pending}
+
+    async def dispatch(self, method: str, path: str, body: bytes) -> Dict:
+        routes = {
+            ("GET", "/health"): self.health,
+            ("GET", "/stats"): self.stats,
+            ("POST", "/generate"): self.generate,
+            ("POST", "/chat"): self.chat,
+        }
+        if (method, path) not in routes:
+            if any(route_path == path for _, route_path in routes):
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f"{method} is not supported on {path}")
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"no such endpoint: {path}")
+        handler = routes[method, path]
+        if method == "GET":
+            return handler()
+        try:
+            parsed = json.loads(body or b"{}")
+        except json.JSONDecodeError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"invalid JSON: {e}") from e
+        if not isinstance(parsed, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "the request body must be a JSON object")
+        try:
+            return await handler(parsed)
+        except ValueError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, str(e)) from e
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve requests on one connection until the client closes it or asks to."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                length = int(headers.get("content-length", 0))
+                try:
+                    if length > MAX_BODY_BYTES:
+                        keep_alive = False
+                        raise HTTPError(
+                            HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"bodies are limited to {MAX_BODY_BYTES} bytes"
+                        )
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload, extra = HTTPStatus.OK, await self.dispatch(method, target.split("?")[0], body), {}
+                except HTTPError as e:
+                    status, payload, extra = e.status, {"error": str(e)}, e.headers
+                await self.respond(writer, status, payload, keep_alive, extra)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def respond(
+        writer: asyncio.StreamWriter, status: HTTPStatus, payload: Dict, keep_alive: bool, headers: Dict[str, str]
+    ) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        lines = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(data)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle, host, port)
+        async with self.client, server:
+            print(f"Serving question generation on http://{host}:{port} with {self.workers} workers")
+            await server.serve_forever()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=16, help="API calls in flight at once, across all requests")
+    parser.add_argument("--max-pending", type=int, default=1000, help="Generations admitted before callers get 503")
+    parser.add_argument(
+        "--data-dir",
+        default=os.path.join(".qgen", "server"),
+        help="Question bank, stem index and telemetry for this service",
+    )
+    parser.add_argument("--system-prompt-file", help="Use these instructions instead of the default SBA prompt")
+    parser.add_argument(
+        "--free-text", action="store_true", help="Return markdown answers instead of typed question sets"
+    )
+    parser.add_argument(
+        "--no-local-categoriser", action="store_true", help="Have Claude choose module and presentation ids"
+    )
+    parser.add_argument(
+        "--no-targeted-edits", action="store_true", help="Regenerate the whole set for every /chat edit"
+    )
+    parser.add_argument("--duplicate-stems", choices=DUPLICATE_MODES, default="Flag")
+    parser.add_argument("--document", help="Source document (PDF, markdown or text) to send relevant passages from")
+    parser.add_argument("--top-k", type=int, default=TOP_K, help="Source passages sent with each request")
+    parser.add_argument("--requests-per-minute", type=float, default=50)
+    parser.add_argument("--tokens-per-minute", type=float, default=40000)
+    parser.add_argument("--base-url", help="Point at a different Messages API, e.g. a local stand-in")
+    args = parser.parse_args(argv)
+
+    system_prompt = SYSTEM_PROMPT
+    if args.system_prompt_file:
+        system_prompt = Path(args.system_prompt_file).read_text(encoding="utf-8")
+
+    data_dir = Path(args.data_dir)
+    document = None
+    if args.document:
+        path = Path(args.document)
+        document = DocumentStore(data_dir / "documents").load(path.name, path.read_bytes())
+
+    bank = QuestionBank(str(data_dir / "question_bank.sqlite3"))
+    categoriser = Categoriser()
+    categoriser.learn_all(bank.categorisations())
+    engine = Engine(
+        Settings(
+            system_prompt=system_prompt,
+            structured=not args.free_text,
+            local_categorisation=not args.no_local_categoriser,
+            targeted_edits=not args.no_targeted_edits,
+            duplicate_stems=args.duplicate_stems,
+            top_k=args.top_k,
+        ),
+        router=Router(),
+        budget=OutputBudget(),
+        categoriser=categoriser,
+        bank=bank,
+        stems=StemIndex(str(data_dir / "stem_index")),
+        telemetry=Telemetry(str(data_dir / "telemetry.jsonl")),
+        document=document,
+    )
+    # Retries go through the limiter, which backs off for every call on the key at once
+    client = anthropic.AsyncAnthropic(base_url=args.base_url, max_retries=0)
+    limiter = KeyLimiter(requests_per_minute=args.requests_per_minute, tokens_per_minute=args.tokens_per_minute)
+    server = GenerationServer(engine, client, limiter, args.workers, args.max_pending)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""Share one in-flight API call between every caller that sends an identical request."""
+import threading
+from typing import Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class Flight:
+    """One call in progress: the latest streamed snapshot, then the result or the error."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._snapshot = None
+        self._version = 0
+        self._done = False
+        self._result = None
+        self._error: Optional[BaseException] = None
+
+    def publish(self, snapshot) -> None:
+        with self._cond:
+            self._snapshot = snapshot
+            self._version += 1
+            self._cond.notify_all()
+
+    def finish(self, result) -> None:
+        with self._cond:
+            self._result = result
+            self._done = True
+            self._cond.notify_all()
+
+    def fail(self, error: BaseException) -> None:
+        with self._cond:
+            self._error = error
+            self._done = True
+            self._cond.notify_all()
+
+    def updates(self) -> Iterator:
+        """Yield the newest snapshot each time it changes, until the call ends.
+
+        Snapshots are cumulative, so a slow reader skips intermediate ones
+        rather than falling behind.
+        """
+        seen = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._version > seen or self._done)
+                if self._version == seen:
+                    return
+                seen = self._version
+                snapshot = self._snapshot
+            yield snapshot
+
+    def result(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._done)
+            if self._error is not None:
+                raise self._error
+            return self._result
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one, process-wide.
+
+    The first caller for a key (the leader) runs the call; anyone arriving
+    with the same key before it finishes follows it, seeing its streamed
+    snapshots and then its result or error. Keys are forgotten as soon as
+    the call ends, so this never serves stale results.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(
+        self,
+        key: str,
+        fn: Callable[[Callable], T],
+        on_update: Optional[Callable] = None,
+    ) -> Tuple[T, bool]:
+        """Return (result of ``fn(publish)``, whether it was shared with an earlier caller)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            for snapshot in flight.updates():
+                if on_update is not None:
+                    on_update(snapshot)
+            return flight.result(), True
+        try:
+            result = fn(flight.publish)
+        except Exception as e:
+            flight.fail(e)
+            raise
+        except BaseException:
+            # The leader's script was stopped or rerun; don't pass that control flow on to followers
+            flight.fail(RuntimeError("The shared request was cancelled"))
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+        flight.finish(result)
+        return result, False
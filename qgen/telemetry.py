@@ -0,0 +1,202 @@
+"""Per-call telemetry: an append-only JSONL log plus rolling in-process statistics."""
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional
+
+import numpy as np
+
+# USD per million tokens: (input, output). Cache writes cost 1.25x input and cache reads 0.1x.
+PRICES = {
+    "claude-3-7-sonnet-20250219": (3.0, 15.0),
+    "claude-3-5-haiku-20241022": (0.8, 4.0),
+}
+CACHE_WRITE_FACTOR = 1.25
+CACHE_READ_FACTOR = 0.1
+
+
+def estimate_cost(model: str, usage: Dict[str, int]) -> float:
+    """Estimated spend in USD for one call, or 0.0 for a model without a price."""
+    if model not in PRICES:
+        return 0.0
+    input_price, output_price = PRICES[model]
+    return (
+        usage.get("input_tokens", 0) * input_price
+        + usage.get("cache_creation_input_tokens", 0) * input_price * CACHE_WRITE_FACTOR
+        + usage.get("cache_read_input_tokens", 0) * input_price * CACHE_READ_FACTOR
+        + usage.get("output_tokens", 0) * output_price
+    ) / 1_000_000
+
+
+@dataclass
+class CallRecord:
+    timestamp: float
+    source: str
+    model: str
+    latency: float
+    time_to_first_token: Optional[float] = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_input_tokens: int = 0
+    cache_creation_input_tokens: int = 0
+    stop_reason: Optional[str] = None
+    error: Optional[str] = None
+    session: Optional[str] = None
+    prompt_hash: Optional[str] = None
+    cost: float = 0.0
+    # Served by following an identical request already in flight, so no tokens were spent
+    coalesced: bool = False
+    # Turn class the model was routed for, if the call went through the router
+    route: Optional[str] = None
+
+    @property
+    def tokens(self) -> int:
+        return (
+            self.input_tokens + self.output_tokens
+            + self.cache_read_input_tokens + self.cache_creation_input_tokens
+        )
+
+
+# Told about each API call attempt: (request, seconds taken, response or None, error or None)
+OnCall = Callable[[Dict, float, object, Optional[Exception]], None]
+
+
+def reported(create: Callable[[Dict], object], on_call: OnCall) -> Callable[[Dict], object]:
+    """Wrap ``create``, which makes one API call, so every attempt is reported to ``on_call``, failed or not."""
+
+    def call(request: Dict):
+        started = time.perf_counter()
+        try:
+            response = create(request)
+        except Exception as e:
+            on_call(request, time.perf_counter() - started, None, e)
+            raise
+        on_call(request, time.perf_counter() - started, response, None)
+        return response
+
+    return call
+
+
+def reported_async(create: Callable[[Dict], Awaitable], on_call: OnCall) -> Callable[[Dict], Awaitable]:
+    """``reported`` for a ``create`` that returns an awaitable."""
+
+    async def call(request: Dict):
+        started = time.perf_counter()
+        try:
+            response = await create(request)
+        except Exception as e:
+            on_call(request, time.perf_counter() - started, None, e)
+            raise
+        on_call(request, time.perf_counter() - started, response, None)
+        return response
+
+    return call
+
+
+class Telemetry:
+    """Records every API call to ``path`` and keeps the last ``window`` in memory for the panel.
+
+    One instance is shared by every session in the process, so the rolling
+    figures describe the whole server while spend is also kept per session.
+    """
+
+    def __init__(self, path: Optional[str] = None, window: int = 1000, rate_window: float = 300.0):
+        self.rate_window = rate_window
+        self._records = deque(maxlen=window)
+        self._spend: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+        self._path = Path(path) if path else None
+        if self._path is not None:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+
+    def record(
+        self,
+        source: str,
+        model: str,
+        latency: float,
+        usage: Optional[Dict[str, int]] = None,
+        stop_reason: Optional[str] = None,
+        error: Optional[str] = None,
+        time_to_first_token: Optional[float] = None,
+        session: Optional[str] = None,
+        prompt_hash: Optional[str] = None,
+        coalesced: bool = False,
+        route: Optional[str] = None,
+    ) -> CallRecord:
+        usage = usage or {}
+        record = CallRecord(
+            timestamp=time.time(),
+            source=source,
+            model=model,
+            latency=latency,
+            time_to_first_token=time_to_first_token,
+            input_tokens=usage.get("input_tokens", 0),
+            output_tokens=usage.get("output_tokens", 0),
+            cache_read_input_tokens=usage.get("cache_read_input_tokens", 0),
+            cache_creation_input_tokens=usage.get("cache_creation_input_tokens", 0),
+            stop_reason=stop_reason,
+            error=error,
+            session=session,
+            prompt_hash=prompt_hash,
+            cost=estimate_cost(model, usage),
+            coalesced=coalesced,
+            route=route,
+        )
+        line = json.dumps(asdict(record)) + "\n"
+        with self._lock:
+            self._records.append(record)
+            self._spend[session] += record.cost
+            if self._path is not None:
+                with open(self._path, "a", encoding="utf-8") as f:
+                    f.write(line)
+        return record
+
+    def summary(self, session: Optional[str] = None) -> Dict:
+        """Rolling latency percentiles, token rate, coalescing and spend over the recent calls.
+
+        Latency figures only cover calls that actually went to the API.
+        """
+        now = time.time()
+        with self._lock:
+            records = list(self._records)
+            spend = sum(self._spend.values())
+            session_spend = self._spend.get(session, 0.0)
+        sent = [r for r in records if not r.coalesced]
+        latencies = np.array([r.latency for r in sent if r.error is None])
+        first_tokens = np.array([r.time_to_first_token for r in sent if r.time_to_first_token is not None])
+        coalesced = len(records) - len(sent)
+        recent_tokens = sum(r.tokens for r in records if r.timestamp >= now - self.rate_window)
+        summary = {
+            "calls": len(records),
+            "errors": sum(1 for r in records if r.error is not None),
+            "coalesced": coalesced,
+            "coalesced_rate": coalesced / len(records) if records else 0.0,
+            "tokens_per_minute": recent_tokens / (self.rate_window / 60),
+            "spend": spend,
+            "session_spend": session_spend,
+        }
+        for name, values in (("latency", latencies), ("time_to_first_token", first_tokens)):
+            p50, p95 = np.percentile(values, [50, 95]).tolist() if len(values) else (None, None)
+            summary[f"p50_{name}"] = p50
+            summary[f"p95_{name}"] = p95
+        summary["routes"] = self._routes(sent)
+        return summary
+
+    @staticmethod
+    def _routes(records) -> Dict:
+        """Calls, p95 latency and mean cost per (turn class, model), for comparing routed tiers."""
+        groups = defaultdict(list)
+        for r in records:
+            if r.route is not None and r.error is None:
+                groups[(r.route, r.model)].append(r)
+        return {
+            key: {
+                "calls": len(group),
+                "p95_latency": float(np.percentile([r.latency for r in group], 95)),
+                "mean_cost": sum(r.cost for r in group) / len(group),
+            }
+            for key, group in groups.items()
+        }
@@ -0,0 +1,76 @@
+import json
+
+import anthropic
+import pytest
+
+from qgen.batch_job import BatchRunner, syllabus_jobs
+from qgen.fake_api import FakeConfig, FakeMessagesAPI
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt(delay):
+    raise Interrupted
+
+
+def read_results(runner):
+    with open(runner.results_path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def api():
+    with FakeMessagesAPI(FakeConfig(latency=0.3, output_tokens=200, seed=7)) as api:
+        yield api
+
+
+@pytest.fixture
+def client(api):
+    return anthropic.Anthropic(api_key="sk-test", base_url=api.base_url, max_retries=0)
+
+
+def runner(client, workdir, **options):
+    return BatchRunner(client, workdir, batch_size=2, structured=True, poll_initial=0.05, log=lambda line: None, **options)
+
+
+def test_an_interrupted_run_resumes_from_its_checkpoint(api, client, tmp_path):
+    jobs = syllabus_jobs(conditions="1-3")
+
+    # The first run submits both batches, then is stopped while they are still processing
+    first = runner(client, tmp_path, sleep=interrupt)
+    with pytest.raises(Interrupted):
+        first.run(jobs)
+    checkpoint = json.loads((tmp_path / "checkpoint.json").read_text())
+    assert [batch["ingested"] for batch in checkpoint["batches"]] == [False, False]
+    assert sorted(checkpoint["jobs"]) == sorted(job.custom_id for job in jobs)
+    assert not first.results_path.exists()
+    assert api.stats.batches == 2
+
+    # Re-running picks the batches up from the checkpoint instead of submitting them again
+    second = runner(client, tmp_path)
+    second.run(jobs)
+    assert api.stats.batches == 2
+    assert all(batch["ingested"] for batch in second.state["batches"])
+    results = read_results(second)
+    assert sorted(record["custom_id"] for record in results) == sorted(job.custom_id for job in jobs)
+    assert {record["status"] for record in results} == {"succeeded"}
+    assert all(record["question_set"]["options"] for record in results)
+    assert results[0]["condition"] == jobs[0].to_dict()["condition"]
+
+
+def test_ingesting_a_batch_again_skips_results_already_written(client, tmp_path):
+    jobs = syllabus_jobs(conditions="1-2")
+    first = runner(client, tmp_path)
+    first.run(jobs)
+    assert len(read_results(first)) == 2
+
+    # As if the run died after writing the results but before checkpointing the batch as ingested
+    state = json.loads((tmp_path / "checkpoint.json").read_text())
+    state["batches"][0]["ingested"] = False
+    (tmp_path / "checkpoint.json").write_text(json.dumps(state))
+    second = runner(client, tmp_path)
+    second.wait()
+    assert len(read_results(second)) == 2
+    assert second.state["batches"][0]["ingested"]
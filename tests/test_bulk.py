@@ -0,0 +1,89 @@
+import asyncio
+
+import anthropic
+import pytest
+
+from qgen.bank import QuestionBank
+from qgen.bulk import make_jobs, run_bulk
+from qgen.engine import Engine, Settings
+from qgen.fake_api import FakeConfig, FakeMessagesAPI
+from qgen.payload import build_system
+from qgen.scheduler import KeyLimiter
+from qgen.telemetry import Telemetry
+
+
+def fake_api(**config):
+    return FakeMessagesAPI(FakeConfig(**dict(dict(latency=0.05, output_tokens=300, seed=5), **config)))
+
+
+def bulk(api, jobs, **options):
+    async def main():
+        async with anthropic.AsyncAnthropic(api_key="sk-test", base_url=api.base_url, max_retries=0) as client:
+            return await run_bulk(client, jobs, build_system("Write SBA questions."), **options)
+
+    return asyncio.run(main())
+
+
+def fast_limiter(**options):
+    return KeyLimiter(requests_per_minute=100000, tokens_per_minute=10**8, backoff_base=0.001, **options)
+
+
+def test_no_more_than_concurrency_requests_are_in_flight():
+    with fake_api(latency=0.1) as api:
+        results = bulk(api, make_jobs("condition", ["Asthma", "Gout", "Sepsis"], 4), concurrency=3)
+    assert len(results) == 12
+    assert all(result.error is None and result.text for result in results)
+    assert api.stats.requests == 12
+    assert api.stats.peak_in_flight == 3
+
+
+def test_progress_is_reported_as_each_job_finishes():
+    seen = []
+    jobs = make_jobs("presentation", ["Chest pain", "Headache"], 3)
+    with fake_api() as api:
+        results = bulk(api, jobs, concurrency=2, on_result=lambda result, stats: seen.append((result, stats.done)))
+    assert [done for _, done in seen] == list(range(1, 7))
+    assert sorted(id(result) for result, _ in seen) == sorted(id(result) for result in results)
+    # Results come back in job order, whatever order they finished in
+    assert [result.job for result in results] == jobs
+
+
+def test_failed_jobs_are_reported_in_their_result():
+    progress = []
+    with fake_api(error_rate=1.0, error_status=429) as api:
+        results = bulk(api, make_jobs("condition", ["Asthma", "Gout"], 1), on_result=lambda r, s: progress.append(s))
+    assert [result.error.split(":")[0] for result in results] == ["RateLimitError", "RateLimitError"]
+    assert all(result.text == "" for result in results)
+    assert (progress[-1].completed, progress[-1].failed) == (0, 2)
+
+
+def test_the_limiter_retries_injected_failures():
+    with fake_api(error_rate=0.4, error_status=429) as api:
+        results = bulk(api, make_jobs("condition", ["Asthma", "Gout", "Sepsis"], 3), limiter=fast_limiter(max_retries=10))
+    assert all(result.error is None for result in results)
+    assert api.stats.errors > 0
+    assert api.stats.requests == len(results) + api.stats.errors
+
+
+def test_a_job_fails_once_its_retries_run_out():
+    with fake_api(error_rate=1.0, error_status=500) as api:
+        results = bulk(api, make_jobs("condition", ["Asthma"], 1), limiter=fast_limiter(max_retries=2))
+    assert results[0].error.startswith("InternalServerError")
+    assert api.stats.requests == 3
+
+
+@pytest.mark.parametrize("structured", [True, False])
+def test_generate_many_banks_and_records_every_job(tmp_path, structured):
+    telemetry = Telemetry()
+    bank = QuestionBank(str(tmp_path / "bank.sqlite"))
+    engine = Engine(Settings(structured=structured, duplicate_stems="Off"), bank=bank, telemetry=telemetry)
+    jobs = engine.jobs("condition", ["Asthma", "Gout"], 2)
+    finished = []
+    with fake_api() as api:
+        client = anthropic.AsyncAnthropic(api_key="sk-test", base_url=api.base_url, max_retries=0)
+        results = engine.generate_bulk(client, jobs, 2, on_result=lambda result, stats: finished.append(result))
+    assert len(finished) == len(results) == 4
+    assert all(result.error is None for result in results)
+    assert all((result.question_set is not None) == structured for result in results)
+    assert len(bank) == 4
+    assert telemetry.summary()["calls"] == api.stats.requests
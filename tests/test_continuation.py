@@ -0,0 +1,139 @@
+import asyncio
+
+import anthropic
+import pytest
+
+from qgen.continuation import OutputBudget, complete, complete_async, continuation_request, merge, settled_output
+from qgen.engine import Engine
+from qgen.fake_api import FakeConfig, FakeMessagesAPI
+from qgen.payload import MODEL
+from qgen.question_set import extract_question_set, tool_options
+
+PROMPT = [{"role": "user", "content": "Generate a question set on asthma."}]
+
+
+@pytest.fixture
+def api():
+    with FakeMessagesAPI(FakeConfig(latency=0, output_tokens=600, seed=3)) as api:
+        yield api
+
+
+@pytest.fixture
+def client(api):
+    return anthropic.Anthropic(api_key="sk-test", base_url=api.base_url, max_retries=0)
+
+
+def text_request(max_tokens):
+    return dict(model=MODEL, max_tokens=max_tokens, messages=PROMPT)
+
+
+def tool_request(max_tokens):
+    return dict(text_request(max_tokens), **tool_options())
+
+
+def test_truncated_text_is_continued_from_a_prefill(client):
+    request = text_request(400)
+    first = client.messages.create(**request)
+    assert first.stop_reason == "max_tokens"
+
+    follow_up = continuation_request(request, first)
+    assert follow_up["messages"][:-1] == PROMPT
+    assert follow_up["messages"][-1] == {"role": "assistant", "content": settled_output(first)}
+    assert not follow_up["messages"][-1]["content"].endswith(" ")
+
+    later = client.messages.create(**follow_up)
+    assert later.stop_reason == "end_turn"
+    merged = merge(first, later)
+    assert merged.content[0].text == settled_output(first) + later.content[0].text
+    assert merged.usage.output_tokens == first.usage.output_tokens + later.usage.output_tokens
+    assert merged.stop_reason == "end_turn"
+    assert merged.id == first.id
+
+
+def test_a_truncated_tool_call_is_narrowed_to_the_missing_fields(client):
+    request = tool_request(300)
+    first = client.messages.create(**request)
+    assert first.stop_reason == "max_tokens"
+    known = settled_output(first)
+    written = first.content[0].input
+    # The field being written when the output stopped is asked for again
+    assert list(known) == list(written)[:-1]
+
+    follow_up = continuation_request(request, first)
+    schema = follow_up["tools"][0]["input_schema"]
+    required = request["tools"][0]["input_schema"]["required"]
+    assert schema["required"] == [name for name in required if name not in known]
+    assert set(schema["properties"]) == set(schema["required"])
+    assistant, result = follow_up["messages"][-2:]
+    assert assistant["content"][0]["input"] == known
+    assert result["content"][0]["tool_use_id"] == assistant["content"][0]["id"]
+
+    later = client.messages.create(**follow_up)
+    assert later.stop_reason == "tool_use"
+    merged = merge(first, later)
+    assert set(merged.content[0].input) == set(required)
+    assert {name: merged.content[0].input[name] for name in known} == known
+    assert merged.stop_reason == "tool_use"
+    assert extract_question_set(merged) is not None
+
+
+def test_complete_continues_until_the_answer_ends(api, client):
+    calls = []
+
+    def send(request, base):
+        calls.append(base)
+        return client.messages.create(**request)
+
+    merged = complete(send, tool_request(300))
+    assert merged.stop_reason == "tool_use"
+    assert extract_question_set(merged) is not None
+    assert calls[0] is None and isinstance(calls[1], dict)
+    assert api.stats.requests == len(calls) == 2
+
+
+def test_complete_sends_once_when_nothing_is_cut_off(api, client):
+    message = complete(lambda request, base: client.messages.create(**request), text_request(1000))
+    assert message.stop_reason == "end_turn"
+    assert api.stats.requests == 1
+
+
+def test_complete_async_matches_complete(api):
+    async def run():
+        async with anthropic.AsyncAnthropic(api_key="sk-test", base_url=api.base_url, max_retries=0) as client:
+            return await complete_async(lambda request, base: client.messages.create(**request), text_request(400))
+
+    merged = asyncio.run(run())
+    assert merged.stop_reason == "end_turn"
+    assert api.stats.requests == 2
+
+
+def test_a_tool_call_that_settled_nothing_is_asked_for_again_with_more_room(client):
+    request = tool_request(100)
+    first = client.messages.create(**request)
+    assert settled_output(first) == {}
+    follow_up = continuation_request(request, first)
+    assert follow_up == dict(request, max_tokens=200)
+    assert continuation_request(request, first, ceiling=150)["max_tokens"] == 150
+    assert continuation_request(request, first, ceiling=100) is None
+
+
+def test_a_one_field_revision_is_not_sent_again_unchanged(api, client):
+    limits = []
+
+    def create(params):
+        limits.append(params["max_tokens"])
+        return client.messages.create(**params)
+
+    engine = Engine(budget=OutputBudget(ceiling=4096))
+    question_set = extract_question_set(client.messages.create(**tool_request(2048)))
+    turns = [
+        {"role": "user", "content": "Asthma"},
+        {"role": "assistant", "content": question_set.to_markdown()},
+        {"role": "user", "content": "Shorten the stem"},
+    ]
+    # A stem longer than the 600 tokens a stem revision is given
+    api.config.output_tokens = 700
+    turn = engine.revise(question_set, "stem", "Shorten the stem", engine.sender(create), engine.route(turns))
+    assert turn.question_set.stem != question_set.stem
+    # Cut off with nothing settled, then asked for once more with twice the room
+    assert limits == [600, 1200]
@@ -0,0 +1,60 @@
+from qgen.dedup import NUM_PERM, StemIndex, signature
+
+ASTHMA = "A 24-year-old woman presents with wheeze and breathlessness after a viral illness."
+GOUT = "A 61-year-old man has a hot swollen first metatarsophalangeal joint after a night of drinking."
+STROKE = "A 72-year-old man has sudden weakness of his right arm and face and slurred speech."
+
+
+def test_near_duplicates_are_found_and_others_are_not():
+    index = StemIndex()
+    assert index.check_and_add(ASTHMA, "asthma") == []
+    assert index.check_and_add(GOUT, "gout") == []
+    matches = index.query(ASTHMA.replace("24-year-old", "26-year-old"))
+    assert [label for label, _ in matches] == ["asthma"]
+    assert index.query(STROKE) == []
+
+
+def test_the_index_is_reloaded_from_disk(tmp_path):
+    index = StemIndex(str(tmp_path / "stems"))
+    index.add(ASTHMA, "asthma")
+    index.add(GOUT, "gout")
+    reloaded = StemIndex(str(tmp_path / "stems"))
+    assert reloaded.labels == ["asthma", "gout"]
+    assert reloaded.query(GOUT)[0][0] == "gout"
+
+
+def test_a_signature_written_without_its_label_is_dropped_on_reload(tmp_path):
+    path = tmp_path / "stems"
+    index = StemIndex(str(path))
+    index.add(ASTHMA, "asthma")
+    # As if the process died between writing the signature and the label
+    with open(path.with_suffix(".sig"), "ab") as f:
+        f.write(signature(GOUT).tobytes())
+
+    reloaded = StemIndex(str(path))
+    assert reloaded.labels == ["asthma"]
+    assert path.with_suffix(".sig").stat().st_size == NUM_PERM * 4
+    reloaded.add(STROKE, "stroke")
+
+    # Every later restart still pairs each label with its own stem
+    again = StemIndex(str(path))
+    assert again.labels == ["asthma", "stroke"]
+    assert again.query(STROKE)[0][0] == "stroke"
+    assert again.query(GOUT) == []
+
+
+def test_a_label_cut_short_is_dropped_on_reload(tmp_path):
+    path = tmp_path / "stems"
+    index = StemIndex(str(path))
+    index.add(ASTHMA, "asthma")
+    with open(path.with_suffix(".sig"), "ab") as f:
+        f.write(signature(GOUT).tobytes()[: NUM_PERM * 2])
+    with open(path.with_suffix(".labels"), "a", encoding="utf-8") as f:
+        f.write('"go')
+
+    reloaded = StemIndex(str(path))
+    assert reloaded.labels == ["asthma"]
+    reloaded.add(GOUT, "gout")
+    again = StemIndex(str(path))
+    assert again.labels == ["asthma", "gout"]
+    assert again.query(GOUT)[0][0] == "gout"
@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+import anthropic
+
+from qgen.engine import Engine, Settings
+from qgen.fake_api import FakeConfig, FakeMessagesAPI
+from qgen.scheduler import KeyLimiter
+from qgen.telemetry import Telemetry
+
+ANSWER = {"role": "assistant", "content": "**Question Stem**\nA 54-year-old man..."}
+
+
+def tool_choice(turns, structured=True):
+    engine = Engine(Settings(structured=structured))
+    return engine.chat_request(turns, new_question=engine.new_question(turns)).get("tool_choice")
+
+
+def test_new_question_sets_are_forced_through_the_tool():
+    assert tool_choice([{"role": "user", "content": "Asthma"}])["type"] == "tool"
+    turns = [{"role": "user", "content": "Asthma"}, ANSWER, {"role": "user", "content": "Write another one"}]
+    assert tool_choice(turns)["type"] == "tool"
+
+
+def test_follow_ups_may_answer_in_text():
+    turns = [{"role": "user", "content": "Asthma"}, ANSWER, {"role": "user", "content": "Why is C wrong?"}]
+    assert tool_choice(turns) == {"type": "auto"}
+
+
+def test_free_text_mode_offers_no_tool():
+    assert tool_choice([{"role": "user", "content": "Asthma"}], structured=False) is None
+
+
+def recorded_calls(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def flaky_api(**config):
+    return FakeMessagesAPI(FakeConfig(**dict(dict(latency=0, error_rate=0.3, error_status=429, seed=11), **config)))
+
+
+def fast_limiter():
+    return KeyLimiter(requests_per_minute=100000, tokens_per_minute=10**8, max_retries=10, backoff_base=0.001)
+
+
+def test_every_bulk_attempt_is_recorded(tmp_path):
+    path = tmp_path / "calls.jsonl"
+    engine = Engine(Settings(duplicate_stems="Off"), telemetry=Telemetry(str(path)))
+    # Longer than a structured answer's 2048 tokens, so answers are continued
+    with flaky_api(output_tokens=4000) as api:
+        client = anthropic.AsyncAnthropic(api_key="sk-test", base_url=api.base_url, max_retries=0)
+        jobs = engine.jobs("condition", ["Asthma", "Gout", "Sepsis"], 2)
+        results = engine.generate_bulk(client, jobs, limiter=fast_limiter())
+    assert all(result.error is None for result in results)
+    calls = recorded_calls(path)
+    assert len(calls) == api.stats.requests
+    failed = [call for call in calls if call["error"]]
+    assert len(failed) == api.stats.errors > 0
+    assert {call["error"] for call in failed} == {"RateLimitError"}
+    assert any(call["stop_reason"] == "max_tokens" for call in calls)
+    assert all(call["time_to_first_token"] for call in calls if not call["error"])
+    assert {call["source"] for call in calls} == {"bulk"}
+
+
+def test_every_service_chat_attempt_is_recorded(tmp_path):
+    path = tmp_path / "calls.jsonl"
+    engine = Engine(Settings(duplicate_stems="Off"), telemetry=Telemetry(str(path)))
+
+    async def chat(base_url):
+        async with anthropic.AsyncAnthropic(api_key="sk-test", base_url=base_url, max_retries=0) as client:
+            return await engine.chat(client, [{"role": "user", "content": "Asthma"}], limiter=fast_limiter())
+
+    with flaky_api(error_rate=0.6) as api:
+        turn = asyncio.run(chat(api.base_url))
+    assert turn.error is None and turn.question_set is not None
+    calls = recorded_calls(path)
+    assert len(calls) == api.stats.requests > 1
+    assert sum(1 for call in calls if call["error"]) == api.stats.errors
+    assert {call["route"] for call in calls} == {"generation"}
@@ -0,0 +1,111 @@
+from qgen.history import HistoryWindow
+
+
+def conversation(turns):
+    """``turns`` question-and-answer pairs followed by a new prompt."""
+    messages = []
+    for number in range(turns):
+        messages.append({"role": "user", "content": f"prompt {number}"})
+        messages.append({"role": "assistant", "content": f"answer {number}"})
+    messages.append({"role": "user", "content": f"prompt {turns}"})
+    return messages
+
+
+def contents(window):
+    return [message["content"] for message in window]
+
+
+def test_nothing_is_folded_while_the_turns_fit():
+    history = HistoryWindow(keep_turns=6)
+    messages = conversation(6)
+    assert history.window(messages) == [{"role": m["role"], "content": m["content"]} for m in messages]
+    assert history.summary == ""
+
+
+def test_a_fold_keeps_half_the_turns_before_the_new_prompt():
+    history = HistoryWindow(keep_turns=6)
+    window = history.window(conversation(7))
+    assert contents(window) == [
+        "prompt 4", "answer 4", "prompt 5", "answer 5", "prompt 6", "answer 6", "prompt 7",
+    ]
+    assert history.folded == 8
+    assert history.summary.splitlines()[1:3] == ["- Writer asked: prompt 0", "- Claude answered: answer 0"]
+
+
+def test_the_window_stays_put_between_folds():
+    history = HistoryWindow(keep_turns=6)
+    messages = conversation(7)
+    history.window(messages)
+    for number in range(7, 10):
+        messages[-1:] = [messages[-1], {"role": "assistant", "content": f"answer {number}"}]
+        messages.append({"role": "user", "content": f"prompt {number + 1}"})
+        assert history.window(messages)[0]["content"] == "prompt 4"
+    assert history.folded == 8
+
+
+def test_a_single_kept_turn_still_sends_the_answer_being_refined():
+    for keep_turns in (1, 2, 3):
+        history = HistoryWindow(keep_turns=keep_turns)
+        window = history.window(conversation(keep_turns + 1))
+        assert window[0]["role"] == "user"
+        assert contents(window)[-2:] == [f"answer {keep_turns}", f"prompt {keep_turns + 1}"]
+
+
+def test_the_token_budget_folds_long_answers():
+    history = HistoryWindow(keep_turns=6, token_budget=50)
+    messages = conversation(3)
+    messages[1]["content"] = "long " * 200
+    window = history.window(messages)
+    assert contents(window) == ["prompt 1", "answer 1", "prompt 2", "answer 2", "prompt 3"]
+    folded = history.summary.splitlines()[1:]
+    assert folded[0] == "- Writer asked: prompt 0"
+    assert folded[1].startswith("- Claude answered: long long") and folded[1].endswith("…")
+
+
+def test_pinned_answers_are_sent_as_a_reference():
+    history = HistoryWindow(keep_turns=6)
+    messages = conversation(2)
+    messages[1]["content"] = "**Question Stem**\nA 54-year-old man...\n**Lead-in**"
+    assert history.pin(messages[1]) == "QS-1"
+    assert history.pin(messages[1]) == "QS-1"
+    window = history.window(messages)
+    assert window[1]["content"].startswith("[Finalised question set QS-1, pinned")
+    assert "**Question Stem**" in window[1]["content"]
+    assert "Lead-in" not in window[1]["content"]
+    assert "pinned" not in window[1]
+
+
+def test_pinned_answers_are_summarised_as_finalised():
+    history = HistoryWindow(keep_turns=1)
+    messages = conversation(3)
+    history.pin(messages[1])
+    history.window(messages)
+    assert "- Finalised question set QS-1: answer 0" in history.summary
+
+
+def test_trim_drops_folded_messages_beyond_the_cap():
+    history = HistoryWindow(keep_turns=2, max_stored_messages=2)
+    messages = conversation(5)
+    window = history.window(messages)
+    assert history.folded == 8
+    trimmed = history.trim(messages)
+    assert len(trimmed) == len(messages) - 6
+    assert (history.folded, history.dropped) == (2, 6)
+    # The same verbatim window is still sent from the trimmed history
+    assert history.window(trimmed) == window
+
+
+def test_trim_keeps_everything_under_the_cap():
+    history = HistoryWindow(keep_turns=6)
+    messages = conversation(7)
+    history.window(messages)
+    assert history.trim(messages) is messages
+    assert history.dropped == 0
+
+
+def test_the_summary_keeps_only_its_newest_lines():
+    history = HistoryWindow(keep_turns=1, max_summary_lines=3)
+    history.window(conversation(4))
+    lines = history.summary.splitlines()
+    assert lines[1] == "(3 earlier messages omitted)"
+    assert lines[2:] == ["- Claude answered: answer 1", "- Writer asked: prompt 2", "- Claude answered: answer 2"]
@@ -0,0 +1,46 @@
+import pytest
+
+from qgen.refine import detect_section, is_edit
+
+
+@pytest.mark.parametrize("prompt, section", [
+    ("Please make the stem more concise", "stem"),
+    ("Shorten the lead-in", "lead_in"),
+    ("Make the distractors closer to the correct answer", "options"),
+    ("Rewrite the explanations more briefly", "explanations"),
+    ("Make it more difficult", "difficulty"),
+    ("Change the module and presentation", "categorisation"),
+    ("Recategorise this question set", "categorisation"),
+])
+def test_edit_requests_target_their_section(prompt, section):
+    assert detect_section(prompt) == section
+
+
+@pytest.mark.parametrize("prompt", [
+    "Generate a more difficult question on Addison's disease",
+    "Now write a question for the presentation chest pain",
+    "Give me another question with a different scenario",
+    "Make a new question with a shorter stem",
+])
+def test_requests_for_new_questions_are_not_edits(prompt):
+    assert not is_edit(prompt)
+    assert detect_section(prompt) is None
+
+
+def test_module_or_presentation_alone_is_not_categorisation():
+    assert detect_section("Change the presentation") is None
+    assert detect_section("Make it fit the cardiovascular module") is None
+
+
+def test_questions_about_the_answer_are_not_edits():
+    assert detect_section("Why is option C wrong?") is None
+
+
+def test_saved_prompts_are_edits_without_an_edit_verb():
+    saved = ["Stem: more concise please"]
+    assert detect_section("stem:  more concise please") is None
+    assert detect_section("stem:  more concise please", saved) == "stem"
+
+
+def test_several_sections_are_not_targeted():
+    assert detect_section("Make the stem and the options shorter") is None
@@ -0,0 +1,103 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from qgen import response_cache
+from qgen.payload import build_messages, build_system
+from qgen.response_cache import ResponseCache, request_key
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+    def tick(self, seconds: float = 1.0) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache, "time", SimpleNamespace(time=clock.time))
+    return clock
+
+
+def entry(size: int) -> dict:
+    """A value that takes up exactly ``size`` bytes once stored."""
+    padding = size - len(json.dumps({"text": ""}))
+    return {"text": "x" * padding}
+
+
+def request(cache: bool = True, max_tokens: int = 1024, prompt: str = "Asthma", summary: str = "") -> dict:
+    turns = [{"role": "user", "content": prompt}]
+    return dict(
+        model="claude-3-7-sonnet-20250219",
+        max_tokens=max_tokens,
+        temperature=0.7,
+        system=build_system("Write SBA questions.", cache, summary),
+        messages=build_messages(turns, cache),
+    )
+
+
+def test_request_key_ignores_cache_control_and_max_tokens():
+    assert request_key(request(cache=True)) == request_key(request(cache=False))
+    summary = "Summary of the earlier conversation:\n- Writer asked: gout"
+    assert request_key(request(cache=True, summary=summary)) == request_key(request(cache=False, summary=summary))
+    assert request_key(request(summary=summary)) != request_key(request())
+    assert request_key(request(max_tokens=1024)) == request_key(request(max_tokens=4096))
+    assert request_key(request(prompt="Asthma")) != request_key(request(prompt="Gout"))
+    assert request_key(dict(request(), temperature=0.2)) != request_key(request())
+
+
+def test_entries_round_trip_and_count_hits(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    cache.put("a", {"text": "answer", "question_set": None})
+    assert cache.get("a") == {"text": "answer", "question_set": None}
+    assert cache.get("b") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1, "bytes": len(json.dumps(cache.get("a")))}
+
+
+def test_entries_expire_after_their_ttl(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), ttl=60)
+    cache.put("default", entry(100))
+    cache.put("short", entry(100), ttl=10)
+    clock.tick(30)
+    assert cache.get("short") is None
+    assert cache.get("default") is not None
+    clock.tick(31)
+    assert cache.get("default") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_the_byte_cap_evicts_least_recently_used_first(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=300)
+    for key in ("a", "b", "c"):
+        cache.put(key, entry(100))
+        clock.tick()
+    # Reading "a" makes "b" the least recently used
+    assert cache.get("a") is not None
+    clock.tick()
+    cache.put("d", entry(100))
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in ("a", "c", "d"))
+    assert cache.stats()["bytes"] == 300
+
+
+def test_a_large_entry_evicts_as_many_as_it_needs(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=300)
+    for key in ("a", "b", "c"):
+        cache.put(key, entry(100))
+        clock.tick()
+    cache.put("big", entry(250))
+    assert [cache.get(key) is not None for key in ("a", "b", "c", "big")] == [False, False, False, True]
+    assert cache.stats()["bytes"] <= 300
+
+
+def test_the_cache_persists_across_instances(tmp_path, clock):
+    path = str(tmp_path / "cache.sqlite")
+    ResponseCache(path).put("a", {"text": "answer"})
+    assert ResponseCache(path).get("a") == {"text": "answer"}
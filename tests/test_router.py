@@ -0,0 +1,51 @@
+import pytest
+
+from qgen.refine import detect_section
+from qgen.router import CATEGORISATION, DEFAULT_TIERS, GENERATION, REFINEMENT, Router, classify
+
+
+def route(prompt, saved_prompts=(), has_answer=True):
+    section = detect_section(prompt, saved_prompts) if has_answer else None
+    return Router().route(prompt, saved_prompts, section, has_answer)
+
+
+@pytest.mark.parametrize("prompt", [
+    "Generate a more difficult question on Addison's disease",
+    "Now write a question for the presentation chest pain",
+    "Give me another question with a different scenario",
+    "Write a new question with a shorter stem and closer options",
+    "Create a question on the cardiovascular module and presentation of chest pain",
+])
+def test_generation_prompts_with_section_words_use_the_generation_tier(prompt):
+    result = route(prompt)
+    assert result.turn_class == GENERATION
+    assert result.tier == DEFAULT_TIERS["strong"]
+
+
+def test_section_words_are_ignored_even_if_a_section_is_passed():
+    turn_class, _ = classify("Generate a more difficult question", section="difficulty", has_answer=True)
+    assert turn_class == GENERATION
+
+
+def test_edits_of_one_section_are_refinements():
+    result = route("Make the stem more concise")
+    assert result.turn_class == REFINEMENT
+    assert result.tier == DEFAULT_TIERS["fast"]
+
+
+def test_categorisation_edits():
+    assert route("Change the module and presentation").turn_class == CATEGORISATION
+
+
+def test_saved_prompts_are_refinements():
+    assert route("Tighten up the wording", ["Tighten up the wording"]).turn_class == REFINEMENT
+
+
+def test_first_turn_is_always_generation():
+    assert route("Make the stem more concise", has_answer=False).turn_class == GENERATION
+
+
+def test_routing_off_uses_the_generation_tier():
+    result = Router().route("Make the stem more concise", (), "stem", True, enabled=False)
+    assert result.turn_class == REFINEMENT
+    assert result.tier == DEFAULT_TIERS["strong"]
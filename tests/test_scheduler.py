@@ -0,0 +1,117 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import anthropic
+import httpx
+import pytest
+
+from qgen.scheduler import BULK, CHAT, KeyLimiter, estimate_request_tokens
+
+REQUEST = {"messages": [{"role": "user", "content": "Asthma"}], "max_tokens": 1000}
+
+
+def rate_limited(seconds: float) -> anthropic.RateLimitError:
+    response = httpx.Response(
+        429, headers={"retry-after": str(seconds)}, request=httpx.Request("POST", "https://api.example/v1/messages")
+    )
+    return anthropic.RateLimitError("rate limited", response=response, body=None)
+
+
+def reply(input_tokens: int = 0, output_tokens: int = 0):
+    return SimpleNamespace(usage=SimpleNamespace(input_tokens=input_tokens, output_tokens=output_tokens))
+
+
+def test_a_waiting_chat_turn_goes_before_queued_bulk_jobs():
+    limiter = KeyLimiter(requests_per_minute=600)
+    # An empty bucket refills one request every 0.1s, so every call has to queue
+    limiter.requests.take(limiter.requests.capacity)
+    order = []
+
+    async def call(name, priority):
+        async def fn():
+            order.append(name)
+            return reply()
+
+        await limiter.call_async(fn, REQUEST, priority)
+
+    async def main():
+        bulk = [asyncio.create_task(call(f"bulk {i}", BULK)) for i in range(3)]
+        await asyncio.sleep(0.02)
+        await asyncio.gather(call("chat", CHAT), *bulk)
+
+    asyncio.run(main())
+    assert order[0] == "chat"
+    assert sorted(order) == ["bulk 0", "bulk 1", "bulk 2", "chat"]
+
+
+def test_retry_after_pauses_every_call_on_the_key():
+    limiter = KeyLimiter(backoff_base=0.001)
+    attempts = []
+
+    async def refused_once():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise rate_limited(0.3)
+        return reply()
+
+    async def other_session():
+        await asyncio.sleep(0.05)
+
+        async def fn():
+            return time.monotonic()
+
+        return await limiter.call_async(fn, REQUEST, CHAT)
+
+    async def main():
+        return await asyncio.gather(limiter.call_async(refused_once, REQUEST, BULK), other_session())
+
+    _, other_ran = asyncio.run(main())
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 0.3
+    assert other_ran - attempts[0] >= 0.3
+
+
+def test_the_token_estimate_is_given_back_when_a_call_fails():
+    limiter = KeyLimiter(tokens_per_minute=40000)
+    limiter.tokens.take(10000)
+
+    def fail():
+        raise ValueError("not retried")
+
+    with pytest.raises(ValueError):
+        limiter.call(fail, REQUEST)
+    assert limiter.tokens.level == pytest.approx(30000, abs=50)
+
+    # A call that succeeds keeps only what it actually used
+    limiter.call(lambda: reply(100, 200), REQUEST)
+    assert limiter.tokens.level == pytest.approx(29700, abs=50)
+    assert estimate_request_tokens(REQUEST) > 1000
+
+
+def test_transient_failures_are_retried_until_the_limit():
+    limiter = KeyLimiter(max_retries=2, backoff_base=0.001)
+    attempts = []
+    retries = []
+
+    def overloaded():
+        attempts.append(1)
+        raise rate_limited(0)
+
+    with pytest.raises(anthropic.RateLimitError):
+        limiter.call(overloaded, REQUEST, on_retry=lambda error, delay: retries.append(delay))
+    assert len(attempts) == 3
+    assert len(retries) == 2
+
+
+def test_other_failures_are_not_retried():
+    limiter = KeyLimiter(backoff_base=0.001)
+    attempts = []
+
+    def bad_request():
+        attempts.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        limiter.call(bad_request, REQUEST)
+    assert len(attempts) == 1
@@ -0,0 +1,23 @@
+import pytest
+
+from qgen.server import MAX_COUNT, parse_generate
+
+
+def test_parse_generate():
+    assert parse_generate({"items": [" Asthma ", "Gout"], "count": 2}) == ("condition", ["Asthma", "Gout"], 2)
+    assert parse_generate({"kind": "presentation", "item": "Chest pain"}) == ("presentation", ["Chest pain"], 1)
+
+
+@pytest.mark.parametrize("body", [
+    {"items": "Asthma"},
+    {"items": {"Asthma": 1}},
+    {"items": []},
+    {"items": ["Asthma", ""]},
+    {"items": ["Asthma"], "count": True},
+    {"items": ["Asthma"], "count": 2.0},
+    {"items": ["Asthma"], "count": MAX_COUNT + 1},
+    {"items": ["Asthma"], "kind": "module"},
+])
+def test_parse_generate_rejects(body):
+    with pytest.raises(ValueError):
+        parse_generate(body)
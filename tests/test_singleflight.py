@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+
+from qgen.singleflight import SingleFlight
+
+
+class Cancelled(BaseException):
+    pass
+
+
+def run_leader(flights, key, fn):
+    """Start ``fn`` as the leader for ``key`` on a thread, once it has begun running."""
+    outcome = {}
+    started = threading.Event()
+
+    def lead(publish):
+        started.set()
+        return fn(publish)
+
+    def target():
+        try:
+            outcome["value"] = flights.do(key, lead)
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    assert started.wait(5)
+    return thread, outcome
+
+
+def follow(flights, key, count):
+    """Start ``count`` followers for ``key``; returns their threads and outcomes."""
+    outcomes = [{} for _ in range(count)]
+
+    def target(outcome):
+        updates = []
+        try:
+            outcome["value"] = flights.do(key, lambda publish: pytest.fail("a follower made the call"), updates.append)
+        except BaseException as e:
+            outcome["error"] = e
+        outcome["updates"] = updates
+
+    threads = [threading.Thread(target=target, args=(outcome,)) for outcome in outcomes]
+    for thread in threads:
+        thread.start()
+    # Let every follower join the flight before the leader is released
+    time.sleep(0.1)
+    return threads, outcomes
+
+
+def test_followers_get_the_leaders_result_and_snapshots():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def call(publish):
+        release.wait(5)
+        publish("partial")
+        return "answer"
+
+    leader, led = run_leader(flights, "key", call)
+    threads, outcomes = follow(flights, "key", 3)
+    release.set()
+    for thread in [leader, *threads]:
+        thread.join(5)
+    assert led["value"] == ("answer", False)
+    for outcome in outcomes:
+        assert outcome["value"] == ("answer", True)
+        assert outcome["updates"] in (["partial"], [])
+
+
+def test_followers_get_the_leaders_error():
+    flights = SingleFlight()
+    release = threading.Event()
+    error = ValueError("overloaded")
+
+    def call(publish):
+        release.wait(5)
+        raise error
+
+    leader, led = run_leader(flights, "key", call)
+    threads, outcomes = follow(flights, "key", 2)
+    release.set()
+    for thread in [leader, *threads]:
+        thread.join(5)
+    assert led["error"] is error
+    assert all(outcome["error"] is error for outcome in outcomes)
+
+
+def test_the_key_is_forgotten_once_the_call_ends():
+    flights = SingleFlight()
+    calls = []
+
+    def call(publish):
+        calls.append(1)
+        return len(calls)
+
+    assert flights.do("key", call) == (1, False)
+    assert flights.do("key", call) == (2, False)
+
+    def fail(publish):
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        flights.do("key", fail)
+    assert flights.do("key", call) == (3, False)
+
+
+def test_a_cancelled_leader_does_not_cancel_its_followers():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def call(publish):
+        release.wait(5)
+        raise Cancelled()
+
+    leader, led = run_leader(flights, "key", call)
+    threads, outcomes = follow(flights, "key", 2)
+    release.set()
+    for thread in [leader, *threads]:
+        thread.join(5)
+    assert isinstance(led["error"], Cancelled)
+    for outcome in outcomes:
+        assert isinstance(outcome["error"], RuntimeError)
+        assert "cancelled" in str(outcome["error"])
+    assert flights.do("key", lambda publish: "fresh") == ("fresh", False)
+
+
+def test_different_keys_do_not_share():
+    flights = SingleFlight()
+    release = threading.Event()
+    leader, led = run_leader(flights, "one", lambda publish: release.wait(5) and "first")
+    assert flights.do("two", lambda publish: "second") == ("second", False)
+    release.set()
+    leader.join(5)
+    assert led["value"] == ("first", False)